@@ -26,6 +26,10 @@ def get_verbosity(config_params):
 
 #yaml = YAML()
 
+# Upper limit on get_num_cores(), set when several pipeline steps run side
+# by side (see task_graph.py)
+num_cores_limit = None
+
 def parse_yaml(filename):
 
     with open(filename, 'rt') as f:
@@ -104,6 +108,9 @@ def get_num_cores(config_params):
                 '("{}") is not valid. Defaulting to the number of detected cores ' \
                 '/ 2'.format(n_raw)
         n = int(np.ceil(max_cores / 2.))
+
+    if num_cores_limit is not None:
+        n = min(n, num_cores_limit)
     
     return n
 
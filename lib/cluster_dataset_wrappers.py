@@ -15,6 +15,7 @@ import cPickle
 
 import cluster_dataset as clus
 from cg_common_functions import get_verbosity, get_sample_table, get_barcode_table, parse_yaml
+from dataset_io import load_dataset
 
 
 def get_lane_data_path(config_params, lane_id):
@@ -42,10 +43,8 @@ def get_dumped_count_matrix_filename(config_params, lane_id):
 def load_dumped_count_matrix(config_params, lane_id):
 
     filename = get_dumped_count_matrix_filename(config_params, lane_id)
-    f = gzip.open(filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = load_dataset(filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
 
     return dataset
 
@@ -62,10 +61,8 @@ def get_dumped_zscore_matrix_filename(config_params, lane_id):
 def load_dumped_zscore_matrix(config_params, lane_id):
 
     filename = get_dumped_zscore_matrix_filename(config_params, lane_id)
-    f = gzip.open(filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = load_dataset(filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
 
     return dataset
 
@@ -10,6 +10,20 @@ VERSION='2.6.1'
 # http://stackoverflow.com/questions/13044562/python-mechanism-to-identify-compressed-file-type-and-uncompress
 
 import zipfile, bz2, gzip
+import threading, Queue, subprocess, tempfile
+from distutils.spawn import find_executable
+
+compressed_magic_bytes = ('\x1f\x8b\x08', '\x42\x5a\x68', '\x50\x4b\x03\x04')
+
+# Checks the "magic bytes" to determine whether a file is compressed
+# with any of the formats understood below.
+def is_compressed(filename):
+
+    f = file(filename, 'rb')
+    file_start = f.read(4)
+    f.close()
+
+    return file_start.startswith(compressed_magic_bytes)
 
 # factory function to create a suitable instance for accessing files
 def get_compressed_file_handle(filename):
@@ -31,9 +45,151 @@ def get_compressed_file_handle(filename):
 	return bz2.BZ2File(filename, 'r')
     # And zip files
     elif file_start.startswith('\x50\x4b\x03\x04'):
-	return zipfile.Zipfile(filename, 'r')
+	# Zip archives hold files rather than a single stream, so open
+	# the first (presumably only) file inside
+	zf = zipfile.ZipFile(filename, 'r')
+	return zf.open(zf.namelist()[0], 'r')
     # And if nothing matches, hopefully it's a text file!
     else:
 	return file(filename, 'rt')
 
+# Multi-threaded command-line decompressors that are used, if found on the
+# PATH, to decompress files for ThreadedLineReader
+external_decompressors = {'\x1f\x8b\x08': ['pigz'], '\x42\x5a\x68': ['pbzip2', 'lbzip2']}
+
+def find_external_decompressor(filename):
+
+    f = file(filename, 'rb')
+    file_start = f.read(4)
+    f.close()
+
+    for magic_bytes, programs in external_decompressors.iteritems():
+        if file_start.startswith(magic_bytes):
+            for program in programs:
+                path = find_executable(program)
+                if path is not None:
+                    return path
+    return None
+
+class ThreadedLineReader:
+    '''
+    Reads the lines of a (possibly compressed) text file, with reading and
+    decompression done ahead of time in a background thread. Large blocks of
+    decompressed data are held in a bounded queue, so reading stays at most
+    "queue_size" blocks ahead of the consumer. If "external" is True and a
+    multi-threaded decompressor (e.g. pigz) is on the PATH, the file is
+    piped through it instead of being decompressed in Python.
+
+    Use read_lines(n) to get lists of up to n lines (without line endings),
+    and close the reader (or use it in a "with" statement) when done.
+    '''
+
+    def __init__(self, filename, block_size = 2**22, queue_size = 8, external = True):
+        self.filename = filename
+        self.queue = Queue.Queue(maxsize = queue_size)
+        self.stopping = threading.Event()
+        self.leftover = ''
+        self.lines = []
+        self.pos = 0
+        self.done = False
+
+        self.proc = None
+        decompressor = find_external_decompressor(filename) if external else None
+        if decompressor is not None:
+            # Error messages go to a temporary file rather than a pipe, which
+            # could fill up (and block the decompressor) while only stdout
+            # is being read
+            self.errors = tempfile.TemporaryFile()
+            self.proc = subprocess.Popen([decompressor, '-dc', filename], stdout = subprocess.PIPE, stderr = self.errors)
+            self.f = self.proc.stdout
+        else:
+            self.f = get_compressed_file_handle(filename)
+
+        self.thread = threading.Thread(target = self._fill_queue, args = (block_size,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        # Stop waiting for space in the queue if the reader gets closed
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return None
+            except Queue.Full:
+                pass
+        return None
+
+    def _fill_queue(self, block_size):
+        # Runs in the background thread. Exceptions are passed along to
+        # the consumer, and None marks the end of the file.
+        try:
+            while not self.stopping.is_set():
+                block = self.f.read(block_size)
+                if block == '':
+                    break
+                self._put(block)
+            if self.proc is not None and not self.stopping.is_set():
+                self.proc.wait()
+                self.errors.seek(0)
+                error = self.errors.read()
+                assert self.proc.returncode == 0, 'Could not decompress "{}":\n{}'.format(self.filename, error)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def read_lines(self, n_lines):
+        '''
+        Returns a list of the next "n_lines" lines, or fewer at the end of
+        the file (an empty list once it has all been read).
+        '''
+        lines = []
+        while len(lines) < n_lines:
+            if self.pos == len(self.lines):
+                if self.done:
+                    break
+                block = self.queue.get()
+                if isinstance(block, Exception):
+                    self.done = True
+                    raise block
+                if block is None:
+                    # A last line without a line ending
+                    self.done = True
+                    self.lines = [self.leftover] if self.leftover != '' else []
+                    self.leftover = ''
+                else:
+                    self.lines = (self.leftover + block).split('\n')
+                    self.leftover = self.lines.pop()
+                self.pos = 0
+                continue
+            n = min(n_lines - len(lines), len(self.lines) - self.pos)
+            lines.extend(self.lines[self.pos:self.pos + n])
+            self.pos += n
+        return lines
+
+    def __iter__(self):
+        while True:
+            lines = self.read_lines(10000)
+            if len(lines) == 0:
+                break
+            for line in lines:
+                yield line
+
+    def close(self):
+        self.stopping.set()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+        self.thread.join()
+        if self.proc is not None:
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.errors.close()
+        else:
+            self.f.close()
+        return None
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
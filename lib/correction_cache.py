@@ -0,0 +1,105 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Persistent record of which reference sequence each observed index tag or
+# barcode sequence was corrected to, so the same sequencing errors do not
+# need to be matched again in every lane and on every rerun.
+#
+# Each set of corrections lives in its own gzipped pickle, named by a hash of
+# everything that determines the corrections (the reference sequences, the
+# error tolerance and the length of the sequence window). The file holds a
+# dict of observed sequence -> [corrected sequence, times seen, last used].
+# Updates happen under an exclusive lock and replace the file atomically, so
+# lanes parsed at the same time can share the cache, and readers never see
+# a partially written file.
+
+import os, gzip, time, hashlib, tempfile
+import cPickle
+import fcntl
+
+def get_cache_key(refs, tol, length):
+    '''
+    Returns the hex digest identifying the corrections made against "refs"
+    with tolerance "tol" for sequence windows of length "length".
+    '''
+    h = hashlib.sha1()
+    h.update('{}\t{}\n'.format(repr(tol), length))
+    h.update('\n'.join(sorted(set(refs))))
+    return h.hexdigest()
+
+class CorrectionCache:
+
+    def __init__(self, folder, max_size):
+        '''
+        "max_size" is the maximum number of observed sequences kept for each
+        key. When a file grows beyond that, the least recently used
+        sequences are dropped first, and among those last used at the same
+        time, the least frequently seen.
+        '''
+        self.folder = folder
+        self.max_size = max_size
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another lane may have just created it
+                assert os.path.isdir(folder), 'Could not create correction cache folder: {}'.format(folder)
+
+    def _filename(self, key):
+        return os.path.join(self.folder, '{}.dump.gz'.format(key))
+
+    def _read(self, key):
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return {}
+        f = gzip.open(filename, 'rb')
+        entries = cPickle.load(f)
+        f.close()
+        return entries
+
+    def load(self, key):
+        '''
+        Returns a dict of observed sequence -> corrected sequence (or
+        "multi_match"/"no_match") for the given key.
+        '''
+        return {seq: entry[0] for seq, entry in self._read(key).iteritems()}
+
+    def update(self, key, match_dict):
+        '''
+        Adds the observed sequences from "match_dict" (observed sequence ->
+        [corrected sequence, count], as built while parsing) to the cache
+        and evicts entries beyond "max_size".
+        '''
+        lock = open(self._filename(key) + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Re-read under the lock to pick up other lanes' additions
+            entries = self._read(key)
+            now = time.time()
+            for seq, match in match_dict.iteritems():
+                if seq in entries:
+                    entries[seq][1] += match[1]
+                    entries[seq][2] = now
+                else:
+                    entries[seq] = [match[0], match[1], now]
+
+            if len(entries) > self.max_size:
+                kept = sorted(entries.iteritems(), key = lambda x: (x[1][2], x[1][1]), reverse = True)[0:self.max_size]
+                entries = dict(kept)
+
+            fd, tmp_filename = tempfile.mkstemp(dir = self.folder, suffix = '.tmp')
+            raw_f = os.fdopen(fd, 'wb')
+            f = gzip.GzipFile(fileobj = raw_f, mode = 'wb')
+            cPickle.dump(entries, f, protocol = cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            raw_f.close()
+            os.chmod(tmp_filename, 0644)
+            os.rename(tmp_filename, self._filename(key))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+        return None
@@ -0,0 +1,116 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Hash-table lookups of conditions and strains, to replace scanning an array
+# of IDs for every condition (or strain) of a dataset. A ConditionIndex maps
+# (screen_name, expt_id) condition IDs, and a StrainIndex maps Strain_IDs, to
+# their positions in a list of IDs: the columns (rows) of a dataset, or the
+# rows of the sample (barcode) table. Indexes of a table also look up the
+# values of its columns (e.g. "include?", "control?" or a batch column) for
+# any list of IDs, such as the conditions of a dataset.
+
+import numpy as np
+from cg_common_functions import bool_dict
+
+def get_condition_ids(sample_table):
+    '''
+    Returns the (screen_name, expt_id) condition IDs of the rows of the
+    sample table, as an n x 2 array.
+    '''
+    return np.array(zip(sample_table['screen_name'], sample_table['expt_id']))
+
+class LabelIndex:
+
+    def __init__(self, ids, table = None):
+        '''
+        Indexes the IDs in "ids". If "table" is given, it must have one row
+        per ID, in the same order, for looking up column values.
+        '''
+        self.ids = [self._key(x) for x in ids]
+        self.positions = {}
+        for i, x in enumerate(self.ids):
+            self.positions.setdefault(x, i)
+        self.table = table
+
+    def _key(self, x):
+        return x
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, x):
+        return self._key(x) in self.positions
+
+    def get_positions(self, ids):
+        '''
+        Returns the position of each of "ids" in the index, or -1 for those
+        not in it.
+        '''
+        return np.array([self.positions.get(self._key(x), -1) for x in ids], dtype = np.int)
+
+    def isin(self, ids):
+        '''
+        Returns whether each of "ids" is in the index.
+        '''
+        return self.get_positions(ids) >= 0
+
+    def find(self, ids):
+        '''
+        Returns the indices of the "ids" that are in the index (for
+        selecting them from a dataset).
+        '''
+        return np.flatnonzero(self.isin(ids))
+
+    def lookup(self, ids):
+        '''
+        Returns the position of each of "ids" in the index, all of which
+        must be in it.
+        '''
+        positions = self.get_positions(ids)
+        assert np.all(positions >= 0), '{} of the IDs were not found, for example: {}'.format(np.sum(positions < 0), ids[np.flatnonzero(positions < 0)[0]])
+        return positions
+
+    def get_column(self, column, ids):
+        '''
+        Returns the values in the table's column for each of "ids", all of
+        which must be in the index.
+        '''
+        return self.table[column].values[self.lookup(ids)]
+
+    def get_flags(self, column, ids):
+        '''
+        Returns the values in the table's True/False column (e.g.
+        "include?") for each of "ids", with False for those not in the
+        index.
+        '''
+        flags = np.array([bool_dict[x] for x in self.table[column]] + [False], dtype = np.bool)
+        return flags[self.get_positions(ids)]
+
+class ConditionIndex(LabelIndex):
+    '''
+    Index of (screen_name, expt_id) condition IDs, which can be given as
+    tuples or as rows of an n x 2 array.
+    '''
+    def _key(self, x):
+        return tuple(x)
+
+class StrainIndex(LabelIndex):
+    '''
+    Index of Strain_IDs.
+    '''
+    pass
+
+def index_sample_table(sample_table):
+    '''
+    Returns a ConditionIndex of the sample table's rows.
+    '''
+    return ConditionIndex(get_condition_ids(sample_table), sample_table)
+
+def index_barcode_table(barcode_table):
+    '''
+    Returns a StrainIndex of the barcode table's rows.
+    '''
+    return StrainIndex(barcode_table['Strain_ID'].values, barcode_table)
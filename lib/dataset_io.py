@@ -0,0 +1,246 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Reading and writing datasets: a list of label arrays followed by a matrix,
+# such as [strains, conditions, matrix], or [ncomps, strains, conditions,
+# matrix] for stacked datasets. Datasets are referred to by their
+# "*.dump.gz" filename, and can be stored in one of these formats:
+#
+#   pickle          A gzipped pickle at the filename itself, which has to be
+#                   decompressed and unpickled in full before any value can
+#                   be used.
+#   npy             A "*.dataset" folder next to the filename, holding a
+#                   .npy file for each label array, the matrix as an
+#                   uncompressed .npy file and a small JSON header. Loading
+#                   memory-maps the matrix, so only the parts of it that are
+#                   used are read from disk.
+#   npy_compressed  The same folder, but with the matrix compressed in
+#                   blocks of rows (which are read in full on loading).
+#
+# load_dataset reads whichever one exists, so scripts can load datasets
+# written in any format (including existing gzipped pickles). The matrix of a
+# stacked dataset may also be a LowRankStack (see stacked_dataset), which the
+# npy formats store as its base matrix plus its (small) component arrays. In
+# the pickle format it is written as the dense 3-D array, so that pickled
+# datasets stay plain numpy arrays that can be read without BEAN-counter.
+
+import os, gzip, json, shutil, tempfile
+import cPickle
+import numpy as np
+
+from stacked_dataset import from_arrays, is_low_rank_stack
+
+dataset_formats = ['pickle', 'npy', 'npy_compressed']
+
+npy_format_version = 1
+
+# Number of matrix values per block in the compressed npy format
+compressed_block_size = 2**22
+
+def get_dataset_format(config_params):
+
+    fmt = config_params.get('dataset_format', 'pickle')
+    assert fmt in dataset_formats, 'dataset_format must be one of {}, not "{}"'.format(', '.join(dataset_formats), fmt)
+    return fmt
+
+def get_dataset_name(filename):
+    '''
+    Returns the dataset's filename (or npy folder) without its ".dump.gz"
+    (or ".dataset") extension.
+    '''
+    filename = filename.rstrip(os.sep)
+    for ext in ['.dump.gz', '.dataset']:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+def is_dataset_filename(filename):
+
+    return filename.rstrip(os.sep).endswith(('.dump.gz', '.dataset'))
+
+def get_npy_dataset_path(filename):
+
+    return get_dataset_name(filename) + '.dataset'
+
+def get_dataset_path(filename, fmt = 'pickle'):
+    '''
+    Returns where the dataset with the given ".dump.gz" filename is stored
+    in the given format.
+    '''
+    assert fmt in dataset_formats, 'Dataset format must be one of {}, not "{}"'.format(', '.join(dataset_formats), fmt)
+    if fmt == 'pickle':
+        return filename
+    return get_npy_dataset_path(filename)
+
+def find_dataset(filename):
+    '''
+    Returns where the dataset with the given ".dump.gz" filename is stored:
+    its npy folder if there is one, and otherwise the filename itself.
+    The npy folder itself may also be given.
+    '''
+    if os.path.isfile(os.path.join(filename, 'header.json')):
+        return filename
+    npy_path = get_npy_dataset_path(filename)
+    if os.path.isfile(os.path.join(npy_path, 'header.json')):
+        return npy_path
+    return filename
+
+def dataset_exists(filename):
+
+    return os.path.exists(find_dataset(filename))
+
+def remove_dataset_path(path):
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    return None
+
+def write_matrix(path, matrix, compress, header):
+
+    header['shape'] = list(matrix.shape)
+    header['dtype'] = matrix.dtype.str
+    if compress:
+        block_rows = max(1, compressed_block_size / max(1, int(np.prod(matrix.shape[1:]))))
+        blocks = {'block_{:06d}'.format(i): matrix[start:(start + block_rows)] for i, start in enumerate(range(0, len(matrix), block_rows))}
+        np.savez_compressed(os.path.join(path, 'matrix.npz'), **blocks)
+        header['block_rows'] = block_rows
+    else:
+        np.save(os.path.join(path, 'matrix.npy'), matrix, allow_pickle = False)
+
+    return None
+
+def read_matrix(path, header, mmap):
+
+    shape = tuple(header['shape'])
+    dtype = np.dtype(str(header['dtype']))
+    if header['compressed']:
+        blocks = np.load(os.path.join(path, 'matrix.npz'), allow_pickle = False)
+        if len(blocks.files) == 0:
+            matrix = np.zeros(shape, dtype = dtype)
+        else:
+            matrix = np.concatenate([blocks[x] for x in sorted(blocks.files)])
+        blocks.close()
+    elif mmap and np.prod(shape) > 0:
+        # Copy-on-write, so changes made to the matrix stay in memory and
+        # are never written back to the file
+        matrix = np.load(os.path.join(path, 'matrix.npy'), mmap_mode = 'c', allow_pickle = False).view(np.ndarray)
+    else:
+        # (Zero-size arrays cannot be memory-mapped)
+        matrix = np.load(os.path.join(path, 'matrix.npy'), allow_pickle = False)
+    assert matrix.shape == shape, 'Matrix of dataset {} has shape {}, not {} as in its header'.format(path, matrix.shape, shape)
+
+    return matrix
+
+def write_npy_dataset(dataset, path, compress):
+
+    labels = dataset[:-1]
+    matrix = dataset[-1]
+    header = {'version': npy_format_version,
+            'labels': [],
+            'compressed': compress
+            }
+
+    # Write to a temporary folder and then move it into place, so a partly
+    # written dataset is never found
+    folder = os.path.dirname(os.path.abspath(path))
+    tmp_path = tempfile.mkdtemp(dir = folder, prefix = '.tmp_' + os.path.basename(path))
+    try:
+        for i, x in enumerate(labels):
+            label_array = np.asarray(x)
+            header['labels'].append({'type': 'list' if isinstance(x, list) else 'array', 'dtype': label_array.dtype.str})
+            # Labels are stored without pickling, so object arrays (of
+            # strings) are stored as string arrays
+            if label_array.dtype == np.object:
+                label_array = label_array.astype(str)
+            np.save(os.path.join(tmp_path, 'labels_{}.npy'.format(i)), label_array, allow_pickle = False)
+        if is_low_rank_stack(matrix):
+            # The base matrix is stored like any other matrix
+            arrays = matrix.get_arrays()
+            header['stack'] = {'kind': matrix.kind, 'arrays': sorted(x for x in arrays if x != 'base')}
+            for name in header['stack']['arrays']:
+                np.save(os.path.join(tmp_path, 'stack_{}.npy'.format(name)), arrays[name], allow_pickle = False)
+            if 'base' in arrays:
+                write_matrix(tmp_path, np.asarray(arrays['base']), compress, header)
+        else:
+            write_matrix(tmp_path, np.asarray(matrix), compress, header)
+        with open(os.path.join(tmp_path, 'header.json'), 'wt') as f:
+            json.dump(header, f, indent = 1, sort_keys = True)
+        os.chmod(tmp_path, 0755)
+        remove_dataset_path(path)
+        os.rename(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        raise
+
+    return None
+
+def read_npy_dataset(path, mmap):
+
+    with open(os.path.join(path, 'header.json'), 'rt') as f:
+        header = json.load(f)
+    assert header['version'] <= npy_format_version, 'Dataset {} was written by a newer version of BEAN-counter (format version {})'.format(path, header['version'])
+
+    dataset = []
+    for i, label_info in enumerate(header['labels']):
+        label_array = np.load(os.path.join(path, 'labels_{}.npy'.format(i)), allow_pickle = False)
+        if np.dtype(str(label_info['dtype'])) == np.object:
+            label_array = label_array.astype(np.object)
+        if label_info['type'] == 'list':
+            dataset.append(label_array.tolist())
+        else:
+            dataset.append(label_array)
+
+    if 'stack' in header:
+        arrays = {x: np.load(os.path.join(path, 'stack_{}.npy'.format(x)), allow_pickle = False) for x in header['stack']['arrays']}
+        if 'shape' in header:
+            arrays['base'] = read_matrix(path, header, mmap)
+        dataset.append(from_arrays(header['stack']['kind'], arrays))
+    else:
+        dataset.append(read_matrix(path, header, mmap))
+
+    return dataset
+
+def load_dataset(filename, mmap = True):
+    '''
+    Loads the dataset with the given ".dump.gz" filename, from whichever
+    format it is stored in. Uncompressed npy matrices are memory-mapped
+    unless "mmap" is False.
+    '''
+    path = find_dataset(filename)
+    if os.path.isdir(path):
+        return read_npy_dataset(path, mmap)
+
+    f = gzip.open(filename, 'rb')
+    dataset = cPickle.load(f)
+    f.close()
+    return dataset
+
+def dump_dataset(dataset, filename, fmt = 'pickle'):
+    '''
+    Writes the dataset under the given ".dump.gz" filename, in the given
+    format, replacing any copy of it stored in another format.
+    '''
+    path = get_dataset_path(filename, fmt)
+    if fmt == 'pickle':
+        if is_low_rank_stack(dataset[-1]):
+            dataset = list(dataset[:-1]) + [np.asarray(dataset[-1])]
+        f = gzip.open(filename, 'wb')
+        cPickle.dump(dataset, f)
+        f.close()
+    else:
+        write_npy_dataset(dataset, path, compress = (fmt == 'npy_compressed'))
+
+    # Remove the copy in the other format, which would otherwise be out of
+    # date (and an npy folder would be loaded in place of a new pickle)
+    if fmt == 'pickle':
+        remove_dataset_path(get_npy_dataset_path(filename))
+    elif os.path.isfile(filename):
+        os.remove(filename)
+
+    return None
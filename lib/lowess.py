@@ -37,12 +37,33 @@ import os, gzip, cPickle
 from scipy.linalg import solve, LinAlgError
 from multiprocessing.pool import Pool
 from contextlib import closing
+from numpy.lib.stride_tricks import as_strided
+from shared_arrays import SharedArray, get_worker_pool
 
-def py_lowess(x, y, f=2. / 3., iter=3, num_cores = 2, dup_x_speedup = False):
+lowess_methods = ['vectorized', 'reference']
+
+# Vectorized fits are split between num_cores worker processes if the spans
+# of the fitted points add up to at least this many elements
+min_parallel_window_size = 2**22
+
+def py_lowess(x, y, f=2. / 3., iter=3, num_cores = 2, dup_x_speedup = False, method = 'vectorized', interp_delta = 0):
     '''
     Performs a local scatterplot smoothing on y given x (LOWESS).
     Results line up with MATLAB's 'smooth' function.
+
+    With method = 'vectorized', the spans and local fits for all points are
+    computed at once with numpy (see calc_spans, span_inds and
+    calc_yest_vectorized). Large fits are split between num_cores processes
+    of the shared worker pool (see calc_yest_shared). method = 'reference'
+    computes them one point at a time with calc_span, span_inds_reference
+    and calc_yest.
+
+    If interp_delta > 0, the local fits are only computed at points more
+    than interp_delta apart along x (as with the "delta" argument of
+    Cleveland's lowess), and the y estimates in between are linearly
+    interpolated. See get_delta_fit_inds.
     '''
+    assert method in lowess_methods, 'LOWESS method must be one of {}, not "{}".'.format(lowess_methods, method)
 
     # Sets globals to enable efficient threading
     global x_
@@ -90,7 +111,9 @@ def py_lowess(x, y, f=2. / 3., iter=3, num_cores = 2, dup_x_speedup = False):
         inds = range(n)
 
     # Calculate each x value's span (distance on the x axis from x)
-    if num_cores > 1:
+    if method != 'reference':
+        h = calc_spans(x, r, inds)
+    elif num_cores > 1:
         with closing(Pool(processes = num_cores)) as pool:
             h = np.array(pool.map(calc_span, inds))
             pool.terminate()
@@ -103,40 +126,68 @@ def py_lowess(x, y, f=2. / 3., iter=3, num_cores = 2, dup_x_speedup = False):
         h = expanded_h
 
     # Calculate the start and end span indices for each x value
-    starts, stops = span_inds(x, h, r)
+    if method == 'reference':
+        starts, stops = span_inds_reference(x, h, r)
+    else:
+        starts, stops = span_inds(x, h, r)
+
+    # The points at which the local fits are computed
+    if interp_delta > 0:
+        fit_inds = get_delta_fit_inds(x, interp_delta)
+    else:
+        fit_inds = inds
+
+    # For large fits, the inputs are put in shared memory once, for all of
+    # the iterations
+    shared = None
+    if method == 'vectorized' and num_cores > 1:
+        if np.sum(stops[fit_inds] - starts[fit_inds] + 1) >= min_parallel_window_size:
+            shared = share_fit_inputs(x, y, h, starts, stops, fit_inds)
 
     # Calculate the y estimates, iterate the specified number of times
     delta = np.ones(n)
-    for iteration in range(iter):
-        #print 'iteration:', iteration
-        if num_cores > 1:
-            with closing(Pool(processes=num_cores)) as pool:
-                yest = np.array(pool.map(calc_yest, inds))
-                pool.terminate()
-        else:
-            yest = np.array(map(calc_yest, inds))
-
-        # If accounting for duplicate x values, expand yest back
-        if dup_x_speedup:
-            expanded_yest = yest[reverse_inds]
-            yest = expanded_yest
-
-        residuals = y - yest
-        s = np.median(np.abs(residuals))
-        # This is a hack to ensure that s is not zero. If the residuals are so
-        # tight that the median absolute residual is zero, then the mean should
-        # also be a very small number (possibly except in cases with insanely
-        # deviant outliers).  This issue only occurs with very low complexity
-        # vectors and is, again, a rare corner case.
-        if s == 0.0:
-            s = np.mean(np.abs(residuals))
-        # If the mean absolute residual is also zero, then all of the resulting
-        # delta values before biweight transformation should also be zero.
-        if s == 0.0:
-            delta = np.zeros_like(residuals, dtype = np.float)
-        else:
-            delta = np.clip(residuals / (6.0 * s), -1, 1)
-        delta = (1 - delta ** 2) ** 2
+    try:
+        for iteration in range(iter):
+            #print 'iteration:', iteration
+            if shared is not None:
+                yest = calc_yest_shared(shared, delta, num_cores)
+            elif method == 'vectorized':
+                yest = calc_yest_vectorized(x, y, h, starts, stops, delta, fit_inds)
+            elif num_cores > 1:
+                with closing(Pool(processes=num_cores)) as pool:
+                    yest = np.array(pool.map(calc_yest, fit_inds))
+                    pool.terminate()
+            else:
+                yest = np.array(map(calc_yest, fit_inds))
+
+            # Interpolate between the fitted points, or if accounting for
+            # duplicate x values, expand yest back
+            if interp_delta > 0:
+                yest = np.interp(x, x[fit_inds], yest)
+            elif dup_x_speedup:
+                expanded_yest = yest[reverse_inds]
+                yest = expanded_yest
+
+            residuals = y - yest
+            s = np.median(np.abs(residuals))
+            # This is a hack to ensure that s is not zero. If the residuals are so
+            # tight that the median absolute residual is zero, then the mean should
+            # also be a very small number (possibly except in cases with insanely
+            # deviant outliers).  This issue only occurs with very low complexity
+            # vectors and is, again, a rare corner case.
+            if s == 0.0:
+                s = np.mean(np.abs(residuals))
+            # If the mean absolute residual is also zero, then all of the resulting
+            # delta values before biweight transformation should also be zero.
+            if s == 0.0:
+                delta = np.zeros_like(residuals, dtype = np.float)
+            else:
+                delta = np.clip(residuals / (6.0 * s), -1, 1)
+            delta = (1 - delta ** 2) ** 2
+    finally:
+        if shared is not None:
+            for shared_array in shared:
+                shared_array.close()
     return yest[unsort_inds]
 
 def cube(x):
@@ -152,6 +203,70 @@ def span_inds(x, h, r):
     given the span in units of distance on the x axis (h). r
     supplies the default width of the span in indices (before
     adjustment for ties, etc.).
+
+    Gives the same results as span_inds_reference, without looping over
+    the points in python. That loop moves its start (stop) index forward
+    to the first point that is closer to (at least h away from) the current
+    point. Since x is sorted, those are found with binary searches, and the
+    loop's indices are the running maxima of them.
+    '''
+    assert np.all(np.diff(x) >= 0), "Argument x must be sorted in ascending order!"
+    assert np.all(h > 0), "Spans must be greater than zero!"
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype = 'int'), np.zeros(0, dtype = 'int')
+
+    # First index at or before each point that is closer than h (the
+    # comparisons are the same as in span_inds_reference, so that rounding
+    # does not change the results)
+    is_close = lambda i, j: np.abs(x[i] - x[j]) < h[i]
+    points = np.arange(n)
+    first_close = find_first(is_close, x, np.searchsorted(x, x - h, side = 'right'), 0, points)
+    starts_ = np.maximum.accumulate(first_close)
+
+    # First index after each point that is not closer than h, if any
+    is_far = lambda i, j: np.abs(x[i] - x[j]) >= h[i]
+    first_far = find_first(is_far, x, np.searchsorted(x, x + h, side = 'left'), points, n)
+    stops_ = np.maximum.accumulate(np.maximum(first_far, r)) - 1
+    return starts_, stops_
+
+def find_first(cond, x, guess, lower, upper):
+    '''
+    For each point i, finds the first index j between lower[i] and upper[i]
+    (where upper may be one past the last index) at which cond(i, j) is
+    True, given that cond is False before that index and True after it,
+    and the same for all points with the same x value. Starts from a guess
+    (from a binary search on x), which can be a little off due to rounding,
+    and steps from there over whole runs of tied x values.
+    '''
+    n = len(x)
+    # The first index of each run of tied values, and the index past its end
+    new_value = np.concatenate([[True], x[1:] != x[:-1]])
+    run_starts = np.maximum.accumulate(np.where(new_value, np.arange(n), 0))
+    run_ends = np.concatenate([np.flatnonzero(new_value)[1:], [n]])[np.cumsum(new_value) - 1]
+
+    points = np.arange(n)
+    lower = np.zeros(n, dtype = np.int) + lower
+    upper = np.zeros(n, dtype = np.int) + upper
+    j = np.clip(guess, lower, upper)
+    while True:
+        # Step back while the previous index also satisfies cond
+        back = j > lower
+        back[back] = cond(points[back], j[back] - 1)
+        j[back] = np.maximum(run_starts[j[back] - 1], lower[back])
+        # Step forward while this one does not
+        forward = (j < upper) & ~back
+        forward[forward] = ~cond(points[forward], j[forward])
+        j[forward] = np.minimum(run_ends[j[forward]], upper[forward])
+        if not np.any(back) and not np.any(forward):
+            return j
+
+def span_inds_reference(x, h, r):
+    '''
+    Calculates span indices for each value in sorted 1D array x,
+    given the span in units of distance on the x axis (h). r
+    supplies the default width of the span in indices (before
+    adjustment for ties, etc.).
     '''
     assert np.all(np.diff(x) >= 0), "Argument x must be sorted in ascending order!"
     n = len(x)
@@ -184,7 +299,14 @@ def calc_yest(i):
     global y_
     global h
     global delta
-   
+
+    return local_fit(x_, y_, h[i], delta, starts[i], stops[i], i)
+
+def local_fit(x, y, h_i, delta, start, stop, i):
+    '''
+    Computes the y estimate for point i from the points in its span
+    (indices "start" through "stop" of the sorted x and y).
+    '''
     # If this has already converged, as evidenced by all delta values
     # in the span being zero, then just return the previous y estimate.
     # NOTE: this completely depends on calculating the span such that
@@ -192,16 +314,16 @@ def calc_yest(i):
     # that all values in w are nonzero and that the only thing that can
     # cause all weights to be zero is if all delta values within the
     # span are zero.
-    delta_span = delta[starts[i]:(stops[i] + 1)]
-    x_span = x_[starts[i]:(stops[i] + 1)]
-    y_span = y_[starts[i]:(stops[i] + 1)]
+    delta_span = delta[start:(stop + 1)]
+    x_span = x[start:(stop + 1)]
+    y_span = y[start:(stop + 1)]
 
     # If all values in delta_span are zero, we have converged. Return the
     # current y value to avoid unnecessary calculations.
     if np.allclose(delta_span, 0):
-        return y_[i]
+        return y[i]
     
-    w = np.clip(np.abs((x_span - x_[i]) / h[i]), 0.0, 1.0)
+    w = np.clip(np.abs((x_span - x[i]) / h_i), 0.0, 1.0)
     w = cube(1 - cube(w))
     weights = delta_span * w
     b = np.array([np.sum(weights * y_span), np.sum(weights * y_span * x_span)])
@@ -222,6 +344,316 @@ def calc_yest(i):
     try:
         beta = solve(A, b)
     except LinAlgError as e:
-        return y_[i]
-    yest_i = beta[0] + beta[1] * x_[i]
+        return y[i]
+    yest_i = beta[0] + beta[1] * x[i]
     return yest_i
+
+def py_lowess_multi(x, Y, f=2. / 3., iter=3, interp_delta = 0):
+    '''
+    Performs LOWESS on each column of the 2-D array Y, given the same x for
+    all of them. Gives the same results as running py_lowess on each column
+    (up to floating-point rounding), but the sorting, spans and tricube
+    weights only depend on x and are computed once for all of the columns.
+    '''
+    x = np.asarray(x, dtype = np.float).ravel()
+    Y = np.asarray(Y, dtype = np.float)
+    assert Y.ndim == 2 and Y.shape[0] == len(x), 'Y must be a 2-D array with one row per x value.'
+    n, m = Y.shape
+    if n == 0 or m == 0:
+        return np.zeros(Y.shape)
+
+    sort_inds = x.argsort()
+    unsort_inds = sort_inds.argsort()
+    x = x[sort_inds]
+    Y = Y[sort_inds]
+
+    r = int(np.ceil(f * n))
+    h = calc_spans(x, r)
+    starts_, stops_ = span_inds(x, h, r)
+
+    if interp_delta > 0:
+        fit_inds = get_delta_fit_inds(x, interp_delta)
+    else:
+        fit_inds = np.arange(n)
+
+    delta_ = np.ones(Y.shape)
+    Yest = np.zeros(Y.shape)
+    for iteration in range(iter):
+        for i in fit_inds:
+            start, stop = starts_[i], stops_[i] + 1
+            delta_span = delta_[start:stop]
+            x_span = x[start:stop]
+            w = np.clip(np.abs((x_span - x[i]) / h[i]), 0.0, 1.0)
+            w = cube(1 - cube(w))
+            wx = np.vstack([w, w * x_span, w * x_span * x_span])
+
+            # Columns that have converged keep their current y value
+            converged = np.all(np.abs(delta_span) <= 1e-8, axis = 0)
+
+            # Weighted sums for every column at once: the rows of "sums" are
+            # sum(weights), sum(weights * x) and sum(weights * x * x), and
+            # those of "b" are sum(weights * y) and sum(weights * y * x)
+            sums = wx.dot(delta_span)
+            b = wx[0:2].dot(delta_span * Y[start:stop])
+
+            Yest[i], unstable = solve_local_fits(sums, b, x[i], Y[i], converged)
+            for j in np.flatnonzero(unstable):
+                Yest[i, j] = local_fit(x, np.ascontiguousarray(Y[:, j]), h[i], np.ascontiguousarray(delta_[:, j]), starts_[i], stops_[i], i)
+        if interp_delta > 0:
+            Yest = interp_rows(x, fit_inds, Yest[fit_inds])
+
+        # Robustness weights, computed separately for each column as in
+        # py_lowess
+        residuals = Y - Yest
+        s = np.median(np.abs(residuals), axis = 0)
+        s = np.where(s == 0.0, np.mean(np.abs(residuals), axis = 0), s)
+        zero_s = s == 0.0
+        delta_ = np.clip(residuals / (6.0 * np.where(zero_s, 1.0, s)), -1, 1)
+        delta_[:, zero_s] = 0.0
+        delta_ = (1 - delta_ ** 2) ** 2
+
+    return Yest[unsort_inds]
+
+def py_lowess_grouped(x, y, f=2. / 3., num_cores = 1, interp_delta = 0):
+    '''
+    Same as py_lowess(x, y, f, iter = 1, dup_x_speedup = True), for data
+    where many points share the same x value. Without robustness iterations,
+    all points with the same x value get the same weight in every local fit,
+    so they are combined into one point, weighted by their number, with
+    their mean y value. The spans are still found among all of the points,
+    but the local fits only sum over the distinct x values, so the cost
+    scales with the number of distinct x values rather than points.
+    '''
+    x = np.asarray(x, dtype = np.float).ravel()
+    y = np.asarray(y, dtype = np.float).ravel()
+    assert len(x) == len(y), 'x and y must have the same length.'
+    n = len(x)
+    if n == 0:
+        return np.zeros(0)
+
+    sort_inds = x.argsort(kind = 'mergesort')
+    x = x[sort_inds]
+    y = y[sort_inds]
+    r = int(np.ceil(f * n))
+
+    # One weighted point per distinct x value
+    uniq_x, inds, reverse_inds, counts = np.unique(x, return_index = True, return_inverse = True, return_counts = True)
+    counts = counts.astype(np.float)
+    mean_y = np.bincount(reverse_inds, weights = y) / counts
+    h = calc_spans(x, r, inds)
+    assert np.all(h > 0), "Spans must be greater than zero!"
+
+    # Each span covers the distinct x values closer than h (any others
+    # would get a tricube weight of zero)
+    points = np.arange(len(uniq_x))
+    is_close = lambda i, j: np.abs(uniq_x[i] - uniq_x[j]) < h[i]
+    starts_ = find_first(is_close, uniq_x, np.searchsorted(uniq_x, uniq_x - h, side = 'right'), 0, points)
+    is_far = lambda i, j: np.abs(uniq_x[i] - uniq_x[j]) >= h[i]
+    stops_ = find_first(is_far, uniq_x, np.searchsorted(uniq_x, uniq_x + h, side = 'left'), points, len(uniq_x)) - 1
+
+    if interp_delta > 0:
+        fit_inds = get_delta_fit_inds(uniq_x, interp_delta)
+    else:
+        fit_inds = points
+
+    # The counts take the place of the robustness weights, so that
+    # sum(weights * mean_y) is the sum over all of the points
+    if num_cores > 1 and np.sum(stops_[fit_inds] - starts_[fit_inds] + 1) >= min_parallel_window_size:
+        shared = share_fit_inputs(uniq_x, mean_y, h, starts_, stops_, fit_inds)
+        try:
+            yest = calc_yest_shared(shared, counts, num_cores)
+        finally:
+            for shared_array in shared:
+                shared_array.close()
+    else:
+        yest = calc_yest_vectorized(uniq_x, mean_y, h, starts_, stops_, counts, fit_inds)
+    if interp_delta > 0:
+        yest = np.interp(uniq_x, uniq_x[fit_inds], yest)
+
+    result = np.zeros(n)
+    result[sort_inds] = yest[reverse_inds]
+    return result
+
+def get_delta_fit_inds(x, interp_delta):
+    '''
+    Chooses the points of the sorted array x at which the local fits are
+    computed when interpolating, following Cleveland's lowess: starting
+    from the first point, the next point fitted is the last one within
+    interp_delta of the previous one along x (or the next distinct x value,
+    if there is none). The last point is always fitted. Of several points
+    with the same x value, the first is used.
+    '''
+    fit_inds = [0]
+    last = 0
+    while x[last] < x[-1]:
+        next_ind = np.searchsorted(x, x[last] + interp_delta, side = 'right') - 1
+        next_ind = np.searchsorted(x, x[next_ind], side = 'left')
+        if next_ind <= last:
+            next_ind = np.searchsorted(x, x[last], side = 'right')
+        fit_inds.append(next_ind)
+        last = next_ind
+    return np.array(fit_inds, dtype = np.int)
+
+def interp_rows(x, fit_inds, fit_values):
+    '''
+    Linearly interpolates each column of fit_values (the values at
+    x[fit_inds], in increasing order) at all of the points in x. The same
+    as calling np.interp on each column.
+    '''
+    x_fit = x[fit_inds]
+    if len(x_fit) == 1:
+        return np.repeat(fit_values, len(x), axis = 0)
+    left = np.clip(np.searchsorted(x_fit, x, side = 'right') - 1, 0, len(x_fit) - 2)
+    t = (x - x_fit[left]) / (x_fit[left + 1] - x_fit[left])
+    t = np.clip(t, 0.0, 1.0)[:, None]
+    return fit_values[left] * (1 - t) + fit_values[left + 1] * t
+
+def delta_accuracy_report(approx, exact):
+    '''
+    Summarizes how far a fit computed with interp_delta is from the exact
+    fit (or anything computed from them, such as normalized profiles).
+    '''
+    errors = np.abs(np.asarray(approx, dtype = np.float) - np.asarray(exact, dtype = np.float))
+    scale = np.nanmax(np.abs(exact))
+    return {'max_abs_error': np.nanmax(errors),
+            'mean_abs_error': np.nanmean(errors),
+            'max_rel_error': np.nanmax(errors) / scale if scale > 0 else 0.0}
+
+def calc_spans(x, r, inds = None):
+    '''
+    For each value in the sorted array x (or those at "inds"), calculates
+    the distance to its r-th nearest neighbour. Same as calc_span, but
+    since x is sorted, the r nearest neighbours of each point (and the point
+    itself) are a window of r + 1 consecutive points. If the window reaches
+    a points to the left, the span is the larger of the distances to its
+    first and last points. The first grows and the second shrinks with a,
+    so the smallest span is found for all points at once by bisecting on a.
+    '''
+    n = len(x)
+    if inds is None:
+        inds = np.arange(n)
+    inds = np.asarray(inds, dtype = np.int)
+    assert r < n, 'Span of {} points is too large for {} points.'.format(r, n)
+
+    dist = lambda a: np.abs(x[inds - a] - x[inds])
+    dist_right = lambda a: np.abs(x[inds + r - a] - x[inds])
+
+    # Search for the smallest a with dist(a) >= dist_right(a), among the
+    # windows that fit within x
+    a_lo = np.maximum(0, inds + r - (n - 1))
+    a_hi = np.minimum(r, inds)
+    lo = a_lo.copy()
+    hi = a_hi + 1
+    while np.any(lo < hi):
+        mid = (lo + hi) / 2
+        searching = lo < hi
+        past = searching & (dist(mid) >= dist_right(mid))
+        lo = np.where(searching & ~past, mid + 1, lo)
+        hi = np.where(past, mid, hi)
+
+    # The best window is either that one or the one before it
+    a = np.minimum(lo, a_hi)
+    h = np.maximum(dist(a), dist_right(a))
+    before = np.maximum(lo - 1, a_lo)
+    h = np.minimum(h, np.maximum(dist(before), dist_right(before)))
+    return h
+
+def calc_yest_vectorized(x, y, h, starts, stops, delta, inds, max_window_size = 2**16):
+    '''
+    Same as calc_yest for each index in "inds", but with all of the local
+    fits computed together. The span of each point is laid out as a row of
+    a padded window array. Points are processed in chunks of at most
+    "max_window_size" window elements, small enough for the chunks to stay
+    in the CPU cache (larger chunks are slower, not faster).
+
+    The windows are as wide as the widest span. This does not change the
+    fits, since the tricube weight of any point outside of a span is
+    exactly zero (see span_inds), as is the robustness weight of the
+    padding past the end of x.
+    '''
+    inds = np.asarray(inds, dtype = np.int)
+    yest = np.zeros(len(inds))
+    if len(inds) == 0:
+        return yest
+    max_width = (stops[inds] - starts[inds] + 1).max()
+
+    # A span has converged if all of its robustness weights are (close to)
+    # zero, which can be counted exactly with a cumulative sum
+    n_unconverged = np.concatenate([[0], np.cumsum(np.abs(delta) > 1e-8)])
+    converged_inds = n_unconverged[stops[inds] + 1] == n_unconverged[starts[inds]]
+
+    # Row i of these views holds the max_width values starting at index i,
+    # so each span can be copied out as one contiguous block
+    windows = []
+    for values in [x, y, delta]:
+        padded = np.concatenate([values, np.zeros(max_width)]).astype(np.float)
+        windows.append(as_strided(padded, shape = (len(values), max_width), strides = (padded.itemsize, padded.itemsize)))
+    x_windows, y_windows, delta_windows = windows
+
+    chunk_size = max(1, max_window_size / max_width)
+    for chunk_start in range(0, len(inds), chunk_size):
+        chunk = inds[chunk_start:(chunk_start + chunk_size)]
+        converged = converged_inds[chunk_start:(chunk_start + chunk_size)]
+        x_i = x[chunk]
+
+        x_span = x_windows[starts[chunk]]
+        y_span = y_windows[starts[chunk]]
+        delta_span = delta_windows[starts[chunk]]
+
+        # Same as clipping to [0, 1], as in calc_yest
+        w = np.minimum(np.abs((x_span - x_i[:, None]) / h[chunk][:, None]), 1.0)
+        weights = delta_span * cube(1 - cube(w))
+        wx = weights * x_span
+        sums = np.vstack([weights.sum(axis = 1), wx.sum(axis = 1), np.einsum('ij,ij->i', wx, x_span)])
+        b = np.vstack([np.einsum('ij,ij->i', weights, y_span), np.einsum('ij,ij->i', wx, y_span)])
+
+        chunk_yest, unstable = solve_local_fits(sums, b, x_i, y[chunk], converged)
+        for j in np.flatnonzero(unstable):
+            i = chunk[j]
+            chunk_yest[j] = local_fit(x, y, h[i], delta, starts[i], stops[i], i)
+        yest[chunk_start:(chunk_start + chunk_size)] = chunk_yest
+
+    return yest
+
+def share_fit_inputs(x, y, h, starts, stops, fit_inds):
+    '''
+    Puts the inputs of calc_yest_vectorized in shared memory, along with
+    arrays for the robustness weights and the y estimates.
+    '''
+    inputs = [SharedArray(data = a) for a in [x, y, h, starts, stops, np.asarray(fit_inds, dtype = np.int)]]
+    return inputs + [SharedArray(len(x)), SharedArray(len(fit_inds))]
+
+def calc_yest_shared(shared, delta, num_cores):
+    '''
+    Same as calc_yest_vectorized, with the points split between the worker
+    pool. Each worker writes its estimates straight into the shared array.
+    '''
+    shared_delta, shared_yest = shared[6:8]
+    shared_delta.array[:] = delta
+    parts = np.array_split(np.arange(len(shared_yest.array)), 4 * num_cores)
+    get_worker_pool(num_cores).map(fit_shared_points, [[shared, x[0], x[-1] + 1] for x in parts if len(x) > 0])
+    return shared_yest.array.copy()
+
+def fit_shared_points(args):
+
+    shared, start, stop = args
+    x, y, h, starts, stops, fit_inds, delta, yest = [a.array for a in shared]
+    yest[start:stop] = calc_yest_vectorized(x, y, h, starts, stops, delta, fit_inds[start:stop])
+
+def solve_local_fits(sums, b, x_i, y_i, converged):
+    '''
+    Solves the weighted least squares fits [[sums[0], sums[1]], [sums[1],
+    sums[2]]] * beta = b in closed form, for every column, and returns the
+    fitted values beta[0] + beta[1] * x_i (or y_i for converged fits).
+
+    Also returns which fits are (nearly) singular. The closed form is not
+    accurate for those, so the caller refits them with local_fit, which
+    handles them exactly as calc_yest does.
+    '''
+    det = sums[0] * sums[2] - sums[1] * sums[1]
+    unstable = ~converged & (np.abs(det) <= 1e-10 * np.abs(sums[0] * sums[2]))
+    safe_det = np.where(converged | unstable, 1.0, det)
+    beta_0 = (sums[2] * b[0] - sums[1] * b[1]) / safe_det
+    beta_1 = (sums[0] * b[1] - sums[1] * b[0]) / safe_det
+    yest = np.where(converged, y_i, beta_0 + beta_1 * x_i)
+    return yest, unstable
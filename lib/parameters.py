@@ -373,6 +373,88 @@ num_cores = Param(
                 'Note that "all" may not have much or any speed boost over 0.5.',
         options = '_any_')
 
+fastq_chunk_size = Param(
+        name = 'fastq_chunk_size',
+        value = 256,
+        type = int,
+        help = 'Size, in megabytes, above which uncompressed fastq files are split ' \
+                'into record-aligned chunks that are parsed in parallel. Compressed ' \
+                'files and paired-end files are parsed in parallel one file (or file ' \
+                'pair) at a time. Parsing uses up to "num_cores" processes.',
+        options = None)
+
+parse_block_size = Param(
+        name = 'parse_block_size',
+        value = 500000,
+        type = int,
+        help = 'Number of reads that are read in and parsed together. Each unique ' \
+                'combination of common primer, index tag and barcode sequences in ' \
+                'a block is only matched once, so larger blocks are faster but ' \
+                'use more memory.',
+        options = None)
+
+preview_reads = Param(
+        name = 'preview_reads',
+        value = 0,
+        type = int,
+        help = 'If greater than 0, raw_fastq_to_count_matrix.py only parses this ' \
+                'many reads from the start of each fastq file, as a quick check ' \
+                'that a lane is parsing. Reports (and totals extrapolated to the ' \
+                'full lane) are written to "reports/preview", and no count matrix ' \
+                'is written, so this must be unset to process the screen.',
+        options = None)
+
+preview_fraction = Param(
+        name = 'preview_fraction',
+        value = 1.0,
+        type = float,
+        help = 'If less than 1, raw_fastq_to_count_matrix.py only parses this ' \
+                'randomly-selected fraction of the reads, producing a preview in ' \
+                'the same way as "preview_reads". Both can be combined.',
+        options = None)
+
+sparse_count_array = Param(
+        name = 'sparse_count_array',
+        value = False,
+        type = bool,
+        help = 'If True, the raw count array of index tag/barcode combinations ' \
+                'only stores the combinations that were observed. This is ' \
+                'always done when the full array would be too large to fit in ' \
+                'memory, as with barcodes on both reads of large pools.',
+        options = [False, True])
+
+correction_cache_folder = Param(
+        name = 'correction_cache_folder',
+        value = None,
+        type = str,
+        help = 'Folder holding the corrections made to observed index tag and ' \
+                'barcode sequences in previous parsing runs, which are reused ' \
+                'instead of matching those sequences again. It can be shared ' \
+                'between screens and by lanes parsed at the same time. Defaults ' \
+                'to "intermediate/correction_cache" in the output folder.',
+        options = '_any_')
+
+correction_cache_size = Param(
+        name = 'correction_cache_size',
+        value = 1000000,
+        type = int,
+        help = 'Maximum number of observed sequences kept in the correction cache ' \
+                'for each set of reference sequences. The least recently used ' \
+                'sequences are dropped first. Set to 0 to disable the cache.',
+        options = None)
+
+dataset_format = Param(
+        name = 'dataset_format',
+        value = 'pickle',
+        type = str,
+        help = 'Format in which datasets (count and z-score matrices) are written. ' \
+                '"pickle" writes gzipped pickles ("*.dump.gz"), which are read in full ' \
+                'on loading. "npy" writes a "*.dataset" folder with the matrix in an ' \
+                'uncompressed .npy file, which is memory-mapped on loading so only ' \
+                'the parts that are used are read. "npy_compressed" compresses the ' \
+                'matrix in blocks of rows. Datasets in any format can be read.',
+        options = ['pickle', 'npy', 'npy_compressed'])
+
 remove_barcode_specific_conditions = Param(
         name = 'remove_barcode_specific_conditions',
         value = True,
@@ -453,6 +535,37 @@ sample_detection_limit = Param(
                 'to control conditions when their normalized profiles are being computed.',
         options = None)
 
+lowess_method = Param(
+        name = 'lowess_method',
+        value = 'vectorized',
+        type = str,
+        help = 'Implementation of the LOWESS fits used to normalize profiles and ' \
+                'to estimate the variance of the control profiles. "vectorized" ' \
+                'computes the fits for many points (and profiles) at once, and ' \
+                '"reference" fits one point of one profile at a time. Both give ' \
+                'the same results, up to floating-point rounding.',
+        options = ['vectorized', 'reference'])
+
+normalization_lowess_delta = Param(
+        name = 'normalization_lowess_delta',
+        value = 0.0,
+        type = float,
+        help = 'If greater than 0, the LOWESS fits that normalize each profile ' \
+                'against the mean control profile are only computed at strains ' \
+                'this far apart along the mean control profile (as a fraction of ' \
+                'its range), and linearly interpolated in between. Values around ' \
+                '0.01 are much faster and usually very close to the exact fit. With ' \
+                'a verbosity of 2 or more, the difference from the exact fit is reported.',
+        options = None)
+
+sigma_lowess_delta = Param(
+        name = 'sigma_lowess_delta',
+        value = 0.0,
+        type = float,
+        help = 'Same as "normalization_lowess_delta", for the LOWESS fits of the ' \
+                'variance of the control profiles.',
+        options = None)
+
 strain_pass_read_count = Param(
         name = 'strain_pass_read_count',
         value = 20,
@@ -0,0 +1,101 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Dependency manifests that let process_screen.py skip steps whose outputs
+# are already up to date, make-style. A manifest records everything a step's
+# outputs depend on: the size and modification time of (potentially large)
+# input files, content hashes of small tables, the relevant config values,
+# the software version and anything else the caller adds (e.g. a hash of a
+# lane's rows in the sample table). It is written next to the step's outputs
+# after the step succeeds. A step is up to date if its outputs exist and the
+# manifest it would write now is identical to the stored one.
+
+import os, json, hashlib
+
+def get_file_signature(filename):
+    '''
+    Returns [size, modification time] of the file, or None if it does not
+    exist.
+    '''
+    if not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+def get_file_hash(filename):
+    '''
+    Returns the SHA-1 digest of the file's contents, or None if it does not
+    exist.
+    '''
+    if not os.path.isfile(filename):
+        return None
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def get_table_hash(tab):
+    '''
+    Returns the SHA-1 digest of the contents of a pandas table (for example,
+    just the rows of the sample table that belong to one lane).
+    '''
+    return hashlib.sha1(tab.to_csv(sep = '\t', index = False)).hexdigest()
+
+def get_manifest(version, input_files = [], hashed_files = [], config_params = {}, config_keys = [], extra = {}):
+    '''
+    Builds the manifest describing the current state of a step's inputs.
+    "input_files" are compared by size and modification time, and
+    "hashed_files" by content.
+    '''
+    manifest = {'version': version,
+            'input_files': {x: get_file_signature(x) for x in input_files},
+            'hashed_files': {x: get_file_hash(x) for x in hashed_files},
+            'config': {x: config_params.get(x) for x in config_keys},
+            'extra': extra
+            }
+
+    # Round-trip through JSON so the manifest compares equal to one read
+    # back from disk
+    return json.loads(json.dumps(manifest, default = str))
+
+def is_up_to_date(manifest_filename, manifest, output_files):
+    '''
+    Returns True if all of the step's outputs exist and the stored manifest
+    matches "manifest".
+    '''
+    if not all(os.path.exists(x) for x in output_files):
+        return False
+    if not os.path.isfile(manifest_filename):
+        return False
+    try:
+        with open(manifest_filename, 'rt') as f:
+            old_manifest = json.load(f)
+    except ValueError:
+        return False
+    return old_manifest == manifest
+
+def write_manifest(manifest_filename, manifest):
+
+    folder = os.path.dirname(manifest_filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp_filename = manifest_filename + '.tmp'
+    with open(tmp_filename, 'wt') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.rename(tmp_filename, manifest_filename)
+
+    return None
+
+def remove_manifest(manifest_filename):
+    '''
+    Removes a stored manifest, so a step that fails partway through is not
+    considered up to date afterwards.
+    '''
+    if os.path.isfile(manifest_filename):
+        os.remove(manifest_filename)
+
+    return None
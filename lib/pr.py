@@ -8,6 +8,9 @@ VERSION='2.6.1'
 
 import numpy as np
 
+# Number of sorted values whose labels are looked up at once
+chunk_size = 2**22
+
 def precision_recall_curve(y_true, probas_pred):
     '''
     Calculates precision-recall pairs for different probability thresholds.
@@ -17,7 +20,9 @@ def precision_recall_curve(y_true, probas_pred):
     of output from 3 GB to < 1 MB for large vectors of y_true/probas_pred).
     
     Returns results in the same format as scikit-learn precision_recall_curve.
-    
+
+    The precisions are computed from the positions of the positives in the
+    sorted values, rather than by stepping through every value.
     '''
 
     # Check if y_true is acceptable
@@ -35,30 +40,40 @@ def precision_recall_curve(y_true, probas_pred):
     # Sorts in descending order, nans go to the end
     sort_inds = np.argsort(-probas_pred)
 
-    total_pos = np.sum(y_true == 1)
-    tp = 0
-    fp = 0
+    # Finds where each positive falls in the sorted order. This is done in
+    # chunks, so the only full-length array besides the inputs is sort_inds
+    pos_inds = []
+    for start in range(0, len(sort_inds), chunk_size):
+        chunk_pos = np.flatnonzero(y_true[sort_inds[start:(start + chunk_size)]] == 1)
+        pos_inds.append(chunk_pos + start)
+    pos_inds = np.concatenate(pos_inds + [np.array([], dtype = np.int)])
+
+    total_pos = len(pos_inds)
     start_prec = np.repeat(np.nan, total_pos + 1)
     end_prec = start_prec.copy()
-    #end_prec = np.repeat(np.nan, total_pos + 1)
     start_prec[0] = 1
     end_prec[0] = 1
     start_thresh = start_prec.copy()
     end_thresh = end_prec.copy()
-    #start_thresh = np.repeat(np.nan, total_pos + 1)
-    #end_thresh = np.repeat(np.nan, total_pos + 1)
     start_thresh[0] = probas_pred.max()
     end_thresh[0] = probas_pred.max()
 
-    for i, idx in enumerate(sort_inds):
-        if y_true[idx]:
-            tp += 1
-            start_prec[tp] = end_prec[tp] = tp * 1.0 / (tp + fp)
-            start_thresh[tp] = end_thresh[tp] = probas_pred[idx]
-        else:
-            fp += 1
-            end_prec[tp] = tp * 1.0 / (tp + fp)
-            end_thresh[tp] = probas_pred[idx]
+    # The precision for each number of true positives (tp) starts at the
+    # tp-th positive, where tp + fp is its position in the sorted order
+    tp = np.arange(1, total_pos + 1)
+    start_prec[1:] = tp * 1.0 / (pos_inds + 1)
+    start_thresh[1:] = probas_pred[sort_inds[pos_inds]]
+
+    # ...and ends just before the next positive (or at the last value). For
+    # tp = 0, there is no end value unless negatives come before the first
+    # positive.
+    end_inds = np.append(pos_inds, len(sort_inds)) - 1
+    has_end = end_inds >= 0
+    has_end[1:] = True
+    tp = np.arange(total_pos + 1)[has_end]
+    end_inds = end_inds[has_end]
+    end_prec[has_end] = tp * 1.0 / (end_inds + 1)
+    end_thresh[has_end] = probas_pred[sort_inds[end_inds]]
 
     dup_inds = start_prec == end_prec
     final_len = (total_pos + 1) * 2 - np.sum(dup_inds)
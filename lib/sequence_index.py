@@ -0,0 +1,312 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Precomputed error-tolerant lookup of index tags and barcodes.
+#
+# Every reference sequence is expanded into all same-length sequences within
+# the allowed number of errors (substitutions, or a deletion plus an
+# insertion, which count as two errors). Each of these variants is encoded as
+# an integer and stored in a sorted array along with the reference it
+# corrects to, so matching an observed sequence is a single binary search
+# instead of an approximate trie traversal. Variants that are equally close
+# to two or more references are stored as "multi_match".
+#
+# Queries that are shorter than the references (truncated reads) are looked
+# up the same way, in tables of the references with bases deleted: a query d
+# bases short is within n errors of a reference if it is within n - d errors
+# of the reference with some d of its bases deleted. These tables are only
+# built once a query of that length is seen.
+
+import numpy as np
+import itertools as it
+
+alphabet = 'ACGTN'
+n_letters = len(alphabet)
+
+# Any character that is not A, C, G or T is treated as an "N"
+digit_table = ''.join(str(alphabet.index(chr(i))) if chr(i) in alphabet else '4' for i in range(256))
+byte_table = np.array([ord(x) - ord('0') for x in digit_table], dtype = np.uint8)
+
+# Longest sequence that can be encoded as a base-5 int64. Longer sequences
+# are stored as fixed-width strings of base-5 digits, which sort the same way.
+max_int_length = 27
+
+MULTI_MATCH = -1
+
+class SequenceIndex:
+
+    def __init__(self, seqs, tol):
+        '''
+        Builds one lookup table per reference sequence length, sorted in
+        descending order by length. "tol" is either a whole number of errors
+        or, if between 0 and 1, a number of errors per base.
+        '''
+        # Don't allow detection of any sequences whose length is equal to or
+        # less than the tolerance, and make sure sequences are at least of
+        # length 2 (a fractional tolerance would let length 0 slip through).
+        seqs = sorted(set(seq for seq in seqs if len(seq) > max(tol, 2)))
+        self.lengths = sorted(set(len(seq) for seq in seqs), key = lambda x: -x)
+        self.tol = tol
+        self.refs = []
+        self.n_mismatches = []
+        self.keys = []
+        self.values = []
+        self.short_tables = {}
+        for l in self.lengths:
+            refs = [seq for seq in seqs if len(seq) == l]
+            n_mismatch = get_n_mismatch(tol, l)
+            keys, values = build_table(refs, n_mismatch)
+            self.refs.append(refs)
+            self.n_mismatches.append(n_mismatch)
+            self.keys.append(keys)
+            self.values.append(values)
+
+    def nbytes(self):
+        tables = zip(self.keys, self.values) + self.short_tables.values()
+        return sum(x.nbytes + y.nbytes for x, y in tables)
+
+    def get_table(self, i, n_deleted):
+        '''
+        Returns the keys and values of the table for queries "n_deleted"
+        bases shorter than the references of the i-th length, building it
+        the first time it is needed.
+        '''
+        if n_deleted == 0:
+            return self.keys[i], self.values[i]
+        if (i, n_deleted) not in self.short_tables:
+            self.short_tables[(i, n_deleted)] = build_table(self.refs[i], self.n_mismatches[i], n_deleted = n_deleted)
+        return self.short_tables[(i, n_deleted)]
+
+    def match(self, seq):
+        '''
+        Returns the reference sequence that the query matches within the
+        number of allowed errors, trying the longest references first.
+
+        Returns "multi_match" if the query sequence matches two reference
+        sequences with the same distance. Returns "no_match" if it goes
+        through everything and no match is found.
+        '''
+        for i, l in enumerate(self.lengths):
+            query = seq[0:l]
+            # Each missing base counts as one error
+            n_deleted = l - len(query)
+            if n_deleted > self.n_mismatches[i]:
+                continue
+            keys, values = self.get_table(i, n_deleted)
+            key = encode_seq(query)
+            j = np.searchsorted(keys, key)
+            if j < len(keys) and keys[j] == key:
+                val = values[j]
+                if val == MULTI_MATCH:
+                    return 'multi_match'
+                return self.refs[i][val]
+
+        # If nothing matched at all, return "no_match"!
+        return 'no_match'
+
+def get_n_mismatch(tol, l):
+
+    if 0 < tol < 1:
+        return int(np.floor(tol * l))
+    else:
+        return int(np.floor(tol))
+
+def encode_seq(seq):
+    '''
+    Encodes a sequence string the same way as encode_digits.
+    '''
+    digits = seq.translate(digit_table)
+    if len(seq) <= max_int_length:
+        return int(digits, n_letters)
+    return digits
+
+def seqs_to_digits(seqs):
+    '''
+    Converts an array of equal-length sequences to an (n x length) uint8
+    array of base-5 digits.
+    '''
+    seqs = np.asarray(seqs, dtype = 'S')
+    l = seqs.dtype.itemsize
+    return byte_table[seqs.view(np.uint8).reshape(len(seqs), l)]
+
+def encode_digits(digits):
+    '''
+    Encodes each row of an (n x length) array of base-5 digits into a key.
+    '''
+    l = digits.shape[1]
+    if l <= max_int_length:
+        powers = n_letters ** np.arange(l - 1, -1, -1, dtype = np.int64)
+        return digits.astype(np.int64).dot(powers)
+    chars = digits + np.uint8(ord('0'))
+    return np.ascontiguousarray(chars).view('S{}'.format(l)).ravel()
+
+def indel_variants(digits):
+    '''
+    Yields copies of "digits" with one base deleted and one base inserted,
+    for every deletion position, insertion position and inserted base.
+    '''
+    n, l = digits.shape
+    for i in range(l):
+        kept = [x for x in range(l) if x != i]
+        for j in range(l):
+            # Column j is a placeholder for the inserted base
+            variant = digits[:, kept[:j] + [i] + kept[j:]]
+            for c in range(n_letters):
+                variant[:, j] = c
+                yield variant.copy()
+
+def substitution_keys(digits, n_sub):
+    '''
+    Yields the keys for every way of changing exactly "n_sub" positions of
+    each row of "digits" to a different base.
+    '''
+    n, l = digits.shape
+    if l <= max_int_length:
+        # Integer keys can be shifted arithmetically without re-encoding
+        base_keys = encode_digits(digits)
+        powers = n_letters ** np.arange(l - 1, -1, -1, dtype = np.int64)
+        for positions in it.combinations(range(l), n_sub):
+            for shifts in it.product(range(1, n_letters), repeat = n_sub):
+                keys = base_keys.copy()
+                for pos, shift in zip(positions, shifts):
+                    old = digits[:, pos].astype(np.int64)
+                    keys += ((old + shift) % n_letters - old) * powers[pos]
+                yield keys
+    else:
+        for positions in it.combinations(range(l), n_sub):
+            positions = list(positions)
+            for shifts in it.product(range(1, n_letters), repeat = n_sub):
+                variant = digits.copy()
+                variant[:, positions] = (variant[:, positions] + np.array(shifts, dtype = np.uint8)) % n_letters
+                yield encode_digits(variant)
+
+def variant_candidates(ref_digits, ref_inds, n_mismatch):
+    '''
+    Generates the keys of all variants of the given references, along with
+    the reference each came from and the number of errors it took. The same
+    key can appear more than once for a reference, with different numbers
+    of errors.
+    '''
+    key_list = []
+    ind_list = []
+    dist_list = []
+    def add(keys, inds, dist):
+        key_list.append(keys)
+        ind_list.append(inds)
+        dist_list.append(np.zeros(len(keys), dtype = np.int8) + dist)
+
+    # Sequences reachable with only deletion/insertion pairs, which cost two
+    # errors each. Substitutions are then made on top of those, up to the
+    # total number of errors.
+    base_digits, base_inds = ref_digits, ref_inds
+    for n_pairs in range(0, n_mismatch / 2 + 1):
+        if n_pairs > 0:
+            variants = list(indel_variants(base_digits))
+            base_digits, base_inds = np.vstack(variants), np.tile(base_inds, len(variants))
+            del variants
+        for n_sub in range(0, n_mismatch - 2 * n_pairs + 1):
+            for keys in substitution_keys(base_digits, n_sub):
+                add(keys, base_inds, 2 * n_pairs + n_sub)
+
+    return np.concatenate(key_list), np.concatenate(ind_list), np.concatenate(dist_list)
+
+def deletion_candidates(ref_digits, ref_inds, n_mismatch, n_deleted):
+    '''
+    Like variant_candidates, but for variants "n_deleted" bases shorter than
+    the references. Each deleted base counts as one error.
+    '''
+    if n_deleted == 0:
+        return variant_candidates(ref_digits, ref_inds, n_mismatch)
+
+    key_list = []
+    ind_list = []
+    dist_list = []
+    l = ref_digits.shape[1]
+    for positions in it.combinations(range(l), n_deleted):
+        kept = [x for x in range(l) if x not in positions]
+        keys, inds, dists = variant_candidates(ref_digits[:, kept], ref_inds, n_mismatch - n_deleted)
+        key_list.append(keys)
+        ind_list.append(inds)
+        dist_list.append(dists + n_deleted)
+
+    return np.concatenate(key_list), np.concatenate(ind_list), np.concatenate(dist_list)
+
+def reduce_candidates(keys, inds, dists):
+    '''
+    Collapses candidate keys to one row per key, holding the closest
+    reference (or MULTI_MATCH if two references are equally close) and its
+    distance.
+    '''
+    order = np.argsort(keys)
+    keys, inds, dists = keys[order], inds[order], dists[order]
+    del order
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    min_dists = np.minimum.reduceat(dists, starts)
+    closest = dists == np.repeat(min_dists, np.diff(np.append(starts, len(keys))))
+    keys, inds = keys[closest], inds[closest]
+
+    # A key has more than one closest reference if they are not all the same
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    lowest = np.minimum.reduceat(inds, starts)
+    highest = np.maximum.reduceat(inds, starts)
+    values = np.where(lowest == highest, lowest, MULTI_MATCH).astype(np.int32)
+
+    return keys[starts], values, min_dists
+
+def merge_tables(table, new_table):
+    '''
+    Merges two reduced tables built from disjoint sets of references.
+    '''
+    keys, values, dists = table
+    new_keys, new_values, new_dists = new_table
+
+    pos = np.searchsorted(keys, new_keys)
+    shared = pos < len(keys)
+    shared[shared] = keys[pos[shared]] == new_keys[shared]
+
+    # For keys in both tables, the closer reference wins and ties become
+    # multi-matches.
+    shared_pos = pos[shared]
+    closer = new_dists[shared] < dists[shared_pos]
+    tied = new_dists[shared] == dists[shared_pos]
+    values[shared_pos[closer]] = new_values[shared][closer]
+    dists[shared_pos[closer]] = new_dists[shared][closer]
+    values[shared_pos[tied]] = MULTI_MATCH
+
+    # Keys only in the new table are slotted in at their sorted positions
+    new_dest = pos[~shared] + np.arange(np.sum(~shared))
+    old_dest = np.ones(len(keys) + len(new_dest), dtype = np.bool)
+    old_dest[new_dest] = False
+    merged = []
+    for old_arr, new_arr in [[keys, new_keys], [values, new_values], [dists, new_dists]]:
+        arr = np.empty(len(old_dest), dtype = old_arr.dtype)
+        arr[new_dest] = new_arr[~shared]
+        arr[old_dest] = old_arr
+        merged.append(arr)
+    return merged
+
+def build_table(refs, n_mismatch, chunk_size = 500, n_deleted = 0):
+    '''
+    Returns the sorted keys of all variants within "n_mismatch" errors of
+    any reference, and for each key the index of the closest reference (or
+    MULTI_MATCH if two references are equally close). References are
+    expanded "chunk_size" at a time to limit memory usage. If "n_deleted"
+    is given, the variants are that many bases shorter than the references.
+    '''
+    ref_digits = seqs_to_digits(refs)
+    ref_inds = np.arange(len(refs), dtype = np.int32)
+
+    table = None
+    for start in range(0, len(refs), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        chunk_table = reduce_candidates(*deletion_candidates(ref_digits[chunk], ref_inds[chunk], n_mismatch, n_deleted))
+        if table is None:
+            table = chunk_table
+        else:
+            table = merge_tables(table, chunk_table)
+
+    keys, values, dists = table
+    return keys, values
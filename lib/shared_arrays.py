@@ -0,0 +1,197 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Numpy arrays in shared memory, and a long-lived process pool to work on
+# them. A SharedArray lives in a memory-mapped file (in /dev/shm if it
+# exists), and only its file name, shape and dtype are pickled when it is
+# passed to a pool worker, which maps the same memory. So workers can read
+# large inputs and write their results straight into an output array,
+# without any of the data being pickled or copied. An array that is already
+# in a shared file mapping (such as another SharedArray) is used in place
+# rather than copied.
+#
+# Files in /dev/shm are sparse, so a tmpfs that is too small for an array is
+# only found out when its pages are written, which kills the process with a
+# bus error. So arrays only go in /dev/shm if there is room for them there
+# (along with the unwritten parts of the other shared arrays), and otherwise
+# in the regular temporary folder.
+#
+# The pool is started on first use and reused by later calls (with the same
+# number of cores), instead of starting a new pool for every step.
+
+import os, tempfile, atexit, weakref
+import numpy as np
+from multiprocessing import Pool
+
+if os.path.isdir('/dev/shm'):
+    shm_folder = '/dev/shm'
+else:
+    shm_folder = None
+
+# The shared arrays in shm_folder that this process created and has not
+# closed yet
+shm_arrays = weakref.WeakValueDictionary()
+
+def get_unwritten_bytes(shared_array):
+    '''
+    Returns how many bytes of the shared array's file have not been
+    allocated yet (and so are not counted as used space).
+    '''
+    try:
+        allocated = os.stat(shared_array.filename).st_blocks * 512
+    except OSError:
+        return 0
+    return max(0, shared_array.nbytes - allocated)
+
+def get_array_folder(nbytes):
+    '''
+    Returns the folder in which to create a shared array of "nbytes" bytes:
+    shm_folder if it has room for it, and otherwise None (the regular
+    temporary folder).
+    '''
+    if shm_folder is None:
+        return None
+    stats = os.statvfs(shm_folder)
+    available = stats.f_bavail * stats.f_frsize - sum(get_unwritten_bytes(x) for x in shm_arrays.values())
+    if nbytes > available:
+        return None
+    return shm_folder
+
+def get_file_mapping(data):
+    '''
+    If "data" is a C-contiguous view of a file that other processes can map
+    (a memory-map that is not copy-on-write), returns the file name, the
+    offset of the data in it and the mode to map it with, and otherwise
+    None.
+    '''
+    base = data
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    if base is None or base.filename is None or base.mode not in ['r', 'r+', 'w+'] or not data.flags['C_CONTIGUOUS']:
+        return None
+    offset = data.__array_interface__['data'][0] - base.__array_interface__['data'][0]
+    if offset < 0 or offset + data.nbytes > base.nbytes:
+        return None
+    return base.filename, base.offset + offset, 'r' if base.mode == 'r' else 'r+'
+
+class SharedArray:
+
+    def __init__(self, shape = None, dtype = np.float, data = None):
+        '''
+        Creates a shared array of the given shape and dtype, or a shared
+        copy of "data". The array is in the "array" attribute. Call close()
+        (or use a "with" statement) to remove the file once the workers are
+        done with it.
+
+        If "data" is already in a file that can be shared (see
+        get_file_mapping), that file is used instead of a copy. Changes to
+        the data are then seen by the workers, and close() leaves the file
+        to its owner.
+        '''
+        self.offset = 0
+        self.mode = 'r+'
+        self.owns_file = True
+        if data is not None:
+            data = np.asarray(data)
+            shape, dtype = data.shape, data.dtype
+            mapping = get_file_mapping(data)
+            if mapping is not None and data.size > 0:
+                self.filename, self.offset, self.mode = mapping
+                self.owns_file = False
+        self.shape = tuple(int(x) for x in np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if not self.owns_file:
+            self.array = data
+            return
+        folder = get_array_folder(self.nbytes)
+        fd, self.filename = tempfile.mkstemp(dir = folder, prefix = 'bean-counter_', suffix = '.dat')
+        os.close(fd)
+        if folder is not None:
+            shm_arrays[self.filename] = self
+        self.array = self._map('w+')
+        if data is not None:
+            self.array[...] = data
+
+    def _map(self, mode):
+        # Zero-size arrays cannot be memory-mapped
+        if np.prod(self.shape) == 0:
+            return np.zeros(self.shape, dtype = self.dtype)
+        return np.memmap(self.filename, dtype = self.dtype, mode = mode, offset = self.offset, shape = self.shape).view(np.ndarray)
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'offset': self.offset, 'mode': self.mode, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.offset = state['offset']
+        self.mode = state['mode']
+        self.shape = state['shape']
+        self.dtype = np.dtype(state['dtype'])
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owns_file = False
+        self.array = self._map(self.mode)
+
+    def detach(self):
+        '''
+        Removes the file and returns the array. The memory stays mapped
+        for as long as the array is in use, so this does not copy it.
+        '''
+        array = self.array
+        self.close()
+        return array
+
+    def close(self):
+        if self.owns_file and os.path.exists(self.filename):
+            os.remove(self.filename)
+        shm_arrays.pop(self.filename, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+worker_pool = None
+worker_pool_size = None
+worker_pool_pid = None
+
+def get_worker_pool(num_cores):
+    '''
+    Returns the shared pool of "num_cores" worker processes, starting it
+    if needed. Tasks should get their data from SharedArrays rather than
+    from globals, as the workers may have been started before the globals
+    were set.
+    '''
+    global worker_pool
+    global worker_pool_size
+    global worker_pool_pid
+    if worker_pool is not None and worker_pool_pid != os.getpid():
+        # A pool inherited from the parent process (e.g. by a task of
+        # task_graph.run_task_graph) belongs to the parent, and cannot be
+        # used or closed here
+        worker_pool = None
+        worker_pool_size = None
+    if worker_pool is None or worker_pool_size != num_cores:
+        close_worker_pool()
+        worker_pool = Pool(processes = num_cores)
+        worker_pool_size = num_cores
+        worker_pool_pid = os.getpid()
+    return worker_pool
+
+def close_worker_pool():
+
+    global worker_pool
+    global worker_pool_size
+    if worker_pool is not None and worker_pool_pid == os.getpid():
+        worker_pool.close()
+        worker_pool.join()
+        worker_pool = None
+        worker_pool_size = None
+
+    return None
+
+atexit.register(close_worker_pool)
@@ -0,0 +1,158 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Sparse stand-in for the n-dimensional count array built while parsing
+# (index tags x barcodes, per read). Only the combinations that were actually
+# observed are stored, as sorted linear indices into the dense array along
+# with their counts, so memory scales with the number of observed
+# combinations rather than with the product of the dimensions.
+#
+# It supports the parts of the numpy interface the parsing code uses:
+# "shape", "sum", "+=", lookups with integer (array) indices, and slicing
+# with ranges along every axis.
+
+import numpy as np
+
+def sum_counts(inds, counts, n):
+    '''
+    Integer version of np.bincount(inds, weights = counts, minlength = n),
+    which would add the counts up as floats (large counts could round).
+    '''
+    sums = np.zeros(n, dtype = np.int)
+    if len(inds) == 0:
+        return sums
+    order = np.argsort(inds, kind = 'mergesort')
+    sorted_inds = inds[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_inds[1:] != sorted_inds[:-1]]))
+    sums[sorted_inds[starts]] = np.add.reduceat(counts[order], starts)
+    return sums
+
+class SparseCountArray:
+
+    def __init__(self, shape):
+        self.shape = tuple(int(x) for x in shape)
+        assert np.prod([long(x) for x in self.shape]) < 2**63, 'Count array of shape {} is too large to index.'.format(self.shape)
+        self.inds = np.zeros(0, dtype = np.int64)
+        self.counts = np.zeros(0, dtype = np.int)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def add_at(self, idxs, counts = 1):
+        '''
+        Equivalent to np.add.at(array, idxs, counts) on a dense array.
+        Additions are buffered and combined in bulk.
+        '''
+        inds = np.ravel_multi_index(idxs, self.shape).astype(np.int64)
+        counts = np.broadcast_to(counts, inds.shape).astype(np.int)
+        self._buffer.append([inds.ravel(), counts.ravel()])
+        self._buffer_size += inds.size
+        if self._buffer_size > max(len(self.inds), 1000000):
+            self.flush()
+
+    def flush(self):
+        '''
+        Combines the buffered additions with the stored counts.
+        '''
+        if len(self._buffer) == 0:
+            return None
+        inds = np.concatenate([self.inds] + [x[0] for x in self._buffer])
+        counts = np.concatenate([self.counts] + [x[1] for x in self._buffer])
+        self.inds, inv = np.unique(inds, return_inverse = True)
+        self.counts = sum_counts(inv, counts, len(self.inds))
+        self._buffer = []
+        self._buffer_size = 0
+        return None
+
+    def coords(self):
+        '''
+        Returns the index along each axis of the stored combinations.
+        '''
+        self.flush()
+        return np.unravel_index(self.inds, self.shape)
+
+    def __iadd__(self, other):
+        assert other.shape == self.shape, 'Cannot add count arrays of shapes {} and {}.'.format(self.shape, other.shape)
+        if isinstance(other, SparseCountArray):
+            other.flush()
+            self._buffer.append([other.inds, other.counts])
+            self._buffer_size += len(other.inds)
+        else:
+            nonzero = np.nonzero(other)
+            self.add_at(nonzero, other[nonzero])
+        self.flush()
+        return self
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        assert len(key) == len(self.shape), 'Count arrays must be indexed along every axis.'
+        self.flush()
+
+        if all(isinstance(x, slice) for x in key):
+            # Restrict to a range along each axis
+            ranges = [x.indices(dim) for x, dim in zip(key, self.shape)]
+            assert all(x[2] == 1 for x in ranges), 'Count arrays can only be sliced with a step of 1.'
+            coords = self.coords()
+            keep = np.ones(len(self.inds), dtype = np.bool)
+            for c, (start, stop, step) in zip(coords, ranges):
+                keep &= (c >= start) & (c < stop)
+            new = SparseCountArray([max(stop - start, 0) for start, stop, step in ranges])
+            new_coords = tuple(c[keep] - r[0] for c, r in zip(coords, ranges))
+            new.inds = np.ravel_multi_index(new_coords, new.shape).astype(np.int64)
+            new.counts = self.counts[keep]
+            return new
+
+        # Otherwise, look up individual elements (negative indices count
+        # from the end, as for numpy arrays)
+        key = np.broadcast_arrays(*[np.asarray(x) for x in key])
+        key = tuple(np.where(x < 0, x + dim, x) for x, dim in zip(key, self.shape))
+        inds = np.ravel_multi_index(key, self.shape).astype(np.int64)
+        pos = np.minimum(np.searchsorted(self.inds, inds), max(len(self.inds) - 1, 0))
+        if len(self.inds) == 0:
+            values = np.zeros(inds.shape, dtype = np.int)
+        else:
+            values = np.where(self.inds[pos] == inds, self.counts[pos], 0)
+        if values.ndim == 0:
+            return values[()]
+        return values
+
+    def sum(self, axis = None):
+        '''
+        Same as numpy's sum, returning dense arrays for partial sums.
+        '''
+        self.flush()
+        if axis is None:
+            return self.counts.sum()
+        if not isinstance(axis, tuple):
+            axis = (axis,)
+        axis = [x % len(self.shape) for x in axis]
+        kept_axes = [i for i in range(len(self.shape)) if i not in axis]
+        if len(kept_axes) == 0:
+            return self.counts.sum()
+        coords = self.coords()
+        kept_shape = tuple(self.shape[i] for i in kept_axes)
+        kept_inds = np.ravel_multi_index(tuple(coords[i] for i in kept_axes), kept_shape)
+        return sum_counts(kept_inds, self.counts, int(np.prod(kept_shape))).reshape(kept_shape)
+
+    def toarray(self):
+        '''
+        Returns the equivalent dense numpy array.
+        '''
+        self.flush()
+        array = np.zeros(self.shape, dtype = np.int)
+        array.flat[self.inds] = self.counts
+        return array
+
+    def __getstate__(self):
+        self.flush()
+        return {'shape': self.shape, 'inds': self.inds, 'counts': self.counts}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.inds = state['inds']
+        self.counts = state['counts']
+        self._buffer = []
+        self._buffer_size = 0
@@ -0,0 +1,145 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Stacked datasets ([ncomps, strains, conditions, matrix_3d]) hold one matrix
+# for each number of components removed by batch or SVD correction. Every
+# one of those matrices is the same base matrix minus a low-rank correction,
+# so instead of a dense (layers x strains x conditions) array, a LowRankStack
+# stores the base matrix, the (strain) component vectors and each
+# component's contribution to every condition, and computes a layer only when
+# it is asked for. It can be indexed like the 3-D array it replaces:
+# stack[i] is layer i, stack[i, rows, cols] part of it, and stack[:, :, cols]
+# a smaller stack with just those conditions.
+
+import numpy as np
+
+class LowRankStack:
+
+    def __init__(self, base, vectors, contributions, ranks, kind = 'corrected'):
+        '''
+        "vectors" (strains x k) are the components, and "contributions"
+        (k x conditions) their contributions to each condition. Layer i
+        uses the first ranks[i] components. With kind "corrected", layer i
+        is the base matrix minus those components' contributions, and NaNs
+        in the base matrix are treated as zeros and put back afterwards.
+        With kind "components", layer i is the contribution of component
+        ranks[i] alone, and there is no base matrix.
+        '''
+        assert kind in ['corrected', 'components'], 'Unknown kind of stack: {}'.format(kind)
+        self.kind = kind
+        self.base = base
+        self.vectors = np.asarray(vectors)
+        self.contributions = np.asarray(contributions)
+        self.ranks = np.asarray(ranks, dtype = np.int)
+        assert self.vectors.shape[1] == self.contributions.shape[0], 'There must be one row of contributions for each component vector'
+        if kind == 'corrected':
+            assert base is not None, 'A corrected stack needs a base matrix'
+            assert base.shape == (self.vectors.shape[0], self.contributions.shape[1]), 'Components do not match the shape of the base matrix'
+            assert np.all(self.ranks <= self.vectors.shape[1]), 'Not enough components for the requested layers'
+        else:
+            assert np.all(self.ranks < self.vectors.shape[1]), 'Not enough components for the requested layers'
+
+    @property
+    def shape(self):
+        return (len(self.ranks), self.vectors.shape[0], self.contributions.shape[1])
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        if self.base is None:
+            return np.result_type(self.vectors, self.contributions)
+        return np.result_type(self.base, self.vectors, self.contributions)
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def layer(self, i):
+        '''
+        Computes layer i of the stack.
+        '''
+        r = self.ranks[i]
+        if self.kind == 'components':
+            return np.dot(self.vectors[:, r:(r + 1)], self.contributions[r:(r + 1)])
+        matrix = np.array(self.base, dtype = self.dtype)
+        nan_idx = np.isnan(matrix)
+        matrix[nan_idx] = 0.0
+        if r > 0:
+            matrix -= np.dot(self.vectors[:, :r], self.contributions[:r])
+        matrix[nan_idx] = np.nan
+        return matrix
+
+    def __iter__(self):
+        '''
+        Yields the layers in order. The layers of a corrected stack are
+        nested, so each one is computed from the one before by removing
+        just the components it adds (one rank-1 update per layer when the
+        ranks go up by one), instead of from the base matrix.
+        '''
+        if self.kind == 'components':
+            for i in range(len(self)):
+                yield self.layer(i)
+            return
+        matrix = np.array(self.base, dtype = self.dtype)
+        nan_idx = np.isnan(matrix)
+        matrix[nan_idx] = 0.0
+        r_prev = 0
+        for i, r in enumerate(self.ranks):
+            if r < r_prev:
+                # Components cannot be added back, so start over
+                matrix = self.layer(i)
+                matrix[nan_idx] = 0.0
+            elif r > r_prev:
+                matrix -= np.dot(self.vectors[:, r_prev:r], self.contributions[r_prev:r])
+            r_prev = r
+            layer = matrix.copy()
+            layer[nan_idx] = np.nan
+            yield layer
+
+    def __getitem__(self, key):
+        '''
+        Indexes like a 3-D array. If more than one layer is selected, the
+        result is another stack, and the strain and condition indices are
+        applied independently of each other.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        layer_key, row_key, col_key = key
+        if isinstance(layer_key, (int, long, np.integer)):
+            return self.layer(layer_key)[row_key, col_key]
+        base = self.base
+        if base is not None:
+            base = base[row_key][:, col_key]
+        return LowRankStack(base, self.vectors[row_key], self.contributions[:, col_key], self.ranks[layer_key], self.kind)
+
+    def __array__(self, dtype = None):
+        '''
+        Builds the full (dense) 3-D array.
+        '''
+        stack = np.empty(self.shape, dtype = self.dtype if dtype is None else dtype)
+        for i, layer in enumerate(self):
+            stack[i] = layer
+        return stack
+
+    def get_arrays(self):
+        '''
+        Returns the arrays to store, by name (see from_arrays).
+        '''
+        arrays = {'vectors': self.vectors, 'contributions': self.contributions, 'ranks': self.ranks}
+        if self.base is not None:
+            arrays['base'] = self.base
+        return arrays
+
+def from_arrays(kind, arrays):
+
+    return LowRankStack(arrays.get('base'), arrays['vectors'], arrays['contributions'], arrays['ranks'], kind)
+
+def is_low_rank_stack(x):
+
+    return isinstance(x, LowRankStack)
@@ -0,0 +1,122 @@
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+VERSION='2.6.1'
+
+# Runs a set of tasks (e.g. the per-lane steps of process_screen.py) as a
+# dependency graph: each task starts as soon as all of the tasks it depends
+# on have finished, with up to "num_cores" tasks running at once. Tasks run
+# in their own (non-daemonic) processes, so they are free to start process
+# pools of their own. The cores are shared out between the tasks that are
+# ready to run, and each task's get_num_cores() is limited accordingly.
+
+import time, traceback
+import Queue
+from multiprocessing import Process
+from multiprocessing import Queue as ProcessQueue
+
+import cg_common_functions
+
+def format_task_id(task_id):
+
+    step, lane_id = task_id
+    if isinstance(step, int):
+        step = 'step {}'.format(step)
+    if lane_id is None:
+        return step
+    return '{} (lane {})'.format(step, lane_id)
+
+def run_task(task_id, func, args, num_cores, result_queue):
+    '''
+    Runs one task, in a child process unless "result_queue" is None, and
+    reports [task_id, run time, traceback or None].
+    '''
+    old_limit = cg_common_functions.num_cores_limit
+    cg_common_functions.num_cores_limit = num_cores
+    start_time = time.time()
+    try:
+        func(*args)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        cg_common_functions.num_cores_limit = old_limit
+    result = [task_id, time.time() - start_time, error]
+    if result_queue is None:
+        return result
+    result_queue.put(result)
+    return None
+
+def run_task_graph(tasks, num_cores):
+    '''
+    "tasks" is a list of [task_id, dependencies, func, args], where task_id
+    is a (step, lane_id) tuple (lane_id is None for steps that combine all
+    lanes, and step is a step number or a name such as "sub-screen A") and
+    dependencies is a list of task_ids. Dependencies on tasks not
+    in the list are considered already done. When several tasks are ready,
+    those earlier in the list run first.
+
+    Returns a list of [task_id, run time] for the tasks, in the order they
+    finished. If any task fails, no new tasks are started, and an
+    AssertionError reports which lanes and steps failed (with their
+    tracebacks) and which were not run as a result.
+    '''
+    task_ids = [x[0] for x in tasks]
+    deps = {x[0]: set(y for y in x[1] if y in task_ids) for x in tasks}
+    waiting = list(tasks)
+    running = {}
+    timings = []
+    failures = []
+    result_queue = ProcessQueue()
+
+    while len(waiting) > 0 or len(running) > 0:
+        # Start the tasks whose dependencies are done, while there are cores
+        if len(failures) == 0:
+            done = set(x[0] for x in timings)
+            ready = [x for x in waiting if deps[x[0]] <= done]
+            task_cores = max(1, num_cores / max(len(ready) + len(running), 1))
+            for task in ready:
+                if len(running) >= num_cores:
+                    break
+                task_id, task_deps, func, args = task
+                waiting.remove(task)
+                if num_cores == 1:
+                    # No need for a separate process
+                    result_queue.put(run_task(task_id, func, args, task_cores, None))
+                    running[task_id] = None
+                else:
+                    p = Process(target = run_task, args = (task_id, func, args, task_cores, result_queue))
+                    p.start()
+                    running[task_id] = p
+        elif len(running) == 0:
+            break
+
+        # Wait for a task to finish
+        try:
+            task_id, run_time, error = result_queue.get(timeout = 1)
+        except Queue.Empty:
+            # Check for processes that died without reporting back
+            for task_id, p in running.items():
+                if p is not None and not p.is_alive() and p.exitcode != 0:
+                    p.join()
+                    del running[task_id]
+                    failures.append([task_id, 'Process exited with code {}'.format(p.exitcode)])
+            continue
+        p = running.pop(task_id)
+        if p is not None:
+            p.join()
+        if error is None:
+            timings.append([task_id, run_time])
+        else:
+            failures.append([task_id, error])
+
+    if len(failures) > 0:
+        report = ['The following steps failed:']
+        for task_id, error in failures:
+            report.append('{} failed:\n{}'.format(format_task_id(task_id), error))
+        if len(waiting) > 0:
+            report.append('These steps were not run: {}'.format(', '.join(format_task_id(x[0]) for x in waiting)))
+        assert False, '\n'.join(report)
+
+    return timings
@@ -33,7 +33,11 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 from cg_common_functions import read_sample_table, bool_dict
+from dataset_index import ConditionIndex, get_condition_ids, index_sample_table
+from stacked_dataset import LowRankStack
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists, dataset_formats
 
 sys.path.append(os.path.join(barseq_path, 'lib/python2.7/site-packages'))
 
@@ -52,18 +56,10 @@ from sklearn import datasets
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def write_corrected_data_info(dataset_3d, batch_col, nondup_col_list, filename, input_filename):
 
     f = open(filename, 'wt')
@@ -74,18 +70,14 @@ def write_corrected_data_info(dataset_3d, batch_col, nondup_col_list, filename,
 
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     #print final_conditions
     #print all_conditions
     #print rows_to_keep
     
     return sample_table.iloc[rows_to_keep]
 
-def a_is_row_in_b(a, b):
-      
-    return np.any(np.all(a == b, axis = 1))
-
 def get_nonreplicating_conditions(sample_table, batch_col, nondup_col_list):
 
     # Do some checks to make sure the columns are in the sample table
@@ -107,36 +99,39 @@ def get_nonreplicating_conditions(sample_table, batch_col, nondup_col_list):
 
     # Iterate over the rows of the sample table, build up the list of conditions
     # that will be used to get the components for removing batch effects.
+    include = [bool_dict[x] for x in sample_table['include?']]
+    control = [bool_dict[x] for x in sample_table['control?']]
+    tags = sample_table[batch_col].values
+    nondup_values = {col: sample_table[col].values for col in nondup_col_list}
     inds = []
-    for i, row in sample_table.iterrows():
+    for i in range(len(sample_table)):
         # First, if the row has been slated to not be included, then don't include! Move on to the next row
-        # print row
-        if not bool_dict[row['include?']]:
+        if not include[i]:
             continue
         # Accept all control conditions, because they should not show strong correlations with batch 
         # identity unless there is a batch effect
-        if bool_dict[row['control?']]:
+        if control[i]:
             inds.append(i)
         else:
             accept = True
-            tag = row[batch_col]
+            tag = tags[i]
             for col in nondup_col_list:
-                if row[col] in nondup_dict[col][tag]:
+                if nondup_values[col][i] in nondup_dict[col][tag]:
                     # If any property (for example, the condition name) has already occurred for a certain
                     # tag, flag that condition as unacceptable to accept as a nonduplicating condition
                     accept = False
             if accept:
                 inds.append(i)
                 for col in nondup_col_list:
-                    nondup_dict[col][tag].add(row[col])
-    
-    nonreplicating_conditions = np.array([row[['screen_name', 'expt_id']] for i, row in sample_table.iterrows() if i in inds])
-    
+                    nondup_dict[col][tag].add(nondup_values[col][i])
+
+    nonreplicating_conditions = sample_table[['screen_name', 'expt_id']].values[inds]
+
     return nonreplicating_conditions
 
 def filter_dataset_by_conditions(conditions, matrix, conds_to_keep):
     
-    inds_to_keep = np.array([i for i, val in enumerate(conditions) if a_is_row_in_b(val, conds_to_keep)])
+    inds_to_keep = ConditionIndex(conds_to_keep).find(conditions)
     filtered_conditions = conditions[inds_to_keep]
     filtered_matrix = matrix[:, inds_to_keep]
 
@@ -153,8 +148,7 @@ def get_batch_classes(dataset, sample_table, batch_col):
     # Now, get a vector along the matrix columns indicating which conditions
     # are in which batch
     barcodes, conditions, matrix = dataset
-    sample_table = sample_table.set_index(['screen_name', 'expt_id'])
-    classes = [batch_mapping[sample_table[batch_col].ix[tuple(cond)]] for cond in conditions]
+    classes = [batch_mapping[x] for x in index_sample_table(sample_table).get_column(batch_col, conditions)]
     return classes
 
 def writeList(l, filename):
@@ -189,8 +183,47 @@ def scikit_lda(small_x, full_x, classes, n_comps):
     #mats.append(np.matmul(full_x, np.matmul(lda.scalings_, lda.scalings_.transpose())))
     return mats
 	
-def inner_python_lda(small_x, full_x, classes, n_comps):
-
+lda_methods = ['reduced', 'full']
+
+def get_condition_span(X):
+    '''
+    Returns an orthonormal basis (strains x rank) of the span of the rows
+    (conditions) of X, from its thin SVD.
+    '''
+    U, S, V_T = np.linalg.svd(X, full_matrices = False)
+    tol = S.max() * max(X.shape) * np.finfo(S.dtype).eps if S.size > 0 else 0
+    return np.transpose(V_T[S > tol])
+
+def get_orthogonal_directions(span, n):
+    '''
+    Returns n orthonormal directions (strains x n) that are orthogonal to
+    the span (see get_condition_span).
+    '''
+    G = np.random.RandomState(0).normal(size = (span.shape[0], n))
+    # Projecting twice keeps the directions orthogonal to the span to
+    # within rounding error
+    for i in range(2):
+        G = G - np.matmul(span, np.matmul(np.transpose(span), G))
+    Q, R = np.linalg.qr(G)
+    return Q
+
+def get_lda_components(small_x, classes, n_comps, method = 'reduced'):
+    '''
+    Fits the LDA on the nonreplicating conditions (the columns of small_x)
+    and returns its first n_comps discriminant directions, as the columns
+    of a strains x n_comps matrix (zero for strains without data).
+
+    With method "full", the scatter matrices are strains x strains. With
+    method "reduced", the data is first projected onto the span of the
+    conditions, which holds all of the scatter, so the scatter matrices,
+    pseudo-inverse and decomposition are only (at most) conditions x
+    conditions, and the directions are mapped back to strains afterwards.
+    Both give the same directions. If more directions are asked for than
+    the span has dimensions, the rest are orthonormal directions outside
+    of it (like the full method's, they carry no discriminant information),
+    so both methods return the same number of directions.
+    '''
+    assert method in lda_methods, 'Unknown LDA method: {}'.format(method)
     # Gets boolean index variables
     classes = np.asarray(classes)
     X = np.transpose(small_x.copy())
@@ -198,6 +231,15 @@ def inner_python_lda(small_x, full_x, classes, n_comps):
     b = np.sum(np.absolute(small_x), axis=1)
     X = X[np.ix_(a > 0, b > 0)]
 
+    # All of the data, and so the within- and between-class scatter, lies in
+    # the span of the conditions, which is usually much smaller than the
+    # number of strains (otherwise there is nothing to gain)
+    n_strains = X.shape[1]
+    reduce_dims = method == 'reduced' and X.shape[0] < n_strains
+    if reduce_dims:
+        span = get_condition_span(X)
+        X = np.matmul(X, span)
+
     #pdb.set_trace()
 
     # Indexes classes and initializes scatter vectors
@@ -230,33 +272,48 @@ def inner_python_lda(small_x, full_x, classes, n_comps):
     #a = np.diag(D)/max(np.diag(D))
     stopind = n_comps
 
-    N = V_T.T[:, 0:stopind]
-    
-    #pdb.set_trace()
-    
-    Xnorm = np.transpose(full_x.copy())
-    a = np.sum(np.absolute(Xnorm), axis=0)
-    b = np.sum(np.absolute(Xnorm), axis=1)
+    directions = V_T.T[:, 0:stopind]
+    if reduce_dims:
+        directions = np.matmul(span, directions)
+        n_missing = min(stopind, n_strains) - directions.shape[1]
+        if n_missing > 0:
+            directions = np.hstack([directions, get_orthogonal_directions(span, n_missing)])
 
-    #pdb.set_trace()
+    N = np.zeros((small_x.shape[0], directions.shape[1]))
+    N[b > 0] = directions
 
-    Xnorm[np.ix_(b > 0, a > 0)] = Xnorm[np.ix_(b > 0, a > 0)] - np.matmul(Xnorm[np.ix_(b > 0, a > 0)], np.matmul(N, np.transpose(N)))
-    Xnorm = Xnorm - np.matmul(Xnorm, np.matmul(N, np.transpose(N)))
-    Xnorm = np.transpose(Xnorm)
+    return N
 
-    #pdb.set_trace()
+def inner_python_lda(small_x, full_x, classes, n_comps, lda_method = 'reduced'):
+    '''
+    Returns full_x with its first n_comps LDA components removed (a single
+    layer of outer_python_lda's stack).
+    '''
+    N = get_lda_components(small_x, classes, n_comps, lda_method)
+
+    # The components are orthonormal and zero for strains without data, so
+    # one projection removes them from every strain
+    Xnorm = full_x - np.matmul(N, np.matmul(np.transpose(N), full_x))
 
     return Xnorm
 	
-def outer_python_lda(small_x, full_x, classes, n_comps):
+def outer_python_lda(small_x, full_x, classes, n_comps, lda_method = 'reduced'):
+    '''
+    Returns a LowRankStack of full_x with 0 to n_comps LDA components
+    removed. The components are nested (the first i components are the
+    same whichever number is fitted), so the LDA is fitted once and layer
+    i removes the first i of them, as inner_python_lda(..., i) would. Each
+    layer is the previous one minus one more rank-1 term, so iterating over
+    the stack costs about as much as removing n_comps components once.
+    '''
     # To be as careful as possible, all matrices are copied to prevent
     # undesired pass-by-reference behavior
-    mats = [full_x.copy()]
-    for i in range(1, n_comps+1):
-        mats.append(inner_python_lda(small_x, full_x, classes, i))
-    return mats
+    base = full_x.copy()
+    N = get_lda_components(small_x, classes, n_comps, lda_method)
+    contributions = np.dot(N.T, base)
+    return LowRankStack(base, N, contributions, range(n_comps + 1))
 
-def LDA_batch_normalization(dataset, sample_table, batch_col, output_folder, n_comps): # this is actually the batch normalization method
+def LDA_batch_normalization(dataset, sample_table, batch_col, output_folder, n_comps, lda_method = 'reduced'): # this is actually the batch normalization method
    
     tmp_output_folder = os.path.join(output_folder, 'tmp')
 
@@ -307,11 +364,11 @@ def LDA_batch_normalization(dataset, sample_table, batch_col, output_folder, n_c
 
     # Runs LDA
     #Xnorm = scikit_lda(filtered_matrix, matrix, batch_classes, n_comps)
-    Xnorm = outer_python_lda(filtered_matrix, matrix, batch_classes, n_comps)
+    Xnorm = outer_python_lda(filtered_matrix, matrix, batch_classes, n_comps, lda_method)
 
     return [barcodes, conditions, Xnorm, n_comps]
 
-def main(dataset, sample_table, batch_column, nondup_col_list, max_comps, output_folder, input_file, verbosity):
+def main(dataset, sample_table, batch_column, nondup_col_list, max_comps, output_folder, input_file, verbosity, dataset_format = 'pickle', lda_method = 'reduced'):
 
     # sample_table = read_sample_table(sample_table_filename)
     # print sample_table
@@ -347,17 +404,19 @@ def main(dataset, sample_table, batch_column, nondup_col_list, max_comps, output
 
 	# Scikit LDA implementation
     final_dataset = [barcodes, filtered_conditions, filtered_matrix, conditions, matrix]
-    corrected_dataset = LDA_batch_normalization(final_dataset, sample_table, batch_column, output_folder, max_comps_remove)
+    corrected_dataset = LDA_batch_normalization(final_dataset, sample_table, batch_column, output_folder, max_comps_remove, lda_method)
     all_mats = corrected_dataset[2]
     n_comps = corrected_dataset[3]
 
-    # Turn the final dataset into a numpy array!
+    # The stack of matrices is a LowRankStack, which computes each matrix
+    # from the components when it is needed (the npy dataset formats store
+    # it that way, and the pickle format as the dense array)
     components_removed = np.array(list(range(max_comps_remove + 1)))
-    all_mats = [components_removed, barcodes, conditions, np.array(all_mats)]
+    all_mats = [components_removed, barcodes, conditions, all_mats]
 
     # Write out the 3-d array with different LDA components removed
     corrected_data_filename = get_corrected_data_filename(output_folder)
-    dump_dataset(all_mats, corrected_data_filename)
+    dump_dataset(all_mats, corrected_data_filename, dataset_format)
 
     # Write info on the dumped stacked matrix to a file
     corrected_data_info_filename = get_corrected_data_info_filename(output_folder)
@@ -378,13 +437,15 @@ if __name__ == '__main__':
     parser.add_argument('nondup_columns', help = 'Comma delimited. The columns that contain condition identifiers that should not be duplicated within the same batch.')
     parser.add_argument('max_components', type = int, help = 'The maximum number of LDA components to remove.')
     parser.add_argument('output_folder', help = 'The folder to which results are exported.')
+    parser.add_argument('--lda_method', choices = lda_methods, default = 'reduced', help = 'How the LDA is fitted. "reduced" works in the span of the nonreplicating conditions, which scales to large strain pools. "full" uses strains x strains scatter matrices. Both remove the same components.')
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the batch-corrected datasets are written.')
     parser.add_argument('-v', '--verbosity', type = int, default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
 
     nondup_col_list = args.nondup_columns.split(',')
@@ -396,4 +457,4 @@ if __name__ == '__main__':
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
-    main(dataset, sample_table, args.batch_column, nondup_col_list, args.max_components, output_folder, dataset_file, args.verbosity)
+    main(dataset, sample_table, args.batch_column, nondup_col_list, args.max_components, output_folder, dataset_file, args.verbosity, args.dataset_format, args.lda_method)
@@ -32,11 +32,13 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 
 from pr import precision_recall_curve
 from version_printing import update_version_file
+from dataset_io import load_dataset, dataset_exists
 
 import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 import correlation_functions as cf
 from cg_common_functions import read_sample_table, bool_dict
+from dataset_index import ConditionIndex, get_condition_ids, index_sample_table
 import plotting_tools as pt
 
 #def read_sample_table(tab_filename):
@@ -49,17 +51,13 @@ import plotting_tools as pt
 
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i, row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     return sample_table.iloc[rows_to_keep]
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
 def filter_dataset_by_conditions(conditions, matrix, conds_to_keep):
 
-    inds_to_keep = np.array([i for i, val in enumerate(conditions) if a_is_row_in_b(val, conds_to_keep)])
+    inds_to_keep = ConditionIndex(conds_to_keep).find(conditions)
     # print inds_to_keep
     filtered_conditions = conditions[inds_to_keep]
     filtered_matrix = matrix[:, inds_to_keep]
@@ -116,18 +114,14 @@ def get_batch_effect_histogram_pval_filename(folder):
 
 def load_3d_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    ncomps, barcodes, conditions, matrix = cPickle.load(f)
+    ncomps, barcodes, conditions, matrix = load_dataset(data_filename)
     dataset = [np.array(ncomps), np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
 def load_2d_or_3d_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    dataset_raw = cPickle.load(f)
+    dataset_raw = load_dataset(data_filename)
     dataset = [np.array(x) if (i+1) < len(dataset_raw) else x for i,x in enumerate(dataset_raw)]
-    f.close()
     # If it's a 2D dataset, add a "0 components removed" array as the first element
     # and add another dimension to the data matrix to turn it into a 3d array. This
     # makes it compatible with all remaining code.
@@ -141,9 +135,7 @@ def load_2d_or_3d_dataset(data_filename):
 
 def get_labels_from_conditions(conditions, sample_table, label_name):
 
-    sample_table = sample_table.set_index(['screen_name', 'expt_id'])
-    conditions_tuple = [tuple(x) for x in conditions]
-    return np.array(sample_table[label_name].ix[conditions_tuple])
+    return index_sample_table(sample_table).get_column(label_name, conditions)
 
 def get_nonreplicating_conditions(sample_table, batch_col, nondup_col_list):
 
@@ -166,36 +158,39 @@ def get_nonreplicating_conditions(sample_table, batch_col, nondup_col_list):
 
     # Iterate over the rows of the sample table, build up the list of conditions
     # that will be used to get the components for removing batch effects.
+    include = [bool_dict[x] for x in sample_table['include?']]
+    control = [bool_dict[x] for x in sample_table['control?']]
+    tags = sample_table[batch_col].values
+    nondup_values = {col: sample_table[col].values for col in nondup_col_list}
     inds = []
-    for i, row in sample_table.iterrows():
+    for i in range(len(sample_table)):
         # First, if the row has been slated to not be included, then don't include! Move on to the next row
-        # print row
-        if not bool_dict[row['include?']]:
+        if not include[i]:
             continue
         # Accept all control conditions, because they should not show strong correlations with batch 
         # identity unless there is a batch effect
-        if bool_dict[row['control?']]:
+        if control[i]:
             inds.append(i)
         else:
             accept = True
-            tag = row[batch_col]
+            tag = tags[i]
             for col in nondup_col_list:
-                if row[col] in nondup_dict[col][tag]:
+                if nondup_values[col][i] in nondup_dict[col][tag]:
                     # If any property (for example, the condition name) has already occurred for a certain
                     # tag, flag that condition as unacceptable to accept as a nonduplicating condition
                     accept = False
             if accept:
                 inds.append(i)
                 for col in nondup_col_list:
-                    nondup_dict[col][tag].add(row[col])
+                    nondup_dict[col][tag].add(nondup_values[col][i])
 
-    nonreplicating_conditions = np.array([row[['screen_name', 'expt_id']] for i, row in sample_table.iterrows() if i in inds])
+    nonreplicating_conditions = sample_table[['screen_name', 'expt_id']].values[inds]
 
     return nonreplicating_conditions
 
 def filter_3d_dataset_by_conditions(conditions, matrix_3d, conds_to_keep):
 
-    inds_to_keep = np.array([i for i, val in enumerate(conditions) if a_is_row_in_b(val, conds_to_keep)])
+    inds_to_keep = ConditionIndex(conds_to_keep).find(conditions)
     #print inds_to_keep
     #print len(inds_to_keep)
     filtered_conditions = conditions[inds_to_keep]
@@ -569,16 +564,15 @@ def main(dataset_3d, sample_table, batch_column, nondup_col_list, include_column
     if not os.path.isdir(pr_folder):
         os.makedirs(pr_folder)
     
-    # Use "range(2)" only when needed to test on a small number of removed components!
-    # for ncomps in range(2):
-    for ncomps in range(len(components_removed)):
+    # Iterates over the matrices with 0, 1, 2, etc. components removed. A
+    # LowRankStack builds each of them from the one before, so this costs
+    # about as much as removing all of the components once (indexing
+    # matrix_3d[ncomps] would rebuild every matrix from scratch).
+    for ncomps, matrix in enumerate(matrix_3d):
     
         if verbosity >= 1:
             print "Evaluating {} batch effect for matrix with {} components removed".format(batch_column, ncomps)
         
-        # Get the matrix with 'ncomps' components removed
-        matrix = matrix_3d[ncomps]
-        
         if num_test_batches > -1:
             # Create a small matrix and set of batch classes for faster testing!
             small_batches_uniq = np.unique(batches)[0:num_test_batches]
@@ -689,7 +683,7 @@ if __name__ == '__main__':
     
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_2d_or_3d_dataset(args.dataset_file)
 
     if args.verbosity >= 2:
@@ -30,7 +30,10 @@ barseq_path = os.getenv('BARSEQ_PATH')
 assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
 sys.path.append(os.path.join(barseq_path, 'lib'))
 from cg_common_functions import read_sample_table
+from dataset_index import ConditionIndex, get_condition_ids
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists, dataset_formats
 
 #def read_sample_table(tab_filename):
 #
@@ -42,39 +45,27 @@ from version_printing import update_version_file
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     #print final_conditions
     #print all_conditions
     #print rows_to_keep
 
     return sample_table.iloc[rows_to_keep]
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
 def get_groups_and_maps(sample_table, collapse_col, conditions, verbosity):
 
     # Generate a np array of the unique groups given by the "collapse_col"
     uniq_groups = np.unique(sample_table[collapse_col])
 
     # Generate a map from each condition to its column index in the matrix
-    cond_to_index = {tuple(val):i for i, val in enumerate(conditions)}
+    cond_to_index = ConditionIndex(conditions)
     
     # Generate a map from each replicate group to a numpy array of condition names, and another one that maps to
     # matrix indices!
@@ -85,8 +76,8 @@ def get_groups_and_maps(sample_table, collapse_col, conditions, verbosity):
         if verbosity >= 2:
             print key
             print tab
-        group_to_cond_map[key] = np.array([(row[1]['screen_name'], row[1]['expt_id']) for row in tab.iterrows()])
-        group_to_ind_map[key] = np.array([cond_to_index[tuple(x)] for x in group_to_cond_map[key]])
+        group_to_cond_map[key] = get_condition_ids(tab)
+        group_to_ind_map[key] = cond_to_index.lookup(group_to_cond_map[key])
     
     return(uniq_groups, group_to_cond_map, group_to_ind_map)
 
@@ -230,7 +221,7 @@ def collapse_one_group(group_name, matrix, name_to_col_index, name_to_sample_id,
     
     
 
-def main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to_keep, how_to_collapse, verbosity):
+def main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to_keep, how_to_collapse, verbosity, dataset_format = 'pickle'):
 
     barcodes, conditions, matrix = dataset
 
@@ -254,7 +245,7 @@ def main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to
         print len(group_to_ind)
 
     # Create containers for the new collapsed profiles and sample table rows
-    sample_table.loc[:, 'individual_rep_ids'] = ['{}_{}'.format(x[1]['screen_name'], x[1]['expt_id']) for x in sample_table.iterrows()]
+    sample_table.loc[:, 'individual_rep_ids'] = ['{}_{}'.format(*x) for x in get_condition_ids(sample_table)]
     sample_table = sample_table.set_index(['screen_name', 'expt_id'], drop = False)
     collapsed_profile_list = []
     sample_tab_row_list = []
@@ -317,7 +308,7 @@ def main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to
 
     # And write the collapsed dataset out to file!
     data_filename = os.path.join(output_folder, 'collapsed_dataset.dump.gz')
-    dump_dataset(dataset = [barcodes, collapsed_conditions, collapsed_matrix], filename = data_filename)
+    dump_dataset(dataset = [barcodes, collapsed_conditions, collapsed_matrix], filename = data_filename, fmt = dataset_format)
     
     update_version_file(output_folder, VERSION)
 
@@ -337,13 +328,14 @@ if __name__ == '__main__':
     parser.add_argument('output_folder', help = 'The folder to which the resulting collapsed matrix and sample table are written')
     parser.add_argument('--cols_to_keep', nargs = '+', help = 'A space-delimited list of column names from the sample table to include in the new, collapsed sample table.')
     parser.add_argument('--how_to_collapse', nargs = '+', help = 'A space-delimited list, parallel to the list from "--cols_to_keep", giving the method by which each column should be collapsed. Current options are:\n"concat" to keep all values and semicolon delimit,\n"uniq" if the values for each condition in a replicate group are the same; and\n"mean" to compute a mean and standard deviation of the values (NaNs are removed first).')
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the collapsed dataset is written.')
     parser.add_argument('-v', '--verbosity', type = int, default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
 
     if args.verbosity >= 2:
@@ -385,4 +377,4 @@ if __name__ == '__main__':
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
-    main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to_keep, how_to_collapse, args.verbosity)
+    main(dataset, sample_table, collapse_col, cor_cutoff, output_folder, cols_to_keep, how_to_collapse, args.verbosity, args.dataset_format)
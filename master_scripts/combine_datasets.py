@@ -25,7 +25,10 @@ barseq_path = os.getenv('BARSEQ_PATH')
 assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
 sys.path.append(os.path.join(barseq_path, 'lib'))
 from cg_common_functions import read_sample_table
+from dataset_index import ConditionIndex, StrainIndex, get_condition_ids
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists, dataset_formats, is_dataset_filename
 
 #def read_sample_table(tab_filename):
 #
@@ -37,49 +40,30 @@ from version_printing import update_version_file
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     #print final_conditions
     #print all_conditions
     #print rows_to_keep
 
     return sample_table.iloc[rows_to_keep]
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
 def strain_match(a, b):
 
-    a_inds = []
-    b_inds = []
-    for i, x in enumerate(a):
-        # Changing from matching based on 2-D array to just lists
-        # b/c "Strain_ID" is now just a single identifier string.
-        #if a_is_row_in_b(x, b):
-        if x in b:
-            #b_match_ind = np.where(np.all(x == b, axis = 1))[0]
-            b_match_ind = np.where(x == np.array(b))[0]
-            assert np.size(b_match_ind) == 1, "Strain {} somehow is matching multiple rows in the final strains array".format(x)
-            b_match_int = int(b_match_ind)
-            a_inds.append(i)
-            b_inds.append(b_match_int)
-
-    return [a_inds, b_inds]
+    # "Strain_ID" is a single identifier string, so the strains are matched
+    # through a StrainIndex of b
+    b_index = StrainIndex(b)
+    assert len(b_index.positions) == len(b), "Some strains somehow match multiple rows in the final strains array"
+    b_positions = b_index.get_positions(a)
+    a_inds = np.flatnonzero(b_positions >= 0)
+
+    return [list(a_inds), list(b_positions[a_inds])]
 
 # Define a function to get unique rows from a 2-D array (for getting
 # unique strains from a combined list). From user545424 on this
@@ -176,7 +160,7 @@ def combine_sample_tables(tables):
 
     return combined_table
 
-def main(dataset_list, sample_table_list, all_strains, output_folder, verbosity):
+def main(dataset_list, sample_table_list, all_strains, output_folder, verbosity, dataset_format = 'pickle'):
 
     combined_dataset = combine_datasets(dataset_list, all_strains, verbosity)
 
@@ -201,7 +185,7 @@ def main(dataset_list, sample_table_list, all_strains, output_folder, verbosity)
     dataset_filename = os.path.join(output_folder, 'combined_dataset.dump.gz')
     table_filename = os.path.join(output_folder, 'combined_sample_table.txt')
 
-    dump_dataset(combined_dataset, dataset_filename)
+    dump_dataset(combined_dataset, dataset_filename, dataset_format)
     combined_sample_table.to_csv(table_filename, sep = '\t', header = True, index = False)
 
     update_version_file(output_folder, VERSION)
@@ -214,6 +198,7 @@ if __name__ == '__main__':
     parser.add_argument('dataset_and_sample_table_files', metavar = 'DATASET_1 SAMPLE_TABLE_1 DATASET_2 SAMPLE_TABLE_2 ...', nargs = '+', help = 'The datasets and sample tables that are to be combined, in alternating order.')
     parser.add_argument('--output_folder', help = 'The folder to which the resulting combined matrix and sample table are written.')
     parser.add_argument('--all_strains', action = 'store_true', help = 'Add this flag if you want to keep all of the strains in the combined dataset, instead of the interesect of the strains. Strains present in one dataset but not the other will be represented as NaNs in the combined dataset.')
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the combined dataset is written.')
     parser.add_argument('-v', '--verbosity', type = int, default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
@@ -223,13 +208,11 @@ if __name__ == '__main__':
     sample_table_list = []
     for i, fname in enumerate(args.dataset_and_sample_table_files):
         fname = os.path.abspath(fname)
-        assert os.path.isfile(fname), "File {} does not exist.".format(fname)
+        assert dataset_exists(fname), "File {} does not exist.".format(fname)
         if i % 2 == 0:
-            assert fname.endswith('dump.gz'), "File {} is not a gzipped dump file".format(fname)
-            f = gzip.open(fname)
-            dataset = cPickle.load(f)
+            assert is_dataset_filename(fname), "File {} is not a dataset (\".dump.gz\" or \".dataset\") file".format(fname)
+            dataset = dataset_io.load_dataset(fname)
             dataset_list.append(dataset)
-            f.close()
         elif i % 2 == 1:
             assert fname.endswith('.txt'), "File {} is not a text file".format(fname)
             tab = read_sample_table(fname)
@@ -249,5 +232,5 @@ if __name__ == '__main__':
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
-    main(dataset_list, sample_table_list, all_strains, output_folder, args.verbosity)
+    main(dataset_list, sample_table_list, all_strains, output_folder, args.verbosity, args.dataset_format)
 
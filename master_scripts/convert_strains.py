@@ -23,6 +23,7 @@ if __name__ == '__main__':
     #parser.add_argument('original_barcode_table', help = 'The barcode table corresponding to the dataset in its current format')
     parser.add_argument('new_barcode_table', help = 'The barcode table corresponding to the dataset in its destination format')
     parser.add_argument('output_file', help = 'The file to which the strain-converted dataset will be written.')
+    parser.add_argument('--dataset_format', choices = ['pickle', 'npy', 'npy_compressed'], default = 'pickle', help = 'The format in which the strain-converted dataset is written.')
     parser.add_argument('-v', '--verbosity', default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
@@ -39,22 +40,16 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 
 from cg_common_functions import read_barcode_table
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
-def main(dataset, new_barcode_tab, output_file):
+def main(dataset, new_barcode_tab, output_file, dataset_format = 'pickle'):
 
     barcodes, conditions, matrix = dataset
 
@@ -63,15 +58,13 @@ def main(dataset, new_barcode_tab, output_file):
 
     new_barcodes = [new_barcode_to_strain_id[x] for x in orig_barcode_labels]
 
-    of = gzip.open(output_file, 'wb')
-    cPickle.dump([new_barcodes, conditions, matrix], of)
-    of.close()
+    dump_dataset([new_barcodes, conditions, matrix], output_file, dataset_format)
 
 if __name__ == '__main__':
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
     if args.verbosity >= 2:
         print dataset
@@ -86,5 +79,5 @@ if __name__ == '__main__':
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
-    main(dataset, new_barcode_table, args.output_file)
+    main(dataset, new_barcode_table, args.output_file, args.dataset_format)
 
@@ -26,28 +26,22 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 import cluster_dataset_wrappers as clus_wrap
 from cg_common_functions import read_sample_table, read_barcode_table
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dataset_exists, get_dataset_name
 
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def main(dataset, dataset_file, table, val_name, strain_table_f, strain_columns, sample_table_f, condition_columns, output_file, verbosity):
 
     strains, conditions, matrix = dataset
 
     full_fname = os.path.abspath(dataset_file)
-    out_folder = full_fname.replace('.dump.gz', '')
+    out_folder = get_dataset_name(full_fname)
     if not os.path.isdir(out_folder):
         os.makedirs(out_folder)
 
@@ -186,7 +180,7 @@ if __name__ == '__main__':
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
 
     if args.verbosity >= 2:
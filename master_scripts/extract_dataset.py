@@ -20,8 +20,9 @@ assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set.
 sys.path.append(os.path.join(barseq_path, 'lib'))
 
 from version_printing import update_version_file
+from dataset_io import load_dataset, dump_dataset, dataset_formats, get_dataset_name, is_dataset_filename
 
-def main(dataset, n, folder):
+def main(dataset, n, folder, dataset_format = 'pickle'):
 
     assert len(dataset) == 4, "Dataset does not contain one or more of the following:\nNumber of components removed vector, strain_barcode_vector,\ncondition vector, or 3-D matrix"
 
@@ -31,26 +32,20 @@ def main(dataset, n, folder):
     extracted_dataset = np.array([dataset[1], dataset[2], dataset[3][n]])
     
     filename = os.path.join(folder, '{}_components_removed.dump.gz'.format(n))
-    dump_dataset(extracted_dataset, filename)
+    dump_dataset(extracted_dataset, filename, dataset_format)
 
     update_version_file(folder, VERSION)
    
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('stacked_dataset_file', help = 'The dataset of stacked matrices, from which one matrix will be extracted.')
     parser.add_argument('n', type = int, help = 'The index of the matrix to extract (Python indexes from zero)')
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the extracted dataset is written.')
     args = parser.parse_args()
 
     filename = args.stacked_dataset_file
-    f = gzip.open(filename)
-    dataset = cPickle.load(f)
-    assert filename.endswith('.dump.gz'), 'Not a valid dataset file - must have a ".dump.gz" extension'
-    folder = filename.replace('.dump.gz', '')
+    assert is_dataset_filename(filename), 'Not a valid dataset file - must have a ".dump.gz" or ".dataset" extension'
+    dataset = load_dataset(filename)
+    folder = get_dataset_name(filename)
 
-    main(dataset, args.n, folder)
+    main(dataset, args.n, folder, args.dataset_format)
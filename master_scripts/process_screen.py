@@ -21,6 +21,7 @@ if __name__ == '__main__':
     parser.add_argument('config_file', help = 'The configuration file containing file locations, species information, and processing parameters.')
     parser.add_argument('--start', default = 1, type = int, help = 'Starting processing step. Choose values 1 through 6. Default value is 1.')
     parser.add_argument('--stop', default = 6, type = int, help = 'Stopping processing step. Choose values 1 through 6. Value must be equal to or greater than --start parameter. Default value is 6.')
+    parser.add_argument('--force', action = 'store_true', help = 'Rerun every step (and every lane) between --start and --stop, even those whose outputs are up to date with their inputs.')
     
     args = parser.parse_args()
 
@@ -46,8 +47,11 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 import cluster_dataset_wrappers as clus_wrap
-from cg_common_functions import get_sample_table, parse_yaml
+from cg_common_functions import get_sample_table, parse_yaml, get_num_cores
 from version_printing import update_version_file
+from pipeline_manifest import get_manifest, get_table_hash, is_up_to_date, write_manifest, remove_manifest
+from task_graph import run_task_graph, format_task_id
+from dataset_io import get_dataset_path, get_dataset_format
 
 # Import all of the processing scripts as libraries
 import raw_fastq_to_count_matrix
@@ -56,8 +60,150 @@ import mtag_correlations
 import merge_count_matrices
 import filter_final_count_matrix
 
-
-def main(config_file, start, stop):
+# Config parameters that the outputs of each step depend on. A change in any
+# of them means the step (and everything downstream of it) is rerun.
+count_config_keys = ['common_primer_tolerance', 'index_tag_tolerance', 'barcode_tolerance', 'preview_reads', 'preview_fraction']
+scoring_config_keys = ['control_detection_limit', 'sample_detection_limit', 'lowess_method',
+        'normalization_lowess_delta', 'sigma_lowess_delta', 'sub_screen_column']
+filter_config_keys = ['remove_barcode_specific_conditions', 'barcode_specific_template_correlation_cutoff',
+        'remove_correlated_index_tags', 'index_tag_correlation_cutoff', 'control_detection_limit',
+        'sample_detection_limit', 'strain_pass_read_count', 'strain_pass_fraction',
+        'condition_pass_read_count', 'condition_pass_fraction']
+
+# Datasets are stored as a file or a folder, depending on the dataset format
+def get_count_matrix_filename(config_params, lane_id):
+    filename = counts_to_zscores.get_dumped_count_matrix_filename(config_params, lane_id)
+    return get_dataset_path(filename, get_dataset_format(config_params))
+
+def get_zscore_filename(config_params, lane_id):
+    filename = os.path.join(counts_to_zscores.get_lane_interactions_path(config_params, lane_id), '{}_scaled_dev.dump.gz'.format(lane_id))
+    return get_dataset_path(filename, get_dataset_format(config_params))
+
+def get_index_tag_qc_filenames(config_params):
+    index_tag_path = mtag_correlations.get_index_tag_correlation_path(config_params)
+    return [os.path.join(index_tag_path, 'control_index_tag_correlations.dump'),
+            os.path.join(index_tag_path, 'barcode-specific_template_correlations.dump')]
+
+def get_lane_fastq_filenames(config_params, lane_id):
+    lane_location_tab = raw_fastq_to_count_matrix.get_lane_location_table(config_params)
+    folder = raw_fastq_to_count_matrix.get_lane_folder(lane_id, lane_location_tab)
+    # A missing folder is reported by the parsing step itself
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, x) for x in sorted(os.listdir(folder)) if raw_fastq_to_count_matrix.is_fastq_filename(x)]
+
+def get_lane_sample_hash(sample_table, lane_id):
+    return get_table_hash(sample_table[sample_table['lane'] == lane_id])
+
+def run_step(description, manifest_filename, manifest, output_files, force, func, *args):
+    '''
+    Runs func(*args), unless all of "output_files" exist and were created
+    from the same inputs as described by "manifest" (see pipeline_manifest),
+    in which case the step is skipped. Returns True if the step was run.
+    '''
+    if not force and is_up_to_date(manifest_filename, manifest, output_files):
+        print 'skipping {} (up to date)'.format(description)
+        return False
+
+    print '{}...'.format(description)
+    remove_manifest(manifest_filename)
+    start_time = time.time()
+    func(*args)
+    end_time = time.time()
+    print 'time to process = {}'.format(time.strftime('%H:%M:%S', time.gmtime(end_time - start_time)))
+    write_manifest(manifest_filename, manifest)
+
+    return True
+
+# The steps, as run by the task graph in main(). Each one builds its manifest
+# when it runs, so it sees the outputs of the steps it depends on.
+def count_lane(config_file, config_params, sample_table, lane_id, force):
+    output_file = get_count_matrix_filename(config_params, lane_id)
+    manifest = get_manifest(raw_fastq_to_count_matrix.VERSION,
+            input_files = get_lane_fastq_filenames(config_params, lane_id),
+            hashed_files = [config_params['amplicon_struct_file'], config_params['gene_barcode_file']],
+            config_params = config_params, config_keys = count_config_keys,
+            extra = {'lane_samples': get_lane_sample_hash(sample_table, lane_id)})
+    run_step('generating read count matrix for lane {}'.format(lane_id),
+            os.path.join(os.path.dirname(output_file), 'raw_fastq_to_count_matrix.manifest.json'),
+            manifest, [output_file], force,
+            raw_fastq_to_count_matrix.main, config_file, lane_id)
+
+def score_lane(config_file, config_params, sample_table, lane_id, force):
+    output_file = get_zscore_filename(config_params, lane_id)
+    manifest = get_manifest(counts_to_zscores.VERSION,
+            input_files = [get_count_matrix_filename(config_params, lane_id)],
+            config_params = config_params, config_keys = scoring_config_keys,
+            extra = {'lane_samples': get_lane_sample_hash(sample_table, lane_id)})
+    run_step('generating z-score matrix for lane {}'.format(lane_id),
+            os.path.join(os.path.dirname(output_file), 'counts_to_zscores.manifest.json'),
+            manifest, [output_file], force,
+            counts_to_zscores.main, config_file, lane_id)
+
+def correlate_index_tags(config_file, config_params, lane_ids, force):
+    output_files = get_index_tag_qc_filenames(config_params)
+    manifest = get_manifest(mtag_correlations.VERSION,
+            input_files = [get_zscore_filename(config_params, x) for x in lane_ids],
+            hashed_files = [config_params['sample_table_file']])
+    run_step('computing index tag correlations',
+            os.path.join(os.path.dirname(output_files[0]), 'mtag_correlations.manifest.json'),
+            manifest, output_files, force,
+            mtag_correlations.main, config_file)
+
+def merge_lanes(config_file, config_params, lane_ids, force):
+    output_file = get_count_matrix_filename(config_params, 'all_lanes')
+    manifest = get_manifest(merge_count_matrices.VERSION,
+            input_files = [get_count_matrix_filename(config_params, x) for x in lane_ids],
+            hashed_files = [config_params['sample_table_file']])
+    run_step('merging count matrices',
+            os.path.join(os.path.dirname(output_file), 'merge_count_matrices.manifest.json'),
+            manifest, [output_file], force,
+            merge_count_matrices.main, config_file)
+
+def filter_merged(config_file, config_params, force):
+    output_file = get_count_matrix_filename(config_params, 'all_lanes_filtered')
+    manifest = get_manifest(filter_final_count_matrix.VERSION,
+            input_files = [get_count_matrix_filename(config_params, 'all_lanes')] + get_index_tag_qc_filenames(config_params),
+            hashed_files = [config_params['sample_table_file'], config_params['gene_barcode_file']],
+            config_params = config_params, config_keys = filter_config_keys)
+    run_step('filtering the final count matrix',
+            os.path.join(os.path.dirname(output_file), 'filter_final_count_matrix.manifest.json'),
+            manifest, [output_file], force,
+            filter_final_count_matrix.main, config_file)
+
+def score_filtered(config_file, config_params, force):
+    output_file = get_zscore_filename(config_params, 'all_lanes_filtered')
+    manifest = get_manifest(counts_to_zscores.VERSION,
+            input_files = [get_count_matrix_filename(config_params, 'all_lanes_filtered')],
+            hashed_files = [config_params['sample_table_file']],
+            config_params = config_params, config_keys = scoring_config_keys)
+    run_step('generating z-score matrix for all lanes',
+            os.path.join(os.path.dirname(output_file), 'counts_to_zscores.manifest.json'),
+            manifest, [output_file], force,
+            counts_to_zscores.main, config_file, 'all_lanes_filtered')
+
+def get_tasks(config_file, config_params, sample_table, lane_ids, start, stop, force):
+    '''
+    Builds the task graph (see task_graph.run_task_graph) for steps "start"
+    through "stop". A lane's z-scores only depend on its own count matrix, so
+    lanes move through steps 1 and 2 independently of each other. The lanes
+    are listed in order, so with fewer cores than lanes the earlier lanes are
+    finished first.
+    '''
+    all_tasks = []
+    for lane_id in lane_ids:
+        all_tasks.append([(1, lane_id), [], count_lane, (config_file, config_params, sample_table, lane_id, force)])
+        all_tasks.append([(2, lane_id), [(1, lane_id)], score_lane, (config_file, config_params, sample_table, lane_id, force)])
+    all_tasks.append([(3, None), [(2, x) for x in lane_ids], correlate_index_tags, (config_file, config_params, lane_ids, force)])
+    all_tasks.append([(4, None), [(1, x) for x in lane_ids], merge_lanes, (config_file, config_params, lane_ids, force)])
+    all_tasks.append([(5, None), [(3, None), (4, None)], filter_merged, (config_file, config_params, force)])
+    all_tasks.append([(6, None), [(5, None)], score_filtered, (config_file, config_params, force)])
+
+    # Steps outside of the range are left out, and the graph treats
+    # dependencies on them as already done
+    return [x for x in all_tasks if start <= x[0][0] <= stop]
+
+def main(config_file, start, stop, force = False):
 
     print 'start: {}'.format(start)
     print 'stop: {}'.format(stop)
@@ -94,74 +240,41 @@ def main(config_file, start, stop):
     ## Or, if you were silly and ran all lanes but the newest 4, add this in
     #lane_ids = ['lane51', 'lane52', 'lane53', 'lane54']
 
-    # First, get one strain X condition count matrix per lane
-    # This only needs to be run once, unless the barcodes
-    # or index tags change for some reason.
-    if start <= 1:
-        for lane_id in lane_ids:
-            print 'generating read count matrix for lane {}...'.format(lane_id)
-            start_time = time.time()
-            raw_fastq_to_count_matrix.main(config_file, lane_id)
-            end_time = time.time()
-            print 'time to process = {}'.format(time.strftime('%H:%M:%S', time.gmtime(end_time - start_time)))
-
-    if stop == 1:
-        return None
-    #    
-    # An initial round of cg interaction scoring is performed
-    # at the lane level, 
-    if start <= 2:
-        for lane_id in lane_ids:    
-            print 'generating z-score matrix for lane {}...'.format(lane_id)
-            start_time = time.time()
-            counts_to_zscores.main(config_file, lane_id)
-            end_time = time.time()
-            print 'time to process = {}'.format(time.strftime('%H:%M:%S', time.gmtime(end_time - start_time)))
-
-    if stop == 2:
-        return None
-
-    # Calculate index tag (condition) correlations on
-    # the DMSO profiles, for removal in the matrix
-    # filtering step
-    if start <= 3:
-        print 'computing index tag correlations...'
-        mtag_correlations.main(config_file)
-
-    if stop == 3:
-        return None
-
-    # Merge all of the count matrices into one big count matrix
-    if start <= 4:
-        print 'merging count matrices...'
-        merge_count_matrices.main(config_file)
-
-    if stop == 4:
-        return None
-
-    # Filter out all of the strains and conditions with the following issues:
-    # 1) They were flagged to be excluded a priori
-    # 2) For conditions: if their associated index tag was too self-correlated
-    #    in the control conditions
-    # 3) If the strains or conditions did not meet the count degree thresholds
-    #    specified in the config file (advanced options)
-    if start <= 5:
-        print 'filtering the final count matrix...'
-        filter_final_count_matrix.main(config_file)
-
-    if stop == 5:
-        return None
-
-    # Calculate chemical-genetic interaction z-scores on the entire dataset
-    if start <= 6:
-        print 'generating z-score matrix for all lanes'
-        start = time.time()
-        counts_to_zscores.main(config_file, 'all_lanes_filtered')
-        end = time.time()
-        print 'time to process = {}'.format(time.strftime('%H:%M:%S', time.gmtime(end - start)))
-
-    if stop == 6:
-        return None
+    # Every step records a manifest of its inputs next to its outputs, and
+    # is skipped on reruns if neither has changed (unless "force" is set).
+    # So adding lanes to a screen only processes the new lanes, plus the
+    # steps that combine all lanes.
+    #
+    # The steps are:
+    # 1) Get one strain X condition count matrix per lane. This only needs
+    #    to be run once, unless the barcodes or index tags change for some
+    #    reason.
+    # 2) An initial round of cg interaction scoring at the lane level
+    # 3) Calculate index tag (condition) correlations on the DMSO profiles,
+    #    for removal in the matrix filtering step
+    # 4) Merge all of the count matrices into one big count matrix
+    # 5) Filter out all of the strains and conditions with the following issues:
+    #    a) They were flagged to be excluded a priori
+    #    b) For conditions: if their associated index tag was too self-correlated
+    #       in the control conditions
+    #    c) If the strains or conditions did not meet the count degree thresholds
+    #       specified in the config file (advanced options)
+    # 6) Calculate chemical-genetic interaction z-scores on the entire dataset
+    #
+    # Each step starts as soon as the steps it needs are done, and lanes are
+    # processed in parallel, with up to "num_cores" steps running at once.
+    tasks = get_tasks(config_file, config_params, sample_table, lane_ids, start, stop, force)
+    num_cores = get_num_cores(config_params)
+    start_time = time.time()
+    timings = run_task_graph(tasks, num_cores)
+    end_time = time.time()
+
+    print '\nTime per step:'
+    for task_id, run_time in timings:
+        print '{}: {}'.format(format_task_id(task_id), time.strftime('%H:%M:%S', time.gmtime(run_time)))
+    print 'total time = {}'.format(time.strftime('%H:%M:%S', time.gmtime(end_time - start_time)))
+
+    return None
 
 if __name__ == '__main__':
-    main(args.config_file, args.start, args.stop)
+    main(args.config_file, args.start, args.stop, args.force)
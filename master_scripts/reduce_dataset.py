@@ -22,7 +22,10 @@ barseq_path = os.getenv('BARSEQ_PATH')
 assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
 sys.path.append(os.path.join(barseq_path, 'lib'))
 from cg_common_functions import read_sample_table, read_barcode_table, bool_dict
+from dataset_index import ConditionIndex, StrainIndex, get_condition_ids, index_sample_table, index_barcode_table
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists, dataset_formats
 
 #def read_sample_table(tab_filename):
 #
@@ -34,27 +37,19 @@ from version_printing import update_version_file
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def filter_strain_table(strain_table, final_strains):
     all_strains = np.array(strain_table['Strain_ID'])
-    rows_to_keep = [i for i, val in enumerate(all_strains) if val in all_strains]
+    rows_to_keep = StrainIndex(final_strains).find(all_strains)
     return strain_table.iloc[rows_to_keep]
 
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     #print final_conditions
     #print all_conditions
     #print rows_to_keep
@@ -66,12 +61,10 @@ def filter_dataset(dataset, info_table, dim):
     strains, conditions, matrix = dataset
 
     if dim == 'strains':
-        reduced_strains = np.array(info_table['Strain_ID'])
-        matrix_strains_to_keep = np.array([i for i, val in enumerate(strains) if val in reduced_strains])
+        matrix_strains_to_keep = index_barcode_table(info_table).find(strains)
         return [strains[matrix_strains_to_keep], conditions, matrix[matrix_strains_to_keep, :]]
     elif dim == 'conditions':
-        reduced_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in info_table.iterrows()])
-        matrix_conds_to_keep = np.array([i for i, val in enumerate(conditions) if a_is_row_in_b(val, reduced_conditions)])
+        matrix_conds_to_keep = index_sample_table(info_table).find(conditions)
         return [strains, conditions[matrix_conds_to_keep], matrix[:, matrix_conds_to_keep]]
     else:
         assert False, '"dim" argument must be either "strains" or "conditions."'
@@ -96,11 +89,7 @@ def filter_info_table_on_column(info_table, column, invert):
 #
 #    return matrix_conditions[matrix_conds_to_keep], matrix[:, matrix_conds_to_keep]
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
-def main(dataset, info_table, dim, filename, col, inv, verbosity):
+def main(dataset, info_table, dim, filename, col, inv, verbosity, dataset_format = 'pickle'):
 
     strains, conditions, matrix = dataset
 
@@ -124,7 +113,7 @@ def main(dataset, info_table, dim, filename, col, inv, verbosity):
     #    print reduced_conditions.shape
     #    print reduced_matrix.shape
 
-    dump_dataset(reduced_dataset, filename)
+    dump_dataset(reduced_dataset, filename, dataset_format)
     
     update_version_file(os.path.dirname(os.path.abspath(filename)), VERSION)
 
@@ -139,13 +128,14 @@ if __name__ == '__main__':
     parser.add_argument('--strains', action = 'store_true', help = 'By default, filtering is performed on the condition side of the dataset (columns). Use this flag to filter the strain side of the dataset')
     parser.add_argument('--column', help = 'As an alternative to using a slimmed-down info table to reduce the dataset, only retain strains/conditions for which the value in this info table column is True')
     parser.add_argument('--invert', action = 'store_true', help = 'If --column is specified, invert the True/False values')    
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the reduced dataset is written.')
     parser.add_argument('-v', '--verbosity', default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
 
     if args.verbosity >= 2:
@@ -175,5 +165,5 @@ if __name__ == '__main__':
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
-    main(dataset, info_table, dim, args.output_file, args.column, args.invert, args.verbosity)
+    main(dataset, info_table, dim, args.output_file, args.column, args.invert, args.verbosity, args.dataset_format)
 
@@ -71,9 +71,11 @@ loc_list_noconfig = ['output_folder', 'lane_location_file', 'sample_table_file',
 raw_dat_list = ['num_lanes']
 sample_tab_list = ['new_sample_table', 'screen_name', 'plate_size', 'plates_per_lane', 'extra_columns']
 bas_list = ['verbosity', 'sub_screen_column']
-adv_list = ['num_cores', 'remove_barcode_specific_conditions', 'barcode_specific_template_correlation_cutoff',
+adv_list = ['num_cores', 'fastq_chunk_size', 'parse_block_size', 'preview_reads', 'preview_fraction', 'sparse_count_array', 'correction_cache_folder', 'correction_cache_size', 'dataset_format',
+        'remove_barcode_specific_conditions', 'barcode_specific_template_correlation_cutoff',
         'remove_correlated_index_tags', 'index_tag_correlation_cutoff', 'common_primer_tolerance', 'index_tag_tolerance',
-        'barcode_tolerance', 'control_detection_limit', 'sample_detection_limit', 'strain_pass_read_count',
+        'barcode_tolerance', 'control_detection_limit', 'sample_detection_limit', 'lowess_method',
+        'normalization_lowess_delta', 'sigma_lowess_delta', 'strain_pass_read_count',
         'strain_pass_fraction', 'condition_pass_read_count', 'condition_pass_fraction']
 
 def add_arg(pr, p_obj):
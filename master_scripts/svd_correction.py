@@ -18,6 +18,7 @@ VERSION='2.6.1'
 import pandas as pd
 import numpy as np
 import scipy
+from scipy.sparse.linalg import svds
 import sys, os, gzip
 import matplotlib
 matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
@@ -33,7 +34,11 @@ sys.path.append(os.path.join(barseq_path, 'lib'))
 import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 from cg_common_functions import read_sample_table, bool_dict
+from dataset_index import ConditionIndex, get_condition_ids
+from stacked_dataset import LowRankStack
 from version_printing import update_version_file
+import dataset_io
+from dataset_io import dump_dataset, dataset_exists, dataset_formats
 
 #def read_sample_table(tab_filename):
 #
@@ -45,18 +50,10 @@ from version_printing import update_version_file
 
 def load_dataset(data_filename):
 
-    f = gzip.open(data_filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = dataset_io.load_dataset(data_filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def write_corrected_data_info(dataset_3d, batch_col, nondup_col_list, filename, input_filename):
 
     f = open(filename, 'wt')
@@ -67,18 +64,14 @@ def write_corrected_data_info(dataset_3d, batch_col, nondup_col_list, filename,
 
 def filter_sample_table(sample_table, final_conditions):
 
-    all_conditions = np.array([tuple(row[['screen_name', 'expt_id']]) for i,row in sample_table.iterrows()])
-    rows_to_keep = [i for i, val in enumerate(all_conditions) if a_is_row_in_b(val, final_conditions)]
+    all_conditions = get_condition_ids(sample_table)
+    rows_to_keep = ConditionIndex(final_conditions).find(all_conditions)
     #print final_conditions
     #print all_conditions
     #print rows_to_keep
     
     return sample_table.iloc[rows_to_keep]
 
-def a_is_row_in_b(a, b):
-      
-    return np.any(np.all(a == b, axis = 1))
-
 def get_include_col_conditions(sample_table, include_col):
 
     # Allow a leading exclamation point to negate a column. Default is false
@@ -98,7 +91,7 @@ def get_include_col_conditions(sample_table, include_col):
 
 def filter_dataset_by_conditions(conditions, matrix, conds_to_keep):
     
-    inds_to_keep = np.array([i for i, val in enumerate(conditions) if a_is_row_in_b(val, conds_to_keep)])
+    inds_to_keep = ConditionIndex(conds_to_keep).find(conditions)
     filtered_conditions = conditions[inds_to_keep]
     filtered_matrix = matrix[:, inds_to_keep]
 
@@ -118,13 +111,86 @@ def get_svd_components_filename(output_folder):
 def get_corrected_data_info_filename(output_folder):
     return os.path.join(output_folder, 'batch_corrected_datasets_info.txt')
 
-def svd_correction(matrix, filtered_matrix, n, verbosity):
+def get_randomized_svd(matrix, k, oversamples = 20, power_iterations = 7, seed = 0):
+    '''
+    Computes the top k singular vectors and values of the matrix with a
+    randomized range finder: the matrix's range is sampled with a few more
+    random vectors than needed, sharpened with power iterations, and the
+    SVD is computed in that small subspace.
+    '''
+    random_state = np.random.RandomState(seed)
+    l = min(k + oversamples, min(matrix.shape))
+    Q, R = np.linalg.qr(np.dot(matrix, random_state.normal(size = (matrix.shape[1], l))))
+    for i in range(power_iterations):
+        Z, R = np.linalg.qr(np.dot(matrix.T, Q))
+        Q, R = np.linalg.qr(np.dot(matrix, Z))
+    U_small, s, V = np.linalg.svd(np.dot(Q.T, matrix), full_matrices = False)
+
+    return np.dot(Q, U_small[:, :k]), s[:k], V[:k]
+
+def get_top_svd_components(matrix, k, method, verbosity):
+    '''
+    Returns the top k singular vectors and values of the matrix (U, s, V,
+    largest first). "lanczos" uses ARPACK (scipy.sparse.linalg.svds) and
+    "randomized" a randomized range finder, both of which compute only
+    those k components. "exact" computes the full SVD with numpy.
+    '''
+    assert k <= min(matrix.shape), 'Cannot remove more SVD components ({}) than the smaller dimension of the matrix ({})'.format(k, min(matrix.shape))
+    # ARPACK can only compute fewer components than the smaller dimension
+    if method == 'lanczos' and k >= min(matrix.shape) - 1:
+        if verbosity >= 2:
+            print 'Too many components for the Lanczos solver, computing the full SVD'
+        method = 'exact'
+
+    if method == 'lanczos':
+        # A fixed starting vector makes the results reproducible
+        v0 = np.random.RandomState(0).uniform(-1, 1, min(matrix.shape))
+        U, s, V = svds(matrix, k = k, tol = 0, v0 = v0)
+        order = np.argsort(-s)
+        U, s, V = U[:, order], s[order], V[order]
+    elif method == 'randomized':
+        U, s, V = get_randomized_svd(matrix, k)
+    elif method == 'exact':
+        U, s, V = np.linalg.svd(matrix, full_matrices = False)
+        U, s, V = U[:, :k], s[:k], V[:k]
+    else:
+        assert False, 'Unknown SVD method: {}'.format(method)
+
+    return U, s, V
+
+def get_sign_multipliers(U, s, V, mat):
+    '''
+    Checks that each component's contributions to the conditions (the
+    projection of the matrix onto its left singular vector) match its
+    singular value times its right singular vector, and returns the sign
+    (1 or -1) that makes them match.
+    '''
+    contributions = np.dot(U.T, mat)
+    sign_multipliers = []
+    for i in range(len(s)):
+        if np.allclose(s[i] * V[i], contributions[i]):
+            sign_multipliers.append(1)
+        elif np.allclose(s[i] * V[i], -contributions[i]):
+            sign_multipliers.append(-1)
+        else:
+            assert False, "SVD not computed properly"
+
+    return np.array(sign_multipliers)
+
+svd_methods = ['lanczos', 'randomized', 'exact']
+
+def svd_correction(matrix, filtered_matrix, n, verbosity, method = 'lanczos'):
     '''
     Computes the SVD on a subset of matrix (filtered_matrix),
     and successively removes SVD components from the full matrix.
-
-    Returns a stack of matrices, each of which has from 0 to n
-    SVD components removed
+    Only the top n+1 components are computed, unless method is "exact"
+    (see get_top_svd_components).
+
+    Returns the numbers of components removed (0 to n), a stack of
+    matrices with that many SVD components removed, and a stack of the
+    components themselves (the n+1th component for each layer). Both
+    stacks are LowRankStacks, which hold only the components and their
+    contributions to each condition.
     '''
 
     # This is somewhat of a hack, since the pipeline should not be generating
@@ -150,8 +216,9 @@ def svd_correction(matrix, filtered_matrix, n, verbosity):
         print 'Number of nans in filtered matrix, after setting nans to zero:', np.sum(np.isnan(filtered_matrix))
         print 'Number of nans in full matrix, after setting nans to zero:', np.sum(np.isnan(matrix))
 
-    # Get the SVD of the filtered matrix
-    U, s, V = np.linalg.svd(filtered_matrix, full_matrices = False)
+    # Get the top n+1 components of the SVD of the filtered matrix (layer n
+    # of the components stack is the n+1th component)
+    U, s, V = get_top_svd_components(filtered_matrix, n + 1, method, verbosity)
     if verbosity >= 3:
         print 'Number of nans in U matrix:', np.sum(np.isnan(U))
         print 'Unique (row, column) nan locations in U matrix:', (np.unique(np.where(np.isnan(U))[0]), np.unique(np.where(np.isnan(U))[1]))
@@ -159,51 +226,43 @@ def svd_correction(matrix, filtered_matrix, n, verbosity):
         print 'Number of nans in V matrix:', np.sum(np.isnan(V))
         print 'Unique (row, column) nan locations in V matrix:', (np.unique(np.where(np.isnan(V))[0]), np.unique(np.where(np.isnan(V))[1]))
 
-    # Loop through the individual components to remove and ensure
-    # that the singular vectors have the right sign. (there is no
-    # guarantee that the singular vectors have the correct sign)
-    # the correct sign is ensured by creating a vector of "multipliers"
-    # that are either 1 or -1.
-    sign_multipliers = [1]
-    # This loop goes from 0 to n-1, because that is how the components are
-    # indexed in the numpy arrays
-    for i in range(n):
-        comp_mat_UsV = get_one_component_via_UsV(U, s, V, i, verbosity)
-        comp_mat_proj = get_one_component_via_proj(U, filtered_matrix, i, verbosity)
-        if np.allclose(comp_mat_UsV, comp_mat_proj):
-            sign_multipliers.append(1)
-        elif np.allclose(comp_mat_UsV, -comp_mat_proj):
-            sign_multipliers.append(-1)
-        else:
-            assert False, "SVD not computed properly"
-
-    # Set up the list that will contain the corrected matrices
-    corrected_mats = []
-    sign_multipliers = np.array(sign_multipliers)
-    
-    # Create a list of each component that is successively removed from the matrix
-    removed_component_matrices = []
-
-    # Successively remove component and put the results in
-    # the corrected mats list
-    components_removed = []
-    for i in range(n + 1):
-        if verbosity >= 2:
-            print 'Removing {} components...'.format(i)
-        components_removed.append(i)
-        multipliers = sign_multipliers[0:i]
-        if verbosity >= 3:
-            print 'Number of nans in full matrix immediately before component removal:', np.sum(np.isnan(matrix))
-        corrected_mat = remove_n_components(matrix, U, i, multipliers, verbosity)
-        if verbosity >= 3:
-            print 'Number of nans in component-removed matrix (before adding nans back in):', np.sum(np.isnan(corrected_mat))
-            print 'Unique (row, column) nan locations in component-removed matrix:', (np.unique(np.where(np.isnan(corrected_mat))[0]), np.unique(np.where(np.isnan(corrected_mat))[1]))
-        # Add nans back in at their original positions
-        corrected_mat[full_matrix_nan_idx] = np.nan
-        corrected_mats.append(corrected_mat)
-        removed_component_matrices.append(get_n_plus_oneth_component(matrix, U, i, sign_multipliers[i], verbosity))
-
-    return [np.array(components_removed), np.array(corrected_mats), np.array(removed_component_matrices)]
+    # Ensure that the singular vectors have the right sign (there is no
+    # guarantee that the singular vectors have the correct sign), using a
+    # vector of "multipliers" that are either 1 or -1. With the exact SVD,
+    # this is checked on each component's full matrix, and otherwise on
+    # the singular vectors alone.
+    if method == 'exact':
+        sign_multipliers = []
+        for i in range(n + 1):
+            comp_mat_UsV = get_one_component_via_UsV(U, s, V, i, verbosity)
+            comp_mat_proj = get_one_component_via_proj(U, filtered_matrix, i, verbosity)
+            if np.allclose(comp_mat_UsV, comp_mat_proj):
+                sign_multipliers.append(1)
+            elif np.allclose(comp_mat_UsV, -comp_mat_proj):
+                sign_multipliers.append(-1)
+            else:
+                assert False, "SVD not computed properly"
+        sign_multipliers = np.array(sign_multipliers)
+    else:
+        sign_multipliers = get_sign_multipliers(U, s, V, filtered_matrix)
+
+    # Layer i of the corrected stack has the first i components removed,
+    # and layer i of the components stack is component i (the next one
+    # that would be removed). The components' contributions are computed
+    # from the full matrix, with its nans set to zero (the corrected
+    # matrices get their nans back at their original positions).
+    components_removed = np.arange(n + 1)
+    vectors = U * sign_multipliers
+    contributions = np.dot(vectors.T, matrix)
+    if verbosity >= 3:
+        print 'Number of nans in component vectors:', np.sum(np.isnan(vectors))
+        print 'Number of nans in component contributions:', np.sum(np.isnan(contributions))
+    base = matrix.copy()
+    base[full_matrix_nan_idx] = np.nan
+    corrected_mats = LowRankStack(base, vectors, contributions, components_removed)
+    removed_component_matrices = LowRankStack(None, vectors, contributions, components_removed, kind = 'components')
+
+    return [components_removed, corrected_mats, removed_component_matrices]
        
 def get_one_component_via_UsV(U, s, V, n, verbosity):
 
@@ -243,72 +302,7 @@ def get_one_component_via_proj(U, mat, n, verbosity):
 
     return np.multiply(component_n_col, contribution_row)
 
-def remove_n_components(mat, U, n, mults, verbosity):
-
-    if n == 0:
-        return mat.copy()
-    else:
-        components_n = U[:, 0:n]
-        components_n_cols = np.reshape(components_n, (-1, n))
-        if verbosity >= 2:
-            print components_n
-            print components_n.shape
-            print components_n_cols
-            print components_n_cols.shape
-        # correct the signs (should test if this actually matters...oh well it is good and safe)
-        components_n_cols = mults * components_n_cols
-        if verbosity >= 2:
-            print components_n_cols
-            print components_n_cols.shape
-    
-        if verbosity >= 3:
-            print 'Number of nans in n+1th component vector:', np.sum(np.isnan(components_n_cols))
-            print 'Number of nans in matrix:', np.sum(np.isnan(mat))
-        
-        contribution = np.dot(components_n_cols.T, mat)
-        contribution_rows = np.reshape(contribution, (n, -1))
-        if verbosity >= 2:
-            print contribution
-            print contribution.shape
-            print contribution_rows
-            print contribution_rows.shape
-        
-        mat_to_remove = np.dot(components_n_cols, contribution_rows)
-        
-        return mat - mat_to_remove
-
-def get_n_plus_oneth_component(mat, U, n, mults, verbosity):
-
-    components_n = U[:, n]
-    components_n_cols = np.reshape(components_n, (-1, 1))
-    if verbosity >= 2:
-        print components_n
-        print components_n.shape
-        print components_n_cols
-        print components_n_cols.shape
-    # correct the signs (should test if this actually matters...oh well it is good and safe)
-    components_n_cols = mults * components_n_cols
-    if verbosity >= 2:
-        print components_n_cols
-        print components_n_cols.shape
-
-    if verbosity >= 3:
-        print 'Number of nans in n+1th component vector:', np.sum(np.isnan(components_n_cols))
-        print 'Number of nans in matrix:', np.sum(np.isnan(mat))
-    
-    contribution = np.dot(components_n_cols.T, mat)
-    contribution_rows = np.reshape(contribution, (1, -1))
-    if verbosity >= 2:
-        print contribution
-        print contribution.shape
-        print contribution_rows
-        print contribution_rows.shape
-    
-    mat_to_remove = np.dot(components_n_cols, contribution_rows)
-    
-    return mat_to_remove
-
-def main(dataset, sample_table, max_comps, include_column, output_folder, input_file, verbosity):
+def main(dataset, sample_table, max_comps, include_column, output_folder, input_file, verbosity, dataset_format = 'pickle', svd_method = 'lanczos'):
 
     barcodes, conditions, matrix = dataset
     # If an include column was specified:
@@ -347,7 +341,7 @@ def main(dataset, sample_table, max_comps, include_column, output_folder, input_
     # Remove 0 components up to and including the max number of comps specified by the user
     if verbosity >= 1:
         print "Performing SVD correction and removing up to and including {} components".format(max_comps_remove)
-    components_removed, all_svd_matrices, removed_component_matrices = svd_correction(matrix, filtered_matrix, max_comps, verbosity)
+    components_removed, all_svd_matrices, removed_component_matrices = svd_correction(matrix, filtered_matrix, max_comps_remove, verbosity, svd_method)
 
     # Put all the pieces of data together
     corrected_3d_dataset = [components_removed, barcodes, conditions, all_svd_matrices]
@@ -356,8 +350,8 @@ def main(dataset, sample_table, max_comps, include_column, output_folder, input_
     # Write out the 3-d array with different LDA components removed
     corrected_data_filename = get_corrected_data_filename(output_folder)
     svd_components_filename = get_svd_components_filename(output_folder)
-    dump_dataset(corrected_3d_dataset, corrected_data_filename)
-    dump_dataset(components_3d_dataset, svd_components_filename)
+    dump_dataset(corrected_3d_dataset, corrected_data_filename, dataset_format)
+    dump_dataset(components_3d_dataset, svd_components_filename, dataset_format)
 
     # Don't think I need to write SVD info to file...there's not much to write except which samples were used,
     # which is in the sample info table and the script!
@@ -378,13 +372,15 @@ if __name__ == '__main__':
     parser.add_argument('max_components', type = int, help = 'The maximum number of SVD components to remove.')
     parser.add_argument('output_folder', help = 'The folder to which results are exported.')
     parser.add_argument('-incl', '--include_column', help = 'Column in the sample table that specifies True/False whether or not the condition in that row should be used when computing the SVD components to remove. If it starts with an exclamation point, then the values in the column are negated first.')
+    parser.add_argument('--svd_method', choices = svd_methods, default = 'lanczos', help = 'How the SVD components are computed. "lanczos" (ARPACK) and "randomized" (a randomized range finder) only compute the components that are removed. "exact" computes the full SVD, and can be used to validate the others.')
+    parser.add_argument('--dataset_format', choices = dataset_formats, default = 'pickle', help = 'The format in which the corrected datasets and removed components are written.')
     parser.add_argument('-v', '--verbosity', type = int, default = 1, help = 'The level of verbosity printed to stdout. Ranges from 0 to 3, 1 is default.')
 
     args = parser.parse_args()
 
     # Get the data ready to rumble!
     dataset_file = os.path.abspath(args.dataset_file)
-    assert os.path.isfile(dataset_file), "Dataset file does not exist."
+    assert dataset_exists(dataset_file), "Dataset file does not exist."
     dataset = load_dataset(args.dataset_file)
 
     assert os.path.isfile(args.sample_table), "Sample table file does not exist."
@@ -400,4 +396,4 @@ if __name__ == '__main__':
     else:
         include_column = None
 
-    main(dataset, sample_table, args.max_components, include_column, output_folder, dataset_file, args.verbosity)
+    main(dataset, sample_table, args.max_components, include_column, output_folder, dataset_file, args.verbosity, args.dataset_format, args.svd_method)
@@ -31,6 +31,7 @@ import cg_file_tools as cg_file
 import cluster_dataset_wrappers as clus_wrap
 from cg_common_functions import get_temp_clustergram_name, read_sample_table, read_barcode_table
 from version_printing import update_version_file
+from dataset_io import load_dataset
 
 import argparse
 
@@ -57,16 +58,12 @@ args = parser.parse_args()
 
 # Load in dataset
 dataset_filename = os.path.abspath(args.dataset_file)
-dataset_f = gzip.open(dataset_filename)
-dataset = cPickle.load(dataset_f)
-dataset_f.close()
+dataset = load_dataset(dataset_filename)
 
 # If there is a new_matrix, specified, load that as well!
 if args.new_dataset is not None:
     new_dataset_filename = os.path.abspath(args.new_dataset)
-    new_dataset_f = gzip.open(new_dataset_filename)
-    new_dataset = cPickle.load(new_dataset_f)
-    new_dataset_f.close()
+    new_dataset = load_dataset(new_dataset_filename)
 else:
     new_dataset = None
 
@@ -29,9 +29,11 @@ import cg_file_tools as cg_file
 from cg_common_functions import get_verbosity, get_barcode_table, get_sample_table, get_num_cores, parse_yaml, bool_dict
 from version_printing import update_version_file
 from cluster_dataset_wrappers import customize_strains, customize_conditions
-from lowess import py_lowess
-from contextlib import closing
-from multiprocessing import Pool
+from lowess import py_lowess, py_lowess_multi, py_lowess_grouped, delta_accuracy_report
+from shared_arrays import SharedArray, get_worker_pool
+from task_graph import run_task_graph
+from dataset_index import ConditionIndex, index_sample_table
+from dataset_io import load_dataset, dump_dataset, get_dataset_format
 
 def get_lane_data_path(config_params, lane_id):
 
@@ -58,32 +60,19 @@ def get_dumped_count_matrix_filename(config_params, lane_id):
 def load_dumped_count_matrix(config_params, lane_id):
 
     filename = get_dumped_count_matrix_filename(config_params, lane_id)
-    f = gzip.open(filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = load_dataset(filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
 
     return dataset
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-    
 def filter_dataset_for_include(dataset, sample_table, config_params):
     
     [barcode_gene_ids, condition_ids, matrix] = dataset
 
-    include_bool_ind = np.array([bool_dict[x] for x in sample_table['include?']])
-    include_table = sample_table[include_bool_ind]
-    include_screen_names = include_table['screen_name']
-    include_expt_ids = include_table['expt_id']
-    include_condition_ids = np.array(list(it.izip(include_screen_names, include_expt_ids)))
-
-    include_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, include_condition_ids)])
+    include_condition_indices = np.flatnonzero(index_sample_table(sample_table).get_flags('include?', condition_ids))
     
     if get_verbosity(config_params) >= 2:
         print condition_ids
-        print include_condition_ids
         print include_condition_indices
     filtered_condition_ids = condition_ids[include_condition_indices]
     filtered_matrix = matrix[:, include_condition_indices]
@@ -94,15 +83,7 @@ def get_control_condition_ids(dataset, sample_table):
     
     [barcode_gene_ids, condition_ids, matrix] = dataset
    
-    control_bool_ind = np.array([bool_dict[x] for x in sample_table['control?']])
-    control_table = sample_table[control_bool_ind]
-    control_screen_names = control_table['screen_name']
-    control_expt_ids = control_table['expt_id']
-    control_condition_ids = np.array(list(it.izip(control_screen_names, control_expt_ids)))
-    
-    # Adding the dtype allows for empty arrays (aka no control conditions), as the default numpy
-    # array dtype for an empty array is np.float64, which cannot be used to index another array.
-    control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)], dtype = np.int)
+    control_condition_indices = np.flatnonzero(index_sample_table(sample_table).get_flags('control?', condition_ids))
     final_control_condition_ids = condition_ids[control_condition_indices]
 
     return final_control_condition_ids
@@ -116,18 +97,14 @@ def get_control_dataset(count_dataset, control_condition_ids, control_detection_
     else:
         matrix = count_matrix
 
-    #control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)])
-    control_condition_indices = []
+    control_condition_indices = ConditionIndex(control_condition_ids).find(condition_ids)
     # Get the ids of the conditions for which >= 75% of the profile is above
     # the control count threshold. This percentage could be changed to a
     # parameter in the future, but this is a relatively rare corner case that
     # only occurs in per-lane scoring when all controls in that lane are of low
     # counts/quality.
-    for i, cond_id in enumerate(condition_ids):
-        if a_is_row_in_b(cond_id, control_condition_ids):
-            if np.nanmean(count_matrix[:, i] >= control_detection_limit) >= 0.75:
-                control_condition_indices.append(i)
-    control_condition_indices = np.array(control_condition_indices)
+    above_limit = np.mean(count_matrix[:, control_condition_indices] >= control_detection_limit, axis = 0)
+    control_condition_indices = control_condition_indices[above_limit >= 0.75]
 
     # If there are less than two control profiles in the data, or if this many
     # are left after the above quality filtering, then return the entire
@@ -145,7 +122,37 @@ def get_control_dataset(count_dataset, control_condition_ids, control_detection_
 def wellbehaved(xx):
     return ( np.invert( np.isinf(xx) ) ) & ( np.invert( np.isnan(xx) ) )
 
-def smooth(xx, yy):
+def get_lowess_method(config_params):
+
+    return config_params.get('lowess_method', 'vectorized')
+
+def get_lowess_deltas(config_params):
+    '''
+    Returns the "delta" used for the LOWESS fits in the normalization and
+    sigma (variance) stages, as fractions of the range of x.
+    '''
+    normalization_delta = float(config_params.get('normalization_lowess_delta', 0))
+    sigma_delta = float(config_params.get('sigma_lowess_delta', 0))
+    assert 0 <= normalization_delta < 1 and 0 <= sigma_delta < 1, '"normalization_lowess_delta" and "sigma_lowess_delta" must be at least 0 and less than 1.'
+
+    return normalization_delta, sigma_delta
+
+def get_interp_delta(x, delta_fraction):
+    '''
+    Converts a delta given as a fraction of the range of x into units of x.
+    '''
+    if delta_fraction <= 0 or len(x) == 0:
+        return 0
+    return delta_fraction * (np.max(x) - np.min(x))
+
+def print_delta_accuracy_report(stage, delta_fraction, approx, exact):
+
+    report = delta_accuracy_report(approx, exact)
+    print 'LOWESS {} with delta = {} x range, compared to the exact fit:'.format(stage, delta_fraction)
+    for key in ['max_abs_error', 'mean_abs_error', 'max_rel_error']:
+        print '\t{}: {}'.format(key, report[key])
+
+def smooth(xx, yy, method = 'vectorized', delta_fraction = 0):
     k = wellbehaved(xx) & wellbehaved(yy)
     yy_normalized = np.zeros(xx.shape) + np.nan
     if np.sum(yy[k]) == 0:
@@ -154,40 +161,96 @@ def smooth(xx, yy):
     # parallelization. If anything, this function should be called in parallel
     # instead. Setting num_cores to 1 just uses python's builtin `map` instead
     # of using multiprocessing with one core.
-    lowess_line = py_lowess(xx[k], yy[k], f = 0.3, iter = 5, num_cores = 1)
+    lowess_line = py_lowess(xx[k], yy[k], f = 0.3, iter = 5, num_cores = 1, method = method,
+            interp_delta = get_interp_delta(xx[k], delta_fraction))
     if np.sum(lowess_line) == 0:
         return yy_normalized
     yy_normalized[k] = xx[k] * yy[k] / lowess_line
     return yy_normalized
 
-def normalize_one_profile(j):
-    global matrix_
-    global mean_control_profile_
-    global sample_detection_limit_
-    #print j
-    y = matrix_[:, j]
-    y[y < sample_detection_limit_] = sample_detection_limit_
+def smooth_matrix(xx, yy_matrix, method = 'vectorized', delta_fraction = 0):
+    '''
+    Same as calling smooth(xx, yy) on each column of yy_matrix. All columns
+    that are well-behaved wherever xx is share the same x values, so they
+    are smoothed together (unless method is "reference").
+    '''
+    k = wellbehaved(xx)
+    normalized = np.zeros(yy_matrix.shape) + np.nan
+    shared = np.all(wellbehaved(yy_matrix[k]), axis = 0)
+    if method == 'reference':
+        shared[:] = False
+    for j in np.flatnonzero(~shared):
+        normalized[:, j] = smooth(xx, yy_matrix[:, j], method, delta_fraction)
+    cols = np.flatnonzero(shared & (np.sum(yy_matrix[k], axis = 0) != 0))
+    if len(cols) == 0 or np.sum(k) == 0:
+        return normalized
+    yy = yy_matrix[k][:, cols]
+    lowess_lines = py_lowess_multi(xx[k], yy, f = 0.3, iter = 5, interp_delta = get_interp_delta(xx[k], delta_fraction))
+    nonzero = np.sum(lowess_lines, axis = 0) != 0
+    normalized[np.ix_(k, cols[nonzero])] = xx[k][:, None] * yy[:, nonzero] / lowess_lines[:, nonzero]
+    return normalized
+
+def normalize_profiles(matrix, mean_control_profile, normalized_matrix, cols, sample_detection_limit, method, delta_fraction):
+    '''
+    Normalizes the columns "cols" of the count matrix and writes them to
+    the same columns of normalized_matrix.
+    '''
+    y = matrix[:, cols]
+    y[y < sample_detection_limit] = sample_detection_limit
     y_log = np.log(y)
-    return smooth(mean_control_profile_, y_log)
+    normalized_matrix[:, cols] = smooth_matrix(mean_control_profile, y_log, method, delta_fraction)
+
+def normalize_shared_profiles(args):
+
+    shared_matrix, shared_mean_control_profile, shared_normalized_matrix = args[0:3]
+    normalize_profiles(shared_matrix.array, shared_mean_control_profile.array, shared_normalized_matrix.array, *args[3:])
+
+def normalize_all_profiles(matrix, mean_control_profile, sample_detection_limit, method, delta_fraction, num_cores):
+    '''
+    Replaces each profile in the matrix with a smoothed profile. The
+    profiles are smoothed in blocks that share the work of the LOWESS fits
+    (see smooth_matrix). With more than one core, the blocks are handed out
+    to the worker pool, which reads the matrix from shared memory and writes
+    the smoothed profiles straight into the shared result.
+    '''
+    if num_cores > 1:
+        col_blocks = np.array_split(np.arange(matrix.shape[1]), min(4 * num_cores, max(matrix.shape[1], 1)))
+        with SharedArray(data = matrix) as shared_matrix, SharedArray(data = mean_control_profile) as shared_mean_control_profile:
+            shared_normalized_matrix = SharedArray(matrix.shape)
+            try:
+                get_worker_pool(num_cores).map(normalize_shared_profiles, [[shared_matrix, shared_mean_control_profile,
+                    shared_normalized_matrix, cols, sample_detection_limit, method, delta_fraction] for cols in col_blocks])
+            finally:
+                normalized_matrix = shared_normalized_matrix.detach()
+    else:
+        normalized_matrix = np.zeros(matrix.shape)
+        normalize_profiles(matrix, mean_control_profile, normalized_matrix, np.arange(matrix.shape[1]),
+                sample_detection_limit, method, delta_fraction)
+
+    return normalized_matrix
 
 def normalizeUsingAllControlsAndSave(config_params, outfolder, dataset, control_condition_ids, lane_id):
-    global matrix_
-    global mean_control_profile_
-    global sample_detection_limit_
 
     barcode_gene_ids, condition_ids, matrix = dataset
     
-    # Make sure the counts are floats for all normalization procedures
-    matrix = matrix.astype(np.float).copy()
+    # Make sure the counts are floats for all normalization procedures. With
+    # more than one core, the float matrix is made in shared memory, so the
+    # worker pool can read it without another copy being made
+    num_cores = get_num_cores(config_params)
+    if num_cores > 1:
+        shared_float_matrix = SharedArray(matrix.shape)
+        shared_float_matrix.array[...] = matrix
+        matrix = shared_float_matrix.array
+    else:
+        shared_float_matrix = None
+        matrix = matrix.astype(np.float)
 
     # Get the detection limits
     sample_detection_limit, control_detection_limit = get_detection_limits(config_params)
     
     # Dump out the raw count matrix before processing
     raw_filename = os.path.join(outfolder, '{}_raw.dump.gz'.format(lane_id))
-    raw_of = gzip.open(raw_filename, 'wb')
-    cPickle.dump(dataset, raw_of)
-    raw_of.close()
+    dump_dataset(dataset, raw_filename, get_dataset_format(config_params))
 
     control_matrix_gene_barcode_ids, control_matrix_condition_ids, control_matrix = get_control_dataset(dataset, control_condition_ids, control_detection_limit)
 
@@ -209,16 +272,18 @@ def normalizeUsingAllControlsAndSave(config_params, outfolder, dataset, control_
     # Replace each profile in the matrix with a smoothed profile
     # In the process, set the counts for any strain under the sample count detection limit
     # to the sample count detection limit. This prevents logging of zero values
-    matrix_ = matrix
-    mean_control_profile_ = mean_control_profile
-    sample_detection_limit_ = sample_detection_limit
-    num_cores = get_num_cores(config_params)
+    lowess_method = get_lowess_method(config_params)
+    normalization_delta, sigma_delta = get_lowess_deltas(config_params)
     #print matrix.shape
-    if num_cores > 1:
-        with closing(Pool(processes = num_cores)) as pool:
-            matrix = np.vstack(pool.map(normalize_one_profile, range(matrix.shape[1]))).T
-    else:
-        matrix = np.vstack(map(normalize_one_profile, range(matrix.shape[1]))).T
+    try:
+        normalized_matrix = normalize_all_profiles(matrix, mean_control_profile, sample_detection_limit, lowess_method, normalization_delta, num_cores)
+        if normalization_delta > 0 and get_verbosity(config_params) >= 2:
+            exact_matrix = normalize_all_profiles(matrix, mean_control_profile, sample_detection_limit, lowess_method, 0, num_cores)
+            print_delta_accuracy_report('normalization', normalization_delta, normalized_matrix, exact_matrix)
+    finally:
+        if shared_float_matrix is not None:
+            shared_float_matrix.close()
+    matrix = normalized_matrix
     #for j in range(matrix.shape[1]):
     #    if get_verbosity(config_params) >= 3:
     #        print j
@@ -232,9 +297,7 @@ def normalizeUsingAllControlsAndSave(config_params, outfolder, dataset, control_
     # Dump out the lowess-normalized matrix
     lowess_dataset = [barcode_gene_ids, condition_ids, matrix]
     lowess_filename = os.path.join(outfolder, '{}_lowess_norm.dump.gz'.format(lane_id))
-    lowess_of = gzip.open(lowess_filename, 'wb')
-    cPickle.dump(lowess_dataset, lowess_of)
-    lowess_of.close()
+    dump_dataset(lowess_dataset, lowess_filename, get_dataset_format(config_params))
 
     return lowess_dataset, mean_control_profile
 
@@ -252,40 +315,61 @@ def deviations_globalmean(config_params, outfolder, lowess_dataset, mean_control
     # Dump out the deviation matrix
     deviation_dataset = [barcode_gene_ids, condition_ids, matrix]
     deviation_filename = os.path.join(outfolder, '{}_deviation.dump.gz'.format(lane_id))
-    deviation_of = gzip.open(deviation_filename, 'wb')
-    cPickle.dump(deviation_dataset, deviation_of)
-    deviation_of.close()
+    dump_dataset(deviation_dataset, deviation_filename, get_dataset_format(config_params))
 
     return deviation_dataset
 
 def getAsymmetricSigmaForScipyMatrix(raw_mean_control_profile, dev_control_matrix, config_params):
-    dev_control_matrix_tall = np.zeros((0, 1))
-    repeated_raw_mean_control_profile = np.zeros((0, 1))
-    raw_mean_control_profile = np.matrix(raw_mean_control_profile).transpose()
-    for i in range(dev_control_matrix.shape[1]):
-        dev_control_matrix_tall = np.vstack((dev_control_matrix_tall, dev_control_matrix[:, [i]]))
-        repeated_raw_mean_control_profile = np.vstack((repeated_raw_mean_control_profile, raw_mean_control_profile))
-    dev_control_matrix_tall = np.array(dev_control_matrix_tall)
+    '''
+    Fits the squared positive and negative deviations of the control
+    profiles against the mean control profile, and returns the square
+    roots of the fits for each strain (negative first), as column vectors.
+    '''
+    raw_mean_control_profile = np.asarray(raw_mean_control_profile, dtype = np.float).ravel()
+    dev_control_matrix = np.asarray(dev_control_matrix, dtype = np.float)
+    num_strains, num_controls = dev_control_matrix.shape
+
+    # One tall vector of all of the control deviations, control by
+    # control, with the mean control profile repeated alongside it
+    dev_control_matrix_tall = dev_control_matrix.T.reshape(-1)
+    repeated_raw_mean_control_profile = np.tile(raw_mean_control_profile, num_controls)
     pos = dev_control_matrix_tall >= 0
     neg = dev_control_matrix_tall < 0
     dev_control_matrix_tall_squared = dev_control_matrix_tall**2
+    if get_verbosity(config_params) >= 3:
+        print dev_control_matrix_tall[pos],  dev_control_matrix_tall_squared[pos]
+        print dev_control_matrix_tall.shape, dev_control_matrix_tall_squared.shape, pos.shape, np.count_nonzero(pos)
+
+    # Without robustness iterations, the deviations of all controls for
+    # the same strain (or any strains with the same mean control value)
+    # can be fit as one weighted point
+    def fit_sigma(ind, delta_fraction):
+        x = repeated_raw_mean_control_profile[ind]
+        interp_delta = get_interp_delta(x, delta_fraction)
+        if get_lowess_method(config_params) == 'reference':
+            return py_lowess(x, dev_control_matrix_tall_squared[ind], f=0.3, iter=1, num_cores = get_num_cores(config_params),
+                    dup_x_speedup = True, method = 'reference', interp_delta = interp_delta)
+        return py_lowess_grouped(x, dev_control_matrix_tall_squared[ind], f=0.3, num_cores = get_num_cores(config_params), interp_delta = interp_delta)
+    normalization_delta, sigma_delta = get_lowess_deltas(config_params)
     lowess = np.zeros(dev_control_matrix_tall.shape)
-    for i in range(dev_control_matrix.shape[1]):
-        if get_verbosity(config_params) >= 3:
-            print dev_control_matrix_tall[pos],  dev_control_matrix_tall_squared[pos]
-            print dev_control_matrix_tall.shape, dev_control_matrix_tall_squared.shape, pos.shape, scipy.nonzero(pos)[0].shape[0]
-    lowess[pos] = py_lowess(np.asarray(repeated_raw_mean_control_profile[pos].ravel().tolist()[0]), dev_control_matrix_tall_squared[pos], 
-                                   f=0.3, iter=1, num_cores = get_num_cores(config_params), dup_x_speedup = True)
-    lowess[neg] = py_lowess(np.asarray(repeated_raw_mean_control_profile[neg].ravel().tolist()[0]), dev_control_matrix_tall_squared[neg],
-                                   f=0.3, iter=1, num_cores = get_num_cores(config_params), dup_x_speedup = True)
-    lowess_pos = np.zeros(raw_mean_control_profile.shape) + np.nan
-    lowess_neg = np.zeros(raw_mean_control_profile.shape) + np.nan
-    for i in range(raw_mean_control_profile.shape[0]):
-        for j in range(i, dev_control_matrix_tall.shape[0], raw_mean_control_profile.shape[0]):
-            if pos[j]:
-                lowess_pos[i] = lowess[j]
-            else:
-                lowess_neg[i] = lowess[j]
+    lowess[pos] = fit_sigma(pos, sigma_delta)
+    lowess[neg] = fit_sigma(neg, sigma_delta)
+    if sigma_delta > 0 and get_verbosity(config_params) >= 2:
+        exact_lowess = np.zeros(dev_control_matrix_tall.shape)
+        exact_lowess[pos] = fit_sigma(pos, 0)
+        exact_lowess[neg] = fit_sigma(neg, 0)
+        print_delta_accuracy_report('sigma fit', sigma_delta, lowess, exact_lowess)
+
+    # Each strain takes the fit from its last control with a positive
+    # deviation, and from its last control without one
+    lowess = lowess.reshape(num_controls, num_strains).T
+    pos = pos.reshape(num_controls, num_strains).T
+    strains = np.arange(num_strains)
+    last_pos = num_controls - 1 - np.argmax(pos[:, ::-1], axis = 1)
+    last_not_pos = num_controls - 1 - np.argmax(~pos[:, ::-1], axis = 1)
+    # (a NaN deviation is not positive, so it gives a negative fit of 0)
+    lowess_pos = np.where(pos.any(axis = 1), lowess[strains, last_pos], np.nan)[:, None]
+    lowess_neg = np.where((~pos).any(axis = 1), lowess[strains, last_not_pos], np.nan)[:, None]
    
     ## Symmetric lowess is not used
     ## Smooths symmetric matrix, removing NaNs and non-well-behaved input    
@@ -303,13 +387,39 @@ def getAsymmetricSigmaForScipyMatrix(raw_mean_control_profile, dev_control_matri
     #return np.sqrt( lowess_neg ).real , np.sqrt( lowess_pos ).real, np.sqrt(lowess_symmetric[range(raw_mean_control_profile.shape[0])]).real
     return np.sqrt( lowess_neg ).real , np.sqrt( lowess_pos ).real
 
+def get_trimmed_sigmas(matrix, fraction = 0.75, max_block_size = 2**22):
+    '''
+    Returns the standard deviation of each column of "matrix", over the
+    "fraction" of its well-behaved values that are smallest in magnitude.
+    Columns with the same number of well-behaved values are sorted
+    together, in blocks of at most "max_block_size" values.
+    '''
+    num_rows, num_cols = matrix.shape
+    sigmas = np.zeros(num_cols) + np.nan
+    good = wellbehaved(matrix)
+    num_trimmed = (good.sum(axis = 0) * fraction).astype(np.int)
+    block_cols = max(1, max_block_size / max(num_rows, 1))
+    for m in np.unique(num_trimmed):
+        if m == 0:
+            continue
+        cols = np.flatnonzero(num_trimmed == m)
+        for block_start in range(0, len(cols), block_cols):
+            block = cols[block_start:(block_start + block_cols)]
+            # Values that are not well-behaved sort last. The smallest values
+            # are summed in order of magnitude, one column per row, so that
+            # the result is the same as np.std on each column's values.
+            abs_dev = np.where(good[:, block], np.abs(matrix[:, block]), np.inf)
+            smallest = np.argsort(abs_dev, axis = 0)[0:m]
+            trimmed = np.take_along_axis(matrix[:, block], smallest, axis = 0)
+            sigmas[block] = np.ascontiguousarray(trimmed.T).std(axis = 1)
+    return sigmas
+
 def scaleInteractions(config_params, outfolder, deviation_dataset, raw_dataset, control_condition_ids, lane_id):
     barcode_gene_ids, condition_ids, matrix = deviation_dataset
     
     # Get the detection limits
     sample_detection_limit, control_detection_limit = get_detection_limits(config_params)
     
-    scaled_dev_matrix = np.zeros(matrix.shape)
     control_matrix_gene_barcode_ids, control_matrix_condition_ids, control_matrix = get_control_dataset(raw_dataset, control_condition_ids, control_detection_limit, new_dataset = deviation_dataset)
 
     # Get rid of controls that have an infinite or NaN as one of their strains
@@ -326,34 +436,22 @@ def scaleInteractions(config_params, outfolder, deviation_dataset, raw_dataset,
 
     #lowess_neg, lowess_pos, lowess_symmetric = getAsymmetricSigmaForScipyMatrix(mean_control_profile, control_matrix, config_params)
     lowess_neg, lowess_pos = getAsymmetricSigmaForScipyMatrix(mean_control_profile, control_matrix, config_params)
-    for i in range(matrix.shape[1]):
-        deviation = np.array( matrix[:, [i]] )
-        #print 'deviation shape:', deviation.shape
-        #print 'lowess_neg shape:', lowess_neg.shape
-        #print 'lowess_pos shape:', lowess_pos.shape
-        k = wellbehaved(deviation) # this remains same but nevertheless I have put it here
-        I = np.argsort(abs(deviation[k]))
-        I = I[range(int( I.shape[0]*0.75) )] # median 75%
-        sigma = np.std(deviation[k][I])
-        #sigma = np.zeros(mean_control_profile.shape) + sigma
-        sigma = np.zeros(deviation.shape) + sigma
-        total_sigma_neg = np.nanmax([sigma, lowess_neg], axis = 0)
-        total_sigma_pos = np.nanmax([sigma, lowess_pos], axis = 0)
-        zscores = np.zeros(deviation.shape) + np.nan
-        #print 'zscores shape:', zscores.shape
-        #print 'total_sigma_neg shape:', total_sigma_neg.shape
-        #print 'total_sigma_pos shape:', total_sigma_pos.shape
-        zscores[deviation < 0] = deviation[deviation < 0] / total_sigma_neg[deviation < 0]
-        zscores[deviation > 0] = deviation[deviation > 0] / total_sigma_pos[deviation > 0]
-        zscores[deviation == 0] = 0
-        scaled_dev_matrix[:, i] = zscores.transpose()
+
+    # Each condition's deviations are scaled by the larger of its own
+    # (trimmed) standard deviation and the control sigma for each strain,
+    # on the side of the deviation's sign
+    matrix = np.asarray(matrix, dtype = np.float)
+    sigma = get_trimmed_sigmas(matrix)[None, :]
+    total_sigma_neg = np.fmax(sigma, lowess_neg)
+    total_sigma_pos = np.fmax(sigma, lowess_pos)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        scaled_dev_matrix = np.where(matrix < 0, matrix / total_sigma_neg, np.where(matrix > 0, matrix / total_sigma_pos, np.nan))
+    scaled_dev_matrix[matrix == 0] = 0
 
     # Dump out the scaled deviation matrix
     scaled_dev_dataset = [barcode_gene_ids, condition_ids, scaled_dev_matrix]
     scaled_dev_filename = os.path.join(outfolder, '{}_scaled_dev.dump.gz'.format(lane_id))
-    scaled_dev_of = gzip.open(scaled_dev_filename, 'wb')
-    cPickle.dump(scaled_dev_dataset, scaled_dev_of)
-    scaled_dev_of.close()
+    dump_dataset(scaled_dev_dataset, scaled_dev_filename, get_dataset_format(config_params))
 
     return scaled_dev_dataset
 
@@ -600,17 +698,55 @@ def get_batch_inds(sample_table, column, dataset):
         return [''], [np.arange(len(dataset[1]))]
     assert column in sample_table, '\n"sub_screen_column" parameter "{}" is not a column in the sample information table,\n' \
             'found here: {}'.format(column, config_params['sample_table_file'])
-    sample_table = sample_table.set_index(['screen_name', 'expt_id'], drop = False)
-    cond_tuples = [tuple(x) for x in dataset[1]]
-    batches = sample_table.loc[cond_tuples, column].values
-    batches_uniq = list(np.unique(batches))
-    batch_index_dict = {x:i for i,x in enumerate(batches_uniq)}
-    batch_index_list = [[] for i in range(len(batches_uniq))]
-    for i, cond in enumerate(cond_tuples):
-        batch = sample_table.loc[cond, column]
-        batch_index_list[batch_index_dict[batch]].append(i)
-
-    return batches_uniq, [np.array(x) for x in batch_index_list]
+    batches = index_sample_table(sample_table).get_column(column, dataset[1])
+    batches_uniq, batch_of_condition = np.unique(batches, return_inverse = True)
+
+    return list(batches_uniq), [np.flatnonzero(batch_of_condition == i) for i in range(len(batches_uniq))]
+
+def score_sub_screen(config_params, sample_table, batch_dataset, filtered_dataset, batch_outfolder, lane_id, cols, combined):
+    '''
+    Scores the conditions of one sub-screen (batch) of a lane and writes its
+    datasets to its own folder. If "combined" is not None, the normalized,
+    deviation and scaled deviation matrices are also written into columns
+    "cols" of its three SharedArrays.
+    '''
+    # Get list of control samples (control? = True)
+    control_condition_ids = get_control_condition_ids(batch_dataset, sample_table)
+    if len(control_condition_ids) == 0:
+        print 'No control conditions detected for lane "{}", using all conditions as pseudo-controls instead'.format(lane_id)
+
+    # Proceed with algorithm to obtain chemical genetic interaction zscores (scaled deviations)
+    if get_verbosity(config_params) >= 1:
+        print "Normalizing ... "
+    normalized_dataset, mean_control_profile = normalizeUsingAllControlsAndSave(config_params, batch_outfolder, filtered_dataset, control_condition_ids, lane_id)
+    if get_verbosity(config_params) >= 1:
+        print "Column means: "
+        print np.nanmean(normalized_dataset[2], axis = 0)
+        print "Done"
+        print "Calculating deviations ... "
+    deviation_dataset = deviations_globalmean(config_params, batch_outfolder, normalized_dataset, mean_control_profile, lane_id)
+    if get_verbosity(config_params) >= 1:
+        print "Column means: "
+        print np.nanmean(deviation_dataset[2], axis = 0)
+        print "Done"
+        print "Scaling interactions ... "
+    scaled_dev_dataset = scaleInteractions(config_params, batch_outfolder, deviation_dataset, filtered_dataset, control_condition_ids, lane_id)
+    if get_verbosity(config_params) >= 1:
+        print "Column means: "
+        print np.nanmean(scaled_dev_dataset[2], axis = 0)
+        print "Done"
+    # For another time
+    #if 'generate_scatterplots' in config_params:
+    #    if config_params['generate_scatterplots'] == 'Y' and lane_id == 'all_lanes_filtered':
+    #        if get_verbosity(config_params) >= 1:
+    #            print "Generating scatterplots"
+    #        generate_scatterplots(config_params, outfolder, mean_control_profile, filtered_dataset, normalized_dataset, deviation_dataset, scaled_dev_dataset)
+
+    if combined is not None:
+        for shared_array, scored_dataset in zip(combined, [normalized_dataset, deviation_dataset, scaled_dev_dataset]):
+            shared_array.array[:, cols] = scored_dataset[2]
+
+    return None
 
 def main(config_file, lane_id):
     
@@ -638,80 +774,60 @@ def main(config_file, lane_id):
         if not os.path.isdir(folder):
             os.makedirs(folder)
 
-    # Keep track of individual batch datasets so they can be joined together again.
+    # The sub-screens are scored at the same time, sharing the cores. If
+    # there is more than one (or the sub-screen was named), each one also
+    # writes its columns of the combined datasets, which are put together
+    # in shared memory.
     strains = dataset[0]
     batch_condition_list = []
-    normalized_dataset_list = []
-    mean_control_profile_list = []
-    deviation_dataset_list = []
-    scaled_dev_dataset_list = []
-
+    batch_args = []
+    num_combined_cols = 0
     for i, batch in enumerate(batches):
         batch_ind = batch_inds[i]
         # If there are no indices for this batch, then skip to the next batch
         # (unlikely but possible, and it definitely would break things)
         if len(batch_ind) == 0:
             continue
-        batch_outfolder = batch_outfolders[i]
         batch_conditions = dataset[1][batch_ind]
         batch_dataset = [dataset[0], batch_conditions, dataset[2][:, batch_ind]]
-    
+
         # Filter out samples flagged as "do not include" (include? == False)
         filtered_dataset = filter_dataset_for_include(batch_dataset, sample_table, config_params)
         batch_condition_list.append(filtered_dataset[1])
+        cols = slice(num_combined_cols, num_combined_cols + filtered_dataset[2].shape[1])
+        num_combined_cols = cols.stop
+
+        batch_args.append([batch, batch_dataset, filtered_dataset, batch_outfolders[i], cols])
 
-        # Get list of control samples (control? = True)
-        control_condition_ids = get_control_condition_ids(batch_dataset, sample_table)
-        if len(control_condition_ids) == 0:
-            print 'No control conditions detected for lane "{}", using all conditions as pseudo-controls instead'.format(lane_id)
-
-        # Proceed with algorithm to obtain chemical genetic interaction zscores (scaled deviations)
-        if get_verbosity(config_params) >= 1:
-            print "Normalizing ... "
-        normalized_dataset, mean_control_profile = normalizeUsingAllControlsAndSave(config_params, batch_outfolder, filtered_dataset, control_condition_ids, lane_id)
-        if get_verbosity(config_params) >= 1:
-            print "Column means: "
-            print np.nanmean(normalized_dataset[2], axis = 0)
-            print "Done"
-            print "Calculating deviations ... "
-        normalized_dataset_list.append(normalized_dataset)
-        mean_control_profile_list.append(mean_control_profile)
-        deviation_dataset = deviations_globalmean(config_params, batch_outfolder, normalized_dataset, mean_control_profile, lane_id)
-        if get_verbosity(config_params) >= 1:
-            print "Column means: "
-            print np.nanmean(deviation_dataset[2], axis = 0)
-            print "Done"
-            print "Scaling interactions ... "
-        deviation_dataset_list.append(deviation_dataset)
-        scaled_dev_dataset = scaleInteractions(config_params, batch_outfolder, deviation_dataset, filtered_dataset, control_condition_ids, lane_id)
-        if get_verbosity(config_params) >= 1:
-            print "Column means: "
-            print np.nanmean(scaled_dev_dataset[2], axis = 0)
-            print "Done"
-        scaled_dev_dataset_list.append(scaled_dev_dataset)
-        # For another time
-        #if 'generate_scatterplots' in config_params:
-        #    if config_params['generate_scatterplots'] == 'Y' and lane_id == 'all_lanes_filtered':
-        #        if get_verbosity(config_params) >= 1:
-        #            print "Generating scatterplots"
-        #        generate_scatterplots(config_params, outfolder, mean_control_profile, filtered_dataset, normalized_dataset, deviation_dataset, scaled_dev_dataset)
     # If the number of batches was greater than 1, then the data from the
     # different stages of interaction scoring have been exported into
     # batch-specific folders. Here we reconstruct the full datasets and export
     # them.
     # If one or more batch names were specified, then still dump out - for per-lane scoring
     if (len(batches) > 1) or (batches != ['']):
-        combined_conditions = np.vstack(batch_condition_list)
-        combined_norm_dataset = [strains, combined_conditions, np.hstack([x[2] for x in normalized_dataset_list])]
-        combined_dev_dataset = [strains, combined_conditions, np.hstack([x[2] for x in deviation_dataset_list])]
-        combined_scaled_dev_dataset = [strains, combined_conditions, np.hstack([x[2] for x in scaled_dev_dataset_list])]
-        with gzip.open(os.path.join(outfolder, '{}_lowess_norm.dump.gz'.format(lane_id)), 'wb') as f_norm:
-            cPickle.dump(combined_norm_dataset, f_norm)
-        with gzip.open(os.path.join(outfolder, '{}_deviation.dump.gz'.format(lane_id)), 'wb') as f_dev:
-            cPickle.dump(combined_dev_dataset, f_dev)
-        with gzip.open(os.path.join(outfolder, '{}_scaled_dev.dump.gz'.format(lane_id)), 'wb') as f_scaleddev:
-            cPickle.dump(combined_scaled_dev_dataset, f_scaleddev)
-        # Should I dump out mean control profile here?
+        combined = [SharedArray((len(strains), num_combined_cols)) for x in range(3)]
+    else:
+        combined = None
+    tasks = []
+    for batch, batch_dataset, filtered_dataset, batch_outfolder, cols in batch_args:
+        task_name = 'sub-screen {}'.format(batch) if batch != '' else 'scoring'
+        tasks.append([(task_name, lane_id), [], score_sub_screen,
+            [config_params, sample_table, batch_dataset, filtered_dataset, batch_outfolder, lane_id, cols, combined]])
+    try:
+        run_task_graph(tasks, get_num_cores(config_params))
+
+        if combined is not None:
+            combined_conditions = np.vstack(batch_condition_list)
+            combined_norm_dataset, combined_dev_dataset, combined_scaled_dev_dataset = [[strains, combined_conditions, x.array] for x in combined]
+            dataset_format = get_dataset_format(config_params)
+            dump_dataset(combined_norm_dataset, os.path.join(outfolder, '{}_lowess_norm.dump.gz'.format(lane_id)), dataset_format)
+            dump_dataset(combined_dev_dataset, os.path.join(outfolder, '{}_deviation.dump.gz'.format(lane_id)), dataset_format)
+            dump_dataset(combined_scaled_dev_dataset, os.path.join(outfolder, '{}_scaled_dev.dump.gz'.format(lane_id)), dataset_format)
+            # Should I dump out mean control profile here?
+    finally:
+        if combined is not None:
+            for shared_array in combined:
+                shared_array.close()
 
     update_version_file(outfolder, VERSION)
     update_version_file(config_params['output_folder'], VERSION)
@@ -29,6 +29,8 @@ import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 from cg_common_functions import get_verbosity, get_sample_table, get_barcode_table, bool_dict, parse_yaml
 from version_printing import update_version_file
+from dataset_index import ConditionIndex, get_condition_ids, index_sample_table, index_barcode_table
+from dataset_io import load_dataset, dump_dataset, get_dataset_format
 
 
 #def get_sample_table(config_params):
@@ -66,34 +68,16 @@ def get_detection_limits(config_params):
 def load_dumped_count_matrix(config_params, lane_id):
 
     filename = get_dumped_count_matrix_filename(config_params, lane_id)
-    f = gzip.open(filename, 'rb')
-    barcodes, conditions, matrix = cPickle.load(f)
+    barcodes, conditions, matrix = load_dataset(filename)
     dataset = [np.array(barcodes), np.array(conditions), matrix]
-    f.close()
 
     return dataset
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
 def get_control_condition_ids(dataset, sample_table):
     
     [barcode_gene_ids, condition_ids, matrix] = dataset
    
-    control_bool_ind = np.array([bool_dict[x] for x in sample_table['control?']])
-    control_table = sample_table[control_bool_ind]
-    control_screen_names = control_table['screen_name']
-    control_expt_ids = control_table['expt_id']
-    control_condition_ids = np.array(list(it.izip(control_screen_names, control_expt_ids)))
-    
-    control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)])
+    control_condition_indices = np.flatnonzero(index_sample_table(sample_table).get_flags('control?', condition_ids))
     final_control_condition_ids = condition_ids[control_condition_indices]
 
     return final_control_condition_ids
@@ -102,7 +86,7 @@ def get_control_dataset(dataset, control_condition_ids):
     
     [barcode_gene_ids, condition_ids, matrix] = dataset
     
-    control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)])
+    control_condition_indices = ConditionIndex(control_condition_ids).find(condition_ids)
     
     if control_condition_indices.size == 0:
         control_condition_ids = condition_ids
@@ -121,11 +105,7 @@ def filter_dataset_for_include_2(dataset, sample_table):
     include_table = sample_table[include_bool_ind]
     not_include_table = sample_table[np.invert(include_bool_ind)]
 
-    include_screen_names = include_table['screen_name']
-    include_expt_ids = include_table['expt_id']
-    include_condition_ids = np.array(list(it.izip(include_screen_names, include_expt_ids)))
-    
-    include_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, include_condition_ids)])
+    include_condition_indices = index_sample_table(include_table).find(condition_ids)
     
     filtered_condition_ids = condition_ids[include_condition_indices]
     filtered_matrix = matrix[:, include_condition_indices]
@@ -142,8 +122,7 @@ def filter_dataset_for_barcodes(dataset, config_params):
     include_table = barcode_tab[include_bool_ind]
     not_include_table = barcode_tab[np.invert(include_bool_ind)]
     
-    include_strain_ids = include_table['Strain_ID'].values
-    include_strain_indices = np.array([i for i, strain_id in enumerate(strain_ids) if strain_id in include_strain_ids])
+    include_strain_indices = index_barcode_table(include_table).find(strain_ids)
 
     filtered_strain_ids = strain_ids[include_strain_indices]
     filtered_matrix = matrix[include_strain_indices, :]
@@ -177,11 +156,7 @@ def filter_dataset_for_index_tags(dataset, config_params):
     to_remove_table = sample_table[to_remove_idx]
     to_keep_table = sample_table[~to_remove_idx]
 
-    to_keep_screen_names = to_keep_table['screen_name']
-    to_keep_expt_ids = to_keep_table['expt_id']
-    to_keep_condition_ids = np.array(list(it.izip(to_keep_screen_names, to_keep_expt_ids)))
-
-    to_keep_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, to_keep_condition_ids)])
+    to_keep_condition_indices = index_sample_table(to_keep_table).find(condition_ids)
     
     filtered_condition_ids = condition_ids[to_keep_condition_indices]
     filtered_matrix = matrix[:, to_keep_condition_indices]
@@ -208,18 +183,11 @@ def filter_dataset_for_barcode_specific_patterns(dataset, config_params):
         print 'condition_ids_to_remove:'
         print cond_ids_to_remove
   
-    if cond_ids_to_remove != []:
-        to_remove_idx = np.array([a_is_row_in_b(tuple(x[1]), cond_ids_to_remove) for x in sample_table[['screen_name', 'expt_id']].iterrows()])
-    else:
-        to_remove_idx = np.array([False for x in sample_table[['screen_name', 'expt_id']].iterrows()])
+    to_remove_idx = ConditionIndex(cond_ids_to_remove).isin(get_condition_ids(sample_table))
     to_remove_table = sample_table[to_remove_idx]
     to_keep_table = sample_table[~to_remove_idx]
 
-    to_keep_screen_names = to_keep_table['screen_name']
-    to_keep_expt_ids = to_keep_table['expt_id']
-    to_keep_condition_ids = np.array(list(it.izip(to_keep_screen_names, to_keep_expt_ids)))
-
-    to_keep_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, to_keep_condition_ids)])
+    to_keep_condition_indices = index_sample_table(to_keep_table).find(condition_ids)
     
     filtered_condition_ids = condition_ids[to_keep_condition_indices]
     filtered_matrix = matrix[:, to_keep_condition_indices]
@@ -229,11 +197,10 @@ def filter_dataset_for_barcode_specific_patterns(dataset, config_params):
     ### and which of the barcode first bases ('A', 'C', 'G', 'T') it matched to
     to_remove_table = to_remove_table.reset_index(drop = True)
     # First, create a table of the correlation information
-    cor_tab = pd.DataFrame({'cond_ids': [tuple(x) for x in barcode_spec_condition_ids], 'corrs': barcode_spec_correlations, 'bases': start_base})
-    cor_tab = cor_tab.set_index('cond_ids')
+    cor_tab = pd.DataFrame({'corrs': barcode_spec_correlations, 'bases': start_base})
     # Now rearrange the table based on the "to_remove_table"
-    cor_tab_cond_ids_idx = [tuple(x[1]) for x in to_remove_table[['screen_name', 'expt_id']].iterrows()]
-    cor_tab_ordered = cor_tab.ix[cor_tab_cond_ids_idx]
+    cor_tab_cond_ids_idx = get_condition_ids(to_remove_table)
+    cor_tab_ordered = cor_tab.iloc[ConditionIndex(barcode_spec_condition_ids).lookup(cor_tab_cond_ids_idx)]
     if get_verbosity(config_params) >= 3:
         print cor_tab_cond_ids_idx
         print cor_tab_ordered
@@ -352,7 +319,7 @@ def dump_filtered_count_matrix(config_params, dataset):
         os.makedirs(dataset_path)
 
     dataset_filename = get_dumped_count_matrix_filename(config_params, lane_id)
-    dump_dataset(dataset, dataset_filename)
+    dump_dataset(dataset, dataset_filename, get_dataset_format(config_params))
     update_version_file(dataset_path, VERSION)
 
 def main(config_file):
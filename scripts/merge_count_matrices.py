@@ -27,6 +27,7 @@ import compressed_file_opener as cfo
 import cg_file_tools as cg_file
 from cg_common_functions import get_verbosity, get_sample_table, parse_yaml
 from version_printing import update_version_file
+from dataset_io import load_dataset, dump_dataset, get_dataset_format
 
 #def get_sample_table(config_params):
 #
@@ -64,12 +65,9 @@ def combine_count_matrices(config_params):
 
     for lane_id in all_lane_ids:
         count_matrix_filename = get_dumped_count_matrix_filename(config_params, lane_id)
-        f = gzip.open(count_matrix_filename)
-
-        gene_barcode_ids, condition_ids, count_matrix = cPickle.load(f)
+        gene_barcode_ids, condition_ids, count_matrix = load_dataset(count_matrix_filename)
 	print "number of nonzero barcodes: {}".format(len(gene_barcode_ids))
 
-        f.close()
         count_matrix_list.append(count_matrix)
         condition_id_list.append(condition_ids)
         gene_barcode_id_list.append(gene_barcode_ids)
@@ -97,12 +95,6 @@ def combine_count_matrices(config_params):
 
     return all_gene_barcode_ids, all_condition_ids, all_count_matrix
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def main(config_file):
 
     # Read in the config params
@@ -120,7 +112,7 @@ def main(config_file):
 
     # Dump out the combined count matrix!
     combined_count_filename = get_dumped_count_matrix_filename(config_params, 'all_lanes')
-    dump_dataset(dataset, combined_count_filename)
+    dump_dataset(dataset, combined_count_filename, get_dataset_format(config_params))
     
     update_version_file(config_params['output_folder'], VERSION)
 
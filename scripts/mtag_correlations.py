@@ -27,6 +27,8 @@ import cg_file_tools as cg_file
 from cg_common_functions import get_verbosity, get_sample_table, get_amplicon_struct_params, get_barcode_table, parse_yaml, bool_dict
 from read_type_functions import determine_read_type, get_seq_params
 from version_printing import update_version_file
+from dataset_index import ConditionIndex, index_sample_table
+from dataset_io import load_dataset, dump_dataset, get_dataset_format
 
 # import pdb
 
@@ -54,10 +56,6 @@ def get_all_lane_ids(sample_table):
 
     return np.unique(np.array(sample_table['lane']))
 
-def a_is_row_in_b(a, b):
-
-    return np.any(np.all(a == b, axis = 1))
-
 def combine_zscore_matrices(config_params):
 
     sample_table = get_sample_table(config_params)
@@ -73,11 +71,8 @@ def combine_zscore_matrices(config_params):
             print lane_id
         lane_interactions_path = get_lane_interactions_path(config_params, lane_id)
         lane_interactions_filename = os.path.join(lane_interactions_path, '{}_scaled_dev.dump.gz'.format(lane_id))
-        f = gzip.open(lane_interactions_filename)
-
-        gene_barcode_ids, condition_ids, zscore_matrix = cPickle.load(f)
+        gene_barcode_ids, condition_ids, zscore_matrix = load_dataset(lane_interactions_filename)
         # print "number of nonzero barcodes: {}".format(len(gene_barcode_ids))
-        f.close()
         zscore_matrix_list.append(zscore_matrix)
         condition_id_list.append(condition_ids)
         gene_barcode_id_list.append(gene_barcode_ids)
@@ -177,23 +172,11 @@ def pearson_between_two_mats_columns(A, B):
     # And compute the correlation coefficient!
     return np.dot(A_mA.T, B_mB) / np.sqrt(np.dot(ssA[:,None],ssB[None]))
 
-def dump_dataset(dataset, filename):
-
-    f = gzip.open(filename, 'wb')
-    cPickle.dump(dataset, f)
-    f.close()
-
 def get_control_condition_ids(dataset, sample_table):
 
     [barcode_gene_ids, condition_ids, matrix] = dataset
 
-    control_bool_ind = np.array([bool_dict[x] for x in sample_table['control?']])
-    control_table = sample_table[control_bool_ind]
-    control_screen_names = control_table['screen_name']
-    control_expt_ids = control_table['expt_id']
-    control_condition_ids = np.array(list(it.izip(control_screen_names, control_expt_ids)))
-
-    control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)])
+    control_condition_indices = np.flatnonzero(index_sample_table(sample_table).get_flags('control?', condition_ids))
     final_control_condition_ids = condition_ids[control_condition_indices]
 
     return final_control_condition_ids
@@ -202,7 +185,7 @@ def get_control_dataset(dataset, control_condition_ids):
 
     [barcode_gene_ids, condition_ids, matrix] = dataset
 
-    control_condition_indices = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, control_condition_ids)])
+    control_condition_indices = ConditionIndex(control_condition_ids).find(condition_ids)
 
     control_condition_ids = condition_ids[control_condition_indices]
     control_matrix = matrix[:, control_condition_indices]
@@ -230,7 +213,8 @@ def get_control_index_tag_correlations(control_dataset, sample_table, config_par
     corr_mat = np.corrcoef(matrix, rowvar = 0)
 
     condition_id_to_index_tag = get_condition_id_to_index_tag(sample_table)
-    index_tags = np.unique([condition_id_to_index_tag[tuple(condition_id)] for condition_id in condition_ids])
+    condition_index_tags = np.array([condition_id_to_index_tag[tuple(condition_id)] for condition_id in condition_ids])
+    index_tags = np.unique(condition_index_tags)
     if get_verbosity(config_params) >= 2:
         print corr_mat
         print index_tags[0:10]
@@ -255,7 +239,7 @@ def get_control_index_tag_correlations(control_dataset, sample_table, config_par
     for index_tag in index_tags:
         # Get indices of correlation matrix (symmetric)
         index_tag_condition_ids = np.vstack(index_tag_to_conditions[index_tag])
-        index_tag_inds = np.array([i for i, cond_id in enumerate(condition_ids) if a_is_row_in_b(cond_id, index_tag_condition_ids)], dtype = np.int)
+        index_tag_inds = np.flatnonzero(condition_index_tags == index_tag)
         if get_verbosity(config_params) >= 3:
             print index_tag_condition_ids
             print index_tag_inds
@@ -368,13 +352,13 @@ def main(config_file):
 
     # Export the initial combined z-score matrix
     per_lane_zscore_dataset_filename = os.path.join(index_tag_path, 'combined_per_lane_zscore_dataset.dump.gz')
-    dump_dataset(dataset, per_lane_zscore_dataset_filename)
+    dump_dataset(dataset, per_lane_zscore_dataset_filename, get_dataset_format(config_params))
 
     # Get just the control dataset, and dump that out too
     control_condition_ids = get_control_condition_ids(dataset, sample_table)
     control_dataset = get_control_dataset(dataset, control_condition_ids)
     per_lane_control_zscore_dataset_filename = os.path.join(index_tag_path, 'combined_per_lane_control_zscore_dataset.dump.gz')
-    dump_dataset(control_dataset, per_lane_control_zscore_dataset_filename)
+    dump_dataset(control_dataset, per_lane_control_zscore_dataset_filename, get_dataset_format(config_params))
 
     # Get the sorted index tag correlations for control conditions
     index_tags_sorted, control_index_tag_correlations_sorted = get_control_index_tag_correlations(control_dataset, sample_table, config_params)
@@ -21,7 +21,6 @@ matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
 import matplotlib.pyplot as plt
 import cPickle
 import itertools as it
-from Bio.trie import trie
 from fractions import Fraction
 
 barseq_path = os.getenv('BARSEQ_PATH')
@@ -29,9 +28,16 @@ assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set.
 sys.path.append(os.path.join(barseq_path, 'lib'))
 
 import compressed_file_opener as cfo
+from sequence_index import SequenceIndex
+from correction_cache import CorrectionCache, get_cache_key
+from sparse_count_array import SparseCountArray
 import cg_file_tools as cg_file
-from cg_common_functions import get_verbosity, get_sample_table, get_amplicon_struct_params, get_barcode_table, parse_yaml
+from cg_common_functions import get_verbosity, get_sample_table, get_amplicon_struct_params, get_barcode_table, get_num_cores, parse_yaml
 from version_printing import update_version_file
+from dataset_index import get_condition_ids
+from dataset_io import dump_dataset, get_dataset_format
+from contextlib import closing
+from multiprocessing import Pool
 
 #import pdb
 
@@ -62,6 +68,9 @@ def get_lane_data_paths(config_params, lane_id):
 def get_lane_reports_path(config_params, lane_id):
 
     output_folder = config_params['output_folder']
+    # Keep preview reports apart from those of the full lane
+    if get_preview_params(config_params) is not None:
+        return os.path.join(output_folder, 'reports', 'preview', lane_id)
     return os.path.join(output_folder, 'reports', lane_id)
 
 def get_barseq_filename(config_params, lane_id):
@@ -278,6 +287,32 @@ def write_summary(total_counts, common_primer_counts, total_index_barcode_counts
 
     of.close()
 
+def write_preview_summary(preview_params, preview_stats, common_primer_counts, total_index_barcode_counts, output_folder, lane_id):
+
+    filename = os.path.join(output_folder, '{0}_preview_summary.txt'.format(lane_id))
+
+    n_read = sum(x[0] for x in preview_stats)
+    n_parsed = sum(x[1] for x in preview_stats)
+
+    of = open(filename, 'wt')
+    of.write('Preview of {0} of each of {1} fastq files (or file pairs)\n'.format('the first {} reads'.format(preview_params[0]) if preview_params[0] > 0 else 'all reads', len(preview_stats)))
+    of.write('Number of reads read: {0}\n'.format(n_read))
+    of.write('Number of reads parsed (randomly selected fraction: {0}): {1}\n'.format(preview_params[1], n_parsed))
+    of.write('\n')
+
+    # Scale the counts by the estimated number of reads in the whole lane
+    if any(x[2] is None for x in preview_stats) or n_parsed == 0:
+        of.write('The total number of reads in the lane could not be estimated, as the position within bz2 and zip files is unknown.\n')
+    else:
+        est_total = sum(x[2] for x in preview_stats)
+        factor = est_total / n_parsed
+        of.write('Extrapolated to the full lane (estimated from the fraction of each file that was read):\n')
+        of.write('Total number of reads: {0:.0f}\n'.format(est_total))
+        of.write('Number of reads with common primer: {0:.0f}\n'.format(common_primer_counts * factor))
+        of.write('Number of reads that match index tags and genetic barcodes: {0:.0f}\n'.format(total_index_barcode_counts * factor))
+
+    of.close()
+
 def generate_reports(config_params, lane_id, count_array_dataset, count_matrix_dataset, filtered_count_matrix_dataset, seq_info_dict, total_counts, common_primer_counts, nonunique_dict):
 
     # seq_info_dict contains: match_dicts, read_ids, seq_types, and column_names
@@ -369,12 +404,9 @@ def dump_count_matrix(config_params, lane_id, strains, conditions, matrix):
     out_path = get_lane_data_paths(config_params, lane_id)[1]
     out_filename = os.path.join(out_path, '{0}_{1}'.format(lane_id, 'barseq_matrix.dump.gz'))
 
-    of = gzip.open(out_filename, 'wb')
-
     dataset = [strains, conditions, matrix]
-    cPickle.dump(dataset, of)
+    dump_dataset(dataset, out_filename, get_dataset_format(config_params))
 
-    of.close()
     update_version_file(out_path, VERSION)
 
 def get_fastq_filename_list(folder, read_type):
@@ -404,47 +436,211 @@ def get_fastq_filename_list(folder, read_type):
 
     return filenames
 
-def line_gen(folder, read_type):
+def block_gen(folder, read_type, block_size):
 
     filenames = get_fastq_filename_list(folder, read_type)
 
-    if read_type == 'single':
-        for fname in filenames:
-            with cfo.get_compressed_file_handle(fname) as f:
-                for i, line in enumerate(f):
-                    if i % 4 == 1:
-                        yield [line.rstrip()]
+    for fname in filenames:
+        for block in chunk_block_gen([fname, None, None], read_type, block_size):
+            yield block
+
+def get_fastq_chunks(folder, read_type, chunk_size):
+    '''
+    Splits the lane's fastq files into units of work for parallel parsing.
+    Each chunk is a list of [filename(s), start, stop], where start and stop
+    are byte offsets into the file (None means the whole file). Compressed
+    files cannot be entered at an arbitrary offset, so each of them is one
+    chunk. Uncompressed single-read files larger than "chunk_size" bytes are
+    split into record-aligned chunks. Paired files are always kept whole so
+    that the two reads of each pair stay in step.
+    '''
+    filenames = get_fastq_filename_list(folder, read_type)
+
+    chunks = []
+    for fname in filenames:
+        if read_type != 'single' or cfo.is_compressed(fname):
+            chunks.append([fname, None, None])
+            continue
+        size = os.path.getsize(fname)
+        offsets = [0]
+        while offsets[-1] + chunk_size < size:
+            next_offset = find_record_start(fname, offsets[-1] + chunk_size)
+            if next_offset >= size:
+                break
+            offsets.append(next_offset)
+        offsets.append(size)
+        for i in range(len(offsets) - 1):
+            chunks.append([fname, offsets[i], offsets[i + 1]])
+
+    return chunks
+
+def find_record_start(filename, offset):
+    '''
+    Returns the byte offset of the first fastq record that starts at or after
+    "offset." Since quality lines may also begin with "@", a header line is
+    only accepted if the line two below it begins with "+".
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        # Discard the (probably partial) line the offset landed in, unless
+        # the offset is already at the beginning of a line
+        if offset > 0:
+            f.seek(offset - 1)
+            if f.read(1) != '\n':
+                f.readline()
+        line_starts = []
+        lines = []
+        while True:
+            line_starts.append(f.tell())
+            line = f.readline()
+            if line == '':
+                return f.tell()
+            lines.append(line)
+            if len(lines) >= 3 and lines[-3].startswith('@') and lines[-1].startswith('+'):
+                return line_starts[-3]
+
+def chunk_block_gen(chunk, read_type, block_size):
+    '''
+    Yields the sequence lines of up to "block_size" reads at a time, as a
+    list with one list of lines per read in the read scheme. Whole files are
+    read (and decompressed) ahead in a background thread.
+    '''
+    fname, start, stop = chunk
+
+    if start is None:
+        if read_type == 'single':
+            with cfo.ThreadedLineReader(fname) as f:
+                while True:
+                    lines = f.read_lines(4 * block_size)
+                    if len(lines) == 0:
+                        break
+                    yield [lines[1::4]]
+        else:
+            # Each file is decompressed in its own thread, so the two reads
+            # of a pair are decompressed at the same time
+            with cfo.ThreadedLineReader(fname[0]) as f1, cfo.ThreadedLineReader(fname[1]) as f2:
+                while True:
+                    lines1 = f1.read_lines(4 * block_size)
+                    lines2 = f2.read_lines(4 * block_size)
+                    n_lines = min(len(lines1), len(lines2))
+                    if n_lines == 0:
+                        break
+                    yield [lines1[1:n_lines:4], lines2[1:n_lines:4]]
+    else:
+        # Uncompressed, record-aligned byte range of a single-read file
+        with open(fname, 'rb') as f:
+            f.seek(start)
+            pos = start
+            while pos < stop:
+                lines = list(it.islice(f, 4 * block_size))
+                if len(lines) == 0:
+                    break
+                line_ends = pos + np.cumsum([len(line) for line in lines])
+                n_lines = np.searchsorted(line_ends, stop, side = 'right')
+                pos = line_ends[-1]
+                yield [lines[1:n_lines:4]]
+
+def get_preview_params(config_params):
+    '''
+    Returns the number of reads to parse from the start of each fastq file
+    (0 for all of them) and the fraction of those reads to randomly select,
+    or None if the whole lane is to be parsed.
+    '''
+    preview_reads = int(config_params.get('preview_reads', 0))
+    preview_fraction = float(config_params.get('preview_fraction', 1))
+    if preview_reads <= 0 and preview_fraction >= 1:
+        return None
+    assert 0 < preview_fraction <= 1, '"preview_fraction" must be greater than 0 and at most 1.'
+    return max(preview_reads, 0), preview_fraction
+
+def get_fraction_read(f, filename):
+    '''
+    Returns the fraction of the file (as stored on disk) that has been read
+    through, or None if it is not known (bz2 and zip files).
+    '''
+    if isinstance(f, gzip.GzipFile):
+        pos = f.fileobj.tell()
+    elif isinstance(f, file):
+        pos = f.tell()
     else:
-        for fname_pair in filenames:
-            with cfo.get_compressed_file_handle(fname_pair[0]) as f1, cfo.get_compressed_file_handle(fname_pair[1]) as f2:
-                for i, (line1, line2) in enumerate(it.izip(f1, f2)):
-                    if i % 4 == 1:
-                        yield [line1.rstrip(), line2.rstrip()]
-
-def gen_seq_tries(seqs, tol):
-    # New: don't allow detection of any sequences whose length is equal to or
-    # less than the tolerance. This prevents weird behavior and should be a
-    # reasonable assumption for pretty much all use cases.
-    # Newer: make sure sequences are at least of length 2. I think this is
-    # necessitated by the new ability to specify the tolerance as a fraction,
-    # so a length 0 sequence would slip through here.
-    seqs = [seq for seq in seqs if len(seq) > max(tol, 2)]
-    lengths = list(set([len(seq) for seq in seqs]))
-    lengths.sort(key = lambda x: -x)
-    trie_list = [trie() for i in range(len(lengths))]
-    len_dict = {x:i for i,x in enumerate(lengths)}
-    for seq in seqs:
-        trie_list[len_dict[len(seq)]][seq] = 0
-    # Returns a list of tries, one for each sequence length,
-    # sorted in descending order by sequence length.
+        return None
+    return min(float(pos) / max(os.path.getsize(filename), 1), 1.)
+
+def preview_block_gen(folder, read_type, block_size, preview_reads, preview_fraction, preview_stats):
+    '''
+    Same as block_gen, but only reads the first "preview_reads" reads of each
+    fastq file (or file pair), and only yields a random "preview_fraction" of
+    those. For each file, [reads read, reads yielded, estimated total reads
+    in the file] is appended to "preview_stats."
+    '''
+    filenames = get_fastq_filename_list(folder, read_type)
+
+    for fname in filenames:
+        if read_type == 'single':
+            fname = [fname]
+        handles = [cfo.get_compressed_file_handle(x) for x in fname]
+        for f in handles:
+            if isinstance(f, gzip.GzipFile):
+                # Keep the compressed data read ahead small, so the position
+                # in the file is accurate
+                f.max_read_chunk = 2**16
+        rng = np.random.RandomState(0)
+        n_read = 0
+        n_kept = 0
+        exhausted = False
+        while not exhausted:
+            n = block_size if preview_reads == 0 else min(block_size, preview_reads - n_read)
+            if n <= 0:
+                break
+            lines = [list(it.islice(f, 4 * n)) for f in handles]
+            n_lines = min(len(x) for x in lines)
+            exhausted = n_lines < 4 * n
+            seqs = [x[1:n_lines:4] for x in lines]
+            n_read += len(seqs[0])
+            if preview_fraction < 1:
+                keep = np.flatnonzero(rng.rand(len(seqs[0])) < preview_fraction)
+                seqs = [[x[i] for i in keep] for x in seqs]
+            n_kept += len(seqs[0])
+            yield seqs
+
+        if exhausted:
+            est_total = float(n_read)
+        else:
+            fraction_read = get_fraction_read(handles[0], fname[0])
+            est_total = n_read / fraction_read if fraction_read else None
+        for f in handles:
+            f.close()
+        preview_stats.append([n_read, n_kept, est_total])
+
+def gen_seq_index(seqs, tol):
+    # Returns an index of all sequences within the tolerance of the given
+    # sequences, along with the sequence lengths it covers (sorted in
+    # descending order). Sequences whose length is not greater than the
+    # tolerance (or 2) are not indexed; see SequenceIndex.
     # FUTURE PLAN: allow for the observed sequence to match a different length
     # of reference sequence, basically so that insertions only cost 1 instead
     # of 2.
-    return trie_list, lengths
+    seq_index = SequenceIndex(seqs, tol)
+    return seq_index, seq_index.lengths
+
+# Dense count arrays with more elements than this (2 GB of counts) are
+# always kept sparse instead
+max_dense_count_array_size = 2**28
+
+def init_count_array(shape, config_params):
+    '''
+    Returns an empty count array of the given shape. It is sparse (storing
+    only the combinations that are observed) if "sparse_count_array" is set,
+    or if the dense array would be too large to hold in memory. This is
+    mainly an issue for paired reads with barcodes on both reads.
+    '''
+    if config_params.get('sparse_count_array', False) or np.prod([long(x) for x in shape]) > max_dense_count_array_size:
+        return SparseCountArray(shape)
+    return np.zeros(shape, dtype = np.int)
 
 def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_params, sample_tab, barcode_tab):
     '''
-    read_inds, seq_types, match_dicts, array_ind_dicts, seq_trie_lists, seq_lengths, tols, column_names, array = initialize_dicts_arrays(...)
+    read_inds, seq_types, match_dicts, array_ind_dicts, seq_indexes, seq_lengths, tols, column_names, array = initialize_dicts_arrays(...)
 
     Note that the steps marked "Remove duplicated barcodes/index tags" do not
     completely remove those sequences, just all duplicate copies. This was
@@ -463,7 +659,7 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
         assert index_tag_col in sample_tab.columns, 'sample_table_column "{}" specified in amplicon_struct_file is not present in the sample table.'.format(index_tag_col)
         # Remove duplicated index tags
         sample_tab = sample_tab[~sample_tab[index_tag_col].duplicated()]
-        index_tag_tries, index_tag_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col], index_tag_tol)
+        index_tag_index, index_tag_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col], index_tag_tol)
         index_tags = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col])}
         index_tags['multi_match'] = len(index_tags)
         index_tags['no_match'] = len(index_tags)
@@ -471,11 +667,11 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
         assert barcode_col in barcode_tab.columns, 'barcode_file_column "{}" specified in amplicon_struct_file is not present in the gene_barcode table.'.format(barcode_col)
         # Remove duplicated barcodes
         barcode_tab = barcode_tab[~barcode_tab[barcode_col].duplicated()]
-        barcode_tries, barcode_lengths = gen_seq_tries(barcode_tab.loc[:, barcode_col], barcode_tol)
+        barcode_index, barcode_lengths = gen_seq_index(barcode_tab.loc[:, barcode_col], barcode_tol)
         barcodes = {x:i for i, x in enumerate(barcode_tab.loc[:, barcode_col])}
         barcodes['multi_match'] = len(barcodes)
         barcodes['no_match'] = len(barcodes)
-        count_array = np.zeros((len(index_tags), len(barcodes)), dtype = np.int)
+        count_array = init_count_array((len(index_tags), len(barcodes)), config_params)
         # While the scheme is the same whether or not the single read is read_1
         # or read_2 (would it actually ever be read_2?!), I will return the id
         # of the read for use later on
@@ -485,7 +681,7 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
             read_id = 'read_2'
         else:
             assert False, "{} is not a valid read id".format(read_type_dict['barcode'])
-        return [0, 0], ['index_tag', 'barcode'], [read_id, read_id], [{}, {}], [index_tags, barcodes], [index_tag_tries, barcode_tries], [index_tag_lengths, barcode_lengths], [index_tag_tol, barcode_tol], [index_tag_col, barcode_col], count_array
+        return [0, 0], ['index_tag', 'barcode'], [read_id, read_id], [{}, {}], [index_tags, barcodes], [index_tag_index, barcode_index], [index_tag_lengths, barcode_lengths], [index_tag_tol, barcode_tol], [index_tag_col, barcode_col], count_array
     elif read_type_dict['type'] == 'paired':
         # Since there are always 2 index tags in a paired read scheme, I can write this code once.
         index_tag_col_1 = amplicon_struct_params['read_1']['index_tag']['sample_table_column']
@@ -495,7 +691,7 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
         # Remove duplicated index tags
         sample_tab = sample_tab[~sample_tab[[index_tag_col_1, index_tag_col_2]].duplicated()]
         if read_type_dict['barcode'] == ['read_1']:
-            index_tag_1_tries, index_tag_1_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
+            index_tag_1_index, index_tag_1_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
             index_tags_1 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_1])}
             index_tags_1['multi_match'] = len(index_tags_1)
             index_tags_1['no_match'] = len(index_tags_1)
@@ -503,22 +699,22 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
             assert barcode_col_1 in barcode_tab.columns, 'read_1 barcode_file_column "{}" specified in amplicon_struct_file is not present in the gene_barcode table.'.format(barcode_col_1)
             # Remove duplicated barcodes
             barcode_tab = barcode_tab[~barcode_tab[barcode_col_1].duplicated()]
-            barcode_1_tries, barcode_1_lengths = gen_seq_tries(barcode_tab.loc[:, barcode_col_1], barcode_tol)
+            barcode_1_index, barcode_1_lengths = gen_seq_index(barcode_tab.loc[:, barcode_col_1], barcode_tol)
             barcodes_1 = {x:i for i, x in enumerate(barcode_tab.loc[:, barcode_col_1])}
             barcodes_1['multi_match'] = len(barcodes_1)
             barcodes_1['no_match'] = len(barcodes_1)
-            index_tag_2_tries, index_tag_2_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
+            index_tag_2_index, index_tag_2_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
             index_tags_2 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_2])}
             index_tags_2['multi_match'] = len(index_tags_2)
             index_tags_2['no_match'] = len(index_tags_2)
-            count_array = np.zeros((len(index_tags_1), len(barcodes_1), len(index_tags_2)), dtype = np.int)
-            return [0, 0, 1], ['index_tag', 'barcode', 'index_tag'], ['read_1', 'read_1', 'read_2'], [{}, {}, {}], [index_tags_1, barcodes_1, index_tags_2], [index_tag_1_tries, barcode_1_tries, index_tag_2_tries], [index_tag_1_lengths, barcode_1_lengths, index_tag_2_lengths], [index_tag_tol, barcode_tol, index_tag_tol], [index_tag_col_1, barcode_col_1, index_tag_col_2], count_array
+            count_array = init_count_array((len(index_tags_1), len(barcodes_1), len(index_tags_2)), config_params)
+            return [0, 0, 1], ['index_tag', 'barcode', 'index_tag'], ['read_1', 'read_1', 'read_2'], [{}, {}, {}], [index_tags_1, barcodes_1, index_tags_2], [index_tag_1_index, barcode_1_index, index_tag_2_index], [index_tag_1_lengths, barcode_1_lengths, index_tag_2_lengths], [index_tag_tol, barcode_tol, index_tag_tol], [index_tag_col_1, barcode_col_1, index_tag_col_2], count_array
         elif read_type_dict['barcode'] == ['read_2']:
-            index_tag_1_tries, index_tag_1_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
+            index_tag_1_index, index_tag_1_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
             index_tags_1 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_1])}
             index_tags_1['multi_match'] = len(index_tags_1)
             index_tags_1['no_match'] = len(index_tags_1)
-            index_tag_2_tries, index_tag_2_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
+            index_tag_2_index, index_tag_2_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
             index_tags_2 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_2])}
             index_tags_2['multi_match'] = len(index_tags_2)
             index_tags_2['no_match'] = len(index_tags_2)
@@ -526,18 +722,18 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
             assert barcode_col_2 in barcode_tab.columns, 'read_2 barcode_file_column "{}" specified in amplicon_struct_file is not present in the gene_barcode table.'.format(barcode_col_2)
             # Remove duplicated barcodes
             barcode_tab = barcode_tab[~barcode_tab[barcode_col_2].duplicated()]
-            barcode_2_tries, barcode_2_lengths = gen_seq_tries(barcode_tab.loc[:, barcode_col_2], barcode_tol)
+            barcode_2_index, barcode_2_lengths = gen_seq_index(barcode_tab.loc[:, barcode_col_2], barcode_tol)
             barcodes_2 = {x:i for i, x in enumerate(barcode_tab.loc[:, barcode_col_2])}
             barcodes_2['multi_match'] = len(barcodes_2)
             barcodes_2['no_match'] = len(barcodes_2)
-            count_array = np.zeros((len(index_tags_1), len(index_tags_2), len(barcodes_2)), dtype = np.int)
-            return [0, 1, 1], ['index_tag', 'index_tag', 'barcode'], ['read_1', 'read_2', 'read_2'], [{}, {}, {}], [index_tags_1, index_tags_2, barcodes_2], [index_tag_1_tries, index_tag_2_tries, barcode_2_tries], [index_tag_1_lengths, index_tag_2_lengths, barcode_2_lengths], [index_tag_tol, index_tag_tol, barcode_tol], [index_tag_col_1, index_tag_col_2, barcode_col_1], count_array
+            count_array = init_count_array((len(index_tags_1), len(index_tags_2), len(barcodes_2)), config_params)
+            return [0, 1, 1], ['index_tag', 'index_tag', 'barcode'], ['read_1', 'read_2', 'read_2'], [{}, {}, {}], [index_tags_1, index_tags_2, barcodes_2], [index_tag_1_index, index_tag_2_index, barcode_2_index], [index_tag_1_lengths, index_tag_2_lengths, barcode_2_lengths], [index_tag_tol, index_tag_tol, barcode_tol], [index_tag_col_1, index_tag_col_2, barcode_col_2], count_array
         elif read_type_dict['barcode'] == ['read_1', 'read_2']:
-            index_tag_1_tries, index_tag_1_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
+            index_tag_1_index, index_tag_1_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_1], index_tag_tol)
             index_tags_1 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_1])}
             index_tags_1['multi_match'] = len(index_tags_1)
             index_tags_1['no_match'] = len(index_tags_1)
-            index_tag_2_tries, index_tag_2_lengths = gen_seq_tries(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
+            index_tag_2_index, index_tag_2_lengths = gen_seq_index(sample_tab.loc[:, index_tag_col_2], index_tag_tol)
             index_tags_2 = {x:i for i, x in enumerate(sample_tab.loc[:, index_tag_col_2])}
             index_tags_2['multi_match'] = len(index_tags_2)
             index_tags_2['no_match'] = len(index_tags_2)
@@ -547,62 +743,18 @@ def initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_param
             assert barcode_col_2 in barcode_tab.columns, 'read_2 barcode_file_column "{}" specified in amplicon_struct_file is not present in the gene barcode table.'.format(barcode_col_2)
             # Remove duplicated barcodes
             barcode_tab = barcode_tab[~barcode_tab[[barcode_col_1, barcode_col_2]].duplicated()]
-            barcode_1_tries, barcode_1_lengths = gen_seq_tries(barcode_tab.loc[:, barcode_col_1], barcode_tol)
+            barcode_1_index, barcode_1_lengths = gen_seq_index(barcode_tab.loc[:, barcode_col_1], barcode_tol)
             barcodes_1 = {x:i for i, x in enumerate(barcode_tab.loc[:, barcode_col_1])}
             barcodes_1['multi_match'] = len(barcodes_1)
             barcodes_1['no_match'] = len(barcodes_1)
-            barcode_2_tries, barcode_2_lengths = gen_seq_tries(barcode_tab.loc[:, barcode_col_2], barcode_tol)
+            barcode_2_index, barcode_2_lengths = gen_seq_index(barcode_tab.loc[:, barcode_col_2], barcode_tol)
             barcodes_2 = {x:i for i, x in enumerate(barcode_tab.loc[:, barcode_col_2])}
             barcodes_2['multi_match'] = len(barcodes_2)
             barcodes_2['no_match'] = len(barcodes_2)
-            count_array = np.zeros((len(index_tags_1), len(barcodes_1), len(index_tags_2), len(barcodes_2)), dtype = np.int)
-            return [0, 0, 1, 1], ['index_tag', 'barcode', 'index_tag', 'barcode'], ['read_1', 'read_1', 'read_2', 'read_2'], [{}, {}, {}, {}], [index_tags_1, barcodes_1, index_tags_2, barcodes_2], [index_tag_1_tries, barcode_1_tries, index_tag_2_tries, barcode_2_tries], [index_tag_1_lengths, barcode_1_lengths, index_tag_2_lengths, barcode_2_lengths], [index_tag_tol, barcode_tol, index_tag_tol, barcode_tol], [index_tag_col_1, barcode_col_1, index_tag_col_2, barcode_col_2], count_array
+            count_array = init_count_array((len(index_tags_1), len(barcodes_1), len(index_tags_2), len(barcodes_2)), config_params)
+            return [0, 0, 1, 1], ['index_tag', 'barcode', 'index_tag', 'barcode'], ['read_1', 'read_1', 'read_2', 'read_2'], [{}, {}, {}, {}], [index_tags_1, barcodes_1, index_tags_2, barcodes_2], [index_tag_1_index, barcode_1_index, index_tag_2_index, barcode_2_index], [index_tag_1_lengths, barcode_1_lengths, index_tag_2_lengths, barcode_2_lengths], [index_tag_tol, barcode_tol, index_tag_tol, barcode_tol], [index_tag_col_1, barcode_col_1, index_tag_col_2, barcode_col_2], count_array
     
 
-def match_seq(seq, seq_trie_length_list, tol, lengths):
-    '''
-    Returns first sequence that can be found in the given trie
-    that matches the query sequences within the number of given mismatches.
-    Comparisons are only performed between same-length sequences, aka the query
-    string is sliced to the the same length as each set of reference sequences
-    and the comparisons proceed starting with the longest slices first.
-
-    Returns "multi_match" if the query sequence matches two reference sequences
-    with the same distance. Returns "no_match" if it goes through everything
-    and no match is found.
-    '''
-
-    #if seq == 'TAGACACGTACGCTGCAGGTC':
-    #    pdb.set_trace()
-
-    for i, l in enumerate(lengths):
-        if 0 < tol < 1:
-            n_mismatch = np.floor(tol * l).astype('int')
-        else:
-            n_mismatch = np.floor(tol).astype('int')
-        res = seq_trie_length_list[i].get_approximate(seq[0:l], n_mismatch)
-        if len(res) == 0:
-            continue
-
-        # If res meets the mismatch criterion, return before examining any others
-        # But must account for multi-matches!
-        if len(res) > 1:
-            res = list(set(res))
-            if len(res) > 1:
-                res.sort(key = lambda x: x[2])
-                if res[0][2] == res[1][2]:
-                    return 'multi_match'
-                else:
-                    return res[0][0]
-            else:
-                return res[0][0]
-
-        else:
-            return res[0][0]
-
-    # If nothing matched at all, return "no_match"!
-    return 'no_match'
-
 def initialize_cp_matchers(read_type_dict, amplicon_struct_params, config_params):
 
 
@@ -620,7 +772,7 @@ def initialize_cp_matchers(read_type_dict, amplicon_struct_params, config_params
         
     cp_tol = config_params.get('common_primer_tolerance', 0)
     bases = ['A', 'C', 'G', 'T']
-    cp_dicts = [{}]
+    cp_dicts = [{} for x in cp_seq_list]
     for i in range(len(cp_seq_list)):
         cp_seq = cp_seq_list[i]
         for mismatch_locs in it.combinations(range(len(cp_seq)), cp_tol):
@@ -633,7 +785,234 @@ def initialize_cp_matchers(read_type_dict, amplicon_struct_params, config_params
     return cp_read_inds, cp_dicts
 
 
-def parse_seqs(lane_id, config_params):
+def get_seq_matrix(lines, min_width):
+    '''
+    Converts a list of sequence lines into an (n x width) uint8 array of
+    characters, padded with zeros to at least "min_width" columns. Line
+    endings are zeroed out, so slicing a window past the end of a short read
+    gives the same (shorter) sequence as slicing the stripped line would.
+    '''
+    seqs = np.array(lines)
+    width = max(seqs.dtype.itemsize, min_width)
+    if seqs.dtype.itemsize < width:
+        seqs = seqs.astype('S{}'.format(width))
+    mat = seqs.view(np.uint8).reshape(len(seqs), width)
+    mat[(mat == ord('\n')) | (mat == ord('\r'))] = 0
+    return mat
+
+def get_window_codes():
+    '''
+    Returns a lookup table of 3-bit codes for the characters expected in
+    sequence windows (zero is the padding past the end of short reads). Any
+    other character gets code 7.
+    '''
+    codes = np.zeros(256, dtype = np.uint8) + 7
+    for i, char in enumerate('\x00ACGTN'):
+        codes[ord(char)] = i
+    return codes
+
+window_codes = get_window_codes()
+
+def unique_windows(window):
+    '''
+    Finds the unique rows of an (n x width) uint8 array of characters.
+    Returns the unique sequences as strings and, for each row, the index of
+    its sequence. Windows of up to 21 expected characters are packed
+    losslessly into one 64-bit integer first, since sorting integers is
+    much faster than sorting strings.
+    '''
+    n, width = window.shape
+    window = np.ascontiguousarray(window)
+    codes = window_codes[window]
+    if width <= 21 and not np.any(codes == 7):
+        keys = np.zeros(n, dtype = np.uint64)
+        for j in range(width):
+            keys <<= np.uint64(3)
+            keys |= codes[:, j]
+    else:
+        keys = window.view('S{}'.format(width)).ravel()
+
+    # Any occurrence of a sequence will do as its representative, so the
+    # (faster) unstable sort is fine here.
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    is_first = np.ones(n, dtype = np.bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = order[is_first]
+    inv = np.empty(n, dtype = np.int)
+    inv[order] = np.cumsum(is_first) - 1
+
+    seqs = [x.rstrip('\x00') for x in np.ascontiguousarray(window[first]).view('S{}'.format(width)).ravel()]
+    return seqs, inv
+
+def count_block(block, parse_params, match_dicts, cp_dicts, array):
+    '''
+    Tallies the common primers, index tags and barcodes of one block of reads
+    (see chunk_block_gen) into "cp_dicts", "match_dicts" and "array", which
+    are all modified in place. Each sequence window is cut out of every read
+    as a column slice, and matching is only performed once per unique
+    sequence in each window. Returns the number of reads in the block.
+    '''
+    read_params_clean = parse_params['read_params_clean']
+    read_inds = parse_params['read_inds']
+    seq_types = parse_params['seq_types']
+    array_ind_dicts = parse_params['array_ind_dicts']
+    seq_indexes = parse_params['seq_indexes']
+    seq_lengths = parse_params['seq_lengths']
+    known_matches = parse_params['known_matches']
+
+    n_reads = len(block[0])
+    if n_reads == 0:
+        return 0
+
+    # Common primer windows first (one per read), then index tags/barcodes.
+    # Always match on longest possible sequence, which is the first in the
+    # list of lengths (hence the [0]).
+    n_cp = len(cp_dicts)
+    windows = []
+    for i in range(n_cp):
+        start_coord = read_params_clean[i]['common_primer']['start']
+        windows.append([i, start_coord, start_coord + len(read_params_clean[i]['common_primer']['seq'])])
+    for i in range(len(read_inds)):
+        start_coord = read_params_clean[read_inds[i]][seq_types[i]]['start']
+        windows.append([read_inds[i], start_coord, start_coord + seq_lengths[i][0]])
+
+    # Get the unique sequences in each window, and which one each read has
+    seq_mats = [get_seq_matrix(lines, max(x[2] for x in windows)) for lines in block]
+    window_seqs = []
+    window_invs = []
+    for read_ind, start_coord, end_coord in windows:
+        seqs, inv = unique_windows(seq_mats[read_ind][:, start_coord:end_coord])
+        window_seqs.append(seqs)
+        window_invs.append(inv)
+    del seq_mats
+
+    # Check first for common primer!
+    cp_match = np.ones(n_reads, dtype = np.bool)
+    for i in range(n_cp):
+        seqs = window_seqs[i]
+        counts = np.bincount(window_invs[i], minlength = len(seqs))
+        is_cp = np.array([seq in cp_dicts[i] for seq in seqs], dtype = np.bool)
+        for j in np.flatnonzero(is_cp):
+            cp_dicts[i][seqs[j]] += int(counts[j])
+        cp_match &= is_cp[window_invs[i]]
+
+    # Match on index tags/barcodes for reads with all common primers
+    idxs = [None] * len(read_inds)
+    for i in range(len(read_inds)):
+        seqs = window_seqs[n_cp + i]
+        inv = window_invs[n_cp + i][cp_match]
+        counts = np.bincount(inv, minlength = len(seqs))
+        seq_idxs = np.zeros(len(seqs), dtype = np.int)
+        for j in np.flatnonzero(counts):
+            seq = seqs[j]
+            try:
+                match = match_dicts[i][seq]
+                match[1] += int(counts[j])
+            except KeyError as e:
+                # Sequences corrected in previous runs are taken from the
+                # cache, otherwise the sequence index returns the corrected
+                # sequence
+                corrected = known_matches[i].get(seq)
+                if corrected is None:
+                    corrected = seq_indexes[i].match(seq)
+                match = match_dicts[i][seq] = [corrected, int(counts[j])]
+            seq_idxs[j] = array_ind_dicts[i][match[0]]
+        idxs[i] = seq_idxs[inv]
+
+    if isinstance(array, SparseCountArray):
+        array.add_at(tuple(idxs))
+    else:
+        np.add.at(array, tuple(idxs), 1)
+
+    return n_reads
+
+def count_reads(blocks, parse_params, match_dicts, cp_dicts, array, report_progress = False):
+    '''
+    Counts every block of reads from "blocks" (see count_block). Returns the
+    number of reads examined.
+    '''
+    n_reads = 0
+    for block in blocks:
+        n_reads += count_block(block, parse_params, match_dicts, cp_dicts, array)
+        if report_progress:
+            sys.stdout.write('\r{} M reads'.format(n_reads / 1000000))
+            sys.stdout.flush()
+
+    return n_reads
+
+def count_chunk_reads(chunk):
+    '''
+    Worker function for parallel parsing. Reads the parsing parameters from
+    module-level globals (inherited by the worker processes) and returns
+    fresh counters for just this chunk, so they can be summed afterwards.
+    '''
+    global parse_params_
+    global read_type_
+
+    match_dicts = [{} for x in parse_params_['seq_types']]
+    cp_dicts = [dict.fromkeys(d, 0) for d in parse_params_['cp_dicts']]
+    if parse_params_['sparse_array']:
+        array = SparseCountArray(parse_params_['array_shape'])
+    else:
+        array = np.zeros(parse_params_['array_shape'], dtype = np.int)
+    n_reads = count_reads(chunk_block_gen(chunk, read_type_, parse_params_['block_size']), parse_params_, match_dicts, cp_dicts, array)
+
+    return array, match_dicts, cp_dicts, n_reads
+
+def merge_counts(match_dicts, cp_dicts, chunk_match_dicts, chunk_cp_dicts):
+    '''
+    Adds the sequence counters from one parsed chunk into the lane-wide
+    counters. The corrected sequence for any observed sequence does not
+    depend on which chunk it came from, so only the counts need adding.
+    '''
+    for i, d in enumerate(chunk_match_dicts):
+        for seq, match in d.iteritems():
+            if seq in match_dicts[i]:
+                match_dicts[i][seq][1] += match[1]
+            else:
+                match_dicts[i][seq] = match
+    for i, d in enumerate(chunk_cp_dicts):
+        for seq, count in d.iteritems():
+            cp_dicts[i][seq] += count
+
+    return None
+
+def get_fastq_chunk_size(config_params):
+    '''
+    Size (in bytes) above which uncompressed fastq files are split into
+    multiple chunks for parallel parsing. Specified in megabytes in the
+    config file.
+    '''
+    return int(float(config_params.get('fastq_chunk_size', 256)) * 2**20)
+
+def get_parse_block_size(config_params):
+    '''
+    Number of reads that are read in and matched together in one block.
+    Larger blocks find more duplicated reads at the cost of memory.
+    '''
+    return int(config_params.get('parse_block_size', 500000))
+
+def get_correction_cache(config_params):
+    '''
+    Returns the persistent cache of sequence corrections, or None if it has
+    been turned off by setting "correction_cache_size" to 0.
+    '''
+    max_size = int(config_params.get('correction_cache_size', 1000000))
+    if max_size <= 0:
+        return None
+    folder = config_params.get('correction_cache_folder')
+    if folder in [None, '']:
+        folder = os.path.join(config_params['output_folder'], 'intermediate', 'correction_cache')
+    return CorrectionCache(folder, max_size)
+
+def parse_seqs(lane_id, config_params, preview_stats = None):
+    '''
+    In preview mode (see get_preview_params), statistics on the reads read
+    from each file are appended to "preview_stats".
+    '''
+    global parse_params_
+    global read_type_
 
     amplicon_struct_params = get_amplicon_struct_params(config_params)
     sample_tab = get_sample_table(config_params)
@@ -650,63 +1029,66 @@ def parse_seqs(lane_id, config_params):
 
     cp_read_inds, cp_dicts = initialize_cp_matchers(read_type_dict, amplicon_struct_params, config_params)
 
-    read_inds, seq_types, read_ids, match_dicts, array_ind_dicts, seq_trie_lists, seq_lengths, tols, column_names, array = initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_params, sample_tab, barcode_tab)
+    read_inds, seq_types, read_ids, match_dicts, array_ind_dicts, seq_indexes, seq_lengths, tols, column_names, array = initialize_dicts_arrays(read_type_dict, amplicon_struct_params, config_params, sample_tab, barcode_tab)
 
     lane_location_tab = get_lane_location_table(config_params)
     folder = get_lane_folder(lane_id, lane_location_tab)
 
-    #pdb.set_trace()
-
-    n = len(read_inds)
-    idxs = [None] * n
-    print ''
-    for counter, line_list in enumerate(line_gen(folder, read_type_dict['type'])):
-    #for line_list in line_gen(folder, read_type_dict['type']):
-        
-        if counter % 1000000 == 0:
-            sys.stdout.write('\r{} M reads'.format(counter / 1000000))
-            sys.stdout.flush()
-
-        ## For testing
-        #if counter / 1000000 == 2:
-        #    break
-        
-        # Check first for common primer!
-        cp_match = [False] * len(cp_dicts)
-        for i in range(len(cp_dicts)):
-            start_coord = read_params_clean[i]['common_primer']['start']
-            end_coord = start_coord + len(read_params_clean[i]['common_primer']['seq'])
-            seq = line_list[i][start_coord:end_coord]
-            try:
-                cp_dicts[i][seq] += 1
-                cp_match[i] = True
-            except KeyError as e:
-                pass
+    # Load the corrections made to the same index tags/barcodes in previous
+    # runs. The cache keys depend only on the reference sequences, the
+    # tolerance and the length of the sequence window.
+    correction_cache = get_correction_cache(config_params)
+    cache_keys = [get_cache_key(sum(x.refs, []), x.tol, seq_lengths[i][0]) for i, x in enumerate(seq_indexes)]
+    if correction_cache is not None:
+        known_matches = [correction_cache.load(key) for key in cache_keys]
+    else:
+        known_matches = [{} for x in cache_keys]
 
-        if not all(cp_match):
-            continue
+    parse_params = {'read_params_clean': read_params_clean,
+            'read_inds': read_inds,
+            'seq_types': seq_types,
+            'array_ind_dicts': array_ind_dicts,
+            'seq_indexes': seq_indexes,
+            'seq_lengths': seq_lengths,
+            'known_matches': known_matches,
+            'block_size': get_parse_block_size(config_params)}
 
-        # Match on index tags/barcodes
-        for i in range(n):
-            start_coord = read_params_clean[read_inds[i]][seq_types[i]]['start']
-            # Always match on longest possible sequence, which is the first in the list (hence the [0])
-            end_coord = start_coord + seq_lengths[i][0]
-            #end_coord = read_params_clean[read_inds[i]][seq_types[i]]['end']
-            seq = line_list[read_inds[i]][start_coord:end_coord]
+    chunks = get_fastq_chunks(folder, read_type_dict['type'], get_fastq_chunk_size(config_params))
+    num_cores = min(get_num_cores(config_params), len(chunks))
+    preview_params = get_preview_params(config_params)
 
-            try:
-                corrected_seq = match_dicts[i][seq][0]
-                match_dicts[i][seq][1] += 1
-            except KeyError as e:
-                # match_seq returns the corrected sequence
-                match_dicts[i][seq] = [match_seq(seq, seq_trie_lists[i], tols[i], seq_lengths[i]), 1]
-                corrected_seq = match_dicts[i][seq][0]
+    #pdb.set_trace()
 
-            idxs[i] = array_ind_dicts[i][corrected_seq]
+    print ''
+    if preview_params is not None:
+        # Previews only read the beginning of each file, so there is little
+        # to be gained from splitting them up
+        blocks = preview_block_gen(folder, read_type_dict['type'], parse_params['block_size'], preview_params[0], preview_params[1], preview_stats)
+        n_reads = count_reads(blocks, parse_params, match_dicts, cp_dicts, array, report_progress = True)
+    elif num_cores > 1:
+        # Each worker counts its own chunks from scratch, and the results are
+        # summed here as they come in.
+        parse_params_ = dict(parse_params, cp_dicts = cp_dicts, array_shape = array.shape, sparse_array = isinstance(array, SparseCountArray))
+        read_type_ = read_type_dict['type']
+        n_reads = 0
+        with closing(Pool(processes = num_cores)) as pool:
+            for chunk_array, chunk_match_dicts, chunk_cp_dicts, chunk_n_reads in pool.imap_unordered(count_chunk_reads, chunks):
+                array += chunk_array
+                merge_counts(match_dicts, cp_dicts, chunk_match_dicts, chunk_cp_dicts)
+                n_reads += chunk_n_reads
+                sys.stdout.write('\r{} M reads'.format(n_reads / 1000000))
+                sys.stdout.flush()
+    else:
+        n_reads = count_reads(block_gen(folder, read_type_dict['type'], parse_params['block_size']), parse_params, match_dicts, cp_dicts, array, report_progress = True)
 
-        array[tuple(idxs)] += 1
+    # The reported read total has always been the index of the last read
+    counter = n_reads - 1
 
     print ''
+    if correction_cache is not None:
+        for i, key in enumerate(cache_keys):
+            correction_cache.update(key, match_dicts[i])
+
     return array, array_ind_dicts, match_dicts, cp_dicts, counter, seq_types, column_names, read_ids
 
 def map_counts_to_strains_conditions(array, array_ind_dicts, seq_types, column_names, config_params, lane_id):
@@ -721,8 +1103,8 @@ def map_counts_to_strains_conditions(array, array_ind_dicts, seq_types, column_n
     sample_tab = sample_tab[sample_tab.lane == lane_id]
 
     # Make mappings from each strain and condition to their respective barcode and index tag combinations
-    strain_to_barcode = {x[1]['Strain_ID']:tuple(x[1][column_names[seq_types == 'barcode']]) for x in barcode_tab.iterrows()}
-    condition_to_index_tag = {tuple(x[1][['screen_name', 'expt_id']]):tuple(x[1][column_names[seq_types == 'index_tag']]) for x in sample_tab.iterrows()}
+    strain_to_barcode = dict(zip(barcode_tab['Strain_ID'], [tuple(x) for x in barcode_tab[column_names[seq_types == 'barcode']].values]))
+    condition_to_index_tag = dict(zip([tuple(x) for x in get_condition_ids(sample_tab)], [tuple(x) for x in sample_tab[column_names[seq_types == 'index_tag']].values]))
    
     # Deal with strains/conditions that are not uniquely defined by their barcodes/index tags 
     strains_per_barcode = pd.Series(strain_to_barcode.values()).value_counts()
@@ -735,26 +1117,25 @@ def map_counts_to_strains_conditions(array, array_ind_dicts, seq_types, column_n
     strain_to_barcode_filtered = {x:strain_to_barcode[x] for x in strain_to_barcode.iterkeys() if strain_to_barcode[x] not in duplicated_barcodes}
     condition_to_index_tag_filtered = {x:condition_to_index_tag[x] for x in condition_to_index_tag.iterkeys() if condition_to_index_tag[x] not in duplicated_index_tags}
 
-    # Make an empty final matrix
     strains = np.array(strain_to_barcode_filtered.keys())
     conditions = np.array(condition_to_index_tag_filtered.keys())
-    matrix = np.zeros((len(strains), len(conditions)), dtype = np.int)
 
-    # Fill in the matrix!
+    # For each axis of the count array, get the index of every strain (a
+    # column vector, for barcode axes) or every condition (a row vector, for
+    # index tag axes). Together they broadcast to the full strain x
+    # condition matrix, which is then pulled out of the array in one go.
     ndim = len(array.shape)
-    for i, strain in enumerate(strains):
-        for j, condition in enumerate(conditions):
-            idx = [None] * ndim
-            index_tag_counter = 0
-            barcode_counter = 0
-            for k in range(ndim):
-                if seq_types[k] == 'index_tag':
-                    idx[k] = array_ind_dicts[k][condition_to_index_tag[tuple(condition)][index_tag_counter]]
-                    index_tag_counter += 1
-                else:
-                    idx[k] = array_ind_dicts[k][strain_to_barcode[strain][barcode_counter]]
-                    barcode_counter += 1
-            matrix[i, j] = array[tuple(idx)]
+    idx = [None] * ndim
+    index_tag_counter = 0
+    barcode_counter = 0
+    for k in range(ndim):
+        if seq_types[k] == 'index_tag':
+            idx[k] = np.array([array_ind_dicts[k][condition_to_index_tag[tuple(condition)][index_tag_counter]] for condition in conditions], dtype = np.int).reshape(1, -1)
+            index_tag_counter += 1
+        else:
+            idx[k] = np.array([array_ind_dicts[k][strain_to_barcode[strain][barcode_counter]] for strain in strains], dtype = np.int).reshape(-1, 1)
+            barcode_counter += 1
+    matrix = array[tuple(idx)]
 
     return strains, conditions, matrix, strains_per_barcode[strains_per_barcode > 1], conditions_per_index_tag[conditions_per_index_tag > 1]
 
@@ -792,7 +1173,8 @@ def main(config_file, lane_id):
     amplicon_struct_params = get_amplicon_struct_params(config_params)
 
     # Check for common primer and put all reads into a master array
-    count_array, array_ind_dicts, match_dicts, cp_dicts, total_reads, seq_types, column_names, read_ids = parse_seqs(lane_id, config_params)
+    preview_stats = []
+    count_array, array_ind_dicts, match_dicts, cp_dicts, total_reads, seq_types, column_names, read_ids = parse_seqs(lane_id, config_params, preview_stats)
     
     #pdb.set_trace()
     
@@ -828,6 +1210,14 @@ def main(config_file, lane_id):
             {'barcode': nonunique_barcodes,
                 'index_tag': nonunique_index_tags}
             )
+
+    # Previews only get reports (plus totals extrapolated to the full lane),
+    # not the count array and matrix that the rest of the pipeline uses
+    preview_params = get_preview_params(config_params)
+    if preview_params is not None:
+        mapped_read_counts = count_array[tuple(slice(-2) for x in count_array.shape)].sum()
+        write_preview_summary(preview_params, preview_stats, count_array.sum(), mapped_read_counts, get_lane_reports_path(config_params, lane_id), lane_id)
+        return None
     
     # Dump the raw count array in case someone wants to use it
     if get_verbosity(config_params) >= 1:
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import gzip, bz2
+import random
+from distutils.spawn import find_executable
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+from testing_lib import get_results_dir
+import compressed_file_opener as cfo
+
+results_dir = get_results_dir()
+os.makedirs(results_dir)
+
+# Compares the lines read by ThreadedLineReader, in batches of various sizes
+# and with blocks much smaller than the lines, to the lines of the file.
+
+rnd = random.Random(0)
+lines = [''.join(rnd.choice('ACGTN') for j in range(rnd.randint(0, 60))) for i in range(3000)]
+text = '\n'.join(lines) + '\n'
+
+def write_file(name, opener, text):
+
+    filename = os.path.join(results_dir, name)
+    f = opener(filename, 'wb')
+    f.write(text)
+    f.close()
+    return filename
+
+plain_filename = write_file('reads.txt', open, text)
+gzip_filename = write_file('reads.txt.gz', gzip.open, text)
+bz2_filename = write_file('reads.txt.bz2', bz2.BZ2File, text)
+
+def read_all(reader, batch_sizes):
+
+    read = []
+    i = 0
+    while True:
+        batch = reader.read_lines(batch_sizes[i % len(batch_sizes)])
+        i += 1
+        if len(batch) == 0:
+            break
+        read.extend(batch)
+    # Keeps returning nothing at the end of the file
+    assert reader.read_lines(10) == []
+    return read
+
+def check_reader(filename, expected, external):
+
+    for block_size in [1, 7, 100, 2**22]:
+        with cfo.ThreadedLineReader(filename, block_size = block_size, queue_size = 2, external = external) as reader:
+            assert read_all(reader, [1, 5, 1000]) == expected
+    with cfo.ThreadedLineReader(filename, block_size = 13, external = external) as reader:
+        assert list(reader) == expected
+
+def test_built_in_decompression():
+    for filename in [plain_filename, gzip_filename, bz2_filename]:
+        check_reader(filename, lines, external = False)
+
+def test_no_final_line_ending():
+    filename = write_file('no_final_line_ending.txt.gz', gzip.open, text.rstrip('\n'))
+    check_reader(filename, lines, external = False)
+    filename = write_file('empty.txt.gz', gzip.open, '')
+    check_reader(filename, [], external = False)
+
+def test_external_decompression():
+    # Uses gzip, which is everywhere, in place of pigz
+    decompressors = cfo.external_decompressors
+    cfo.external_decompressors = {'\x1f\x8b\x08': ['pigz', 'gzip']}
+    try:
+        assert cfo.find_external_decompressor(gzip_filename) is not None
+        assert cfo.find_external_decompressor(plain_filename) is None
+        check_reader(gzip_filename, lines, external = True)
+        if cfo.find_external_decompressor(bz2_filename) is None:
+            check_reader(bz2_filename, lines, external = True)
+    finally:
+        cfo.external_decompressors = decompressors
+
+def use_script(name, script):
+
+    filename = os.path.join(results_dir, name)
+    f = open(filename, 'w')
+    f.write('#!/bin/sh\n' + script)
+    f.close()
+    os.chmod(filename, 0755)
+    return lambda x: filename
+
+def test_decompressor_messages():
+    gzip_path = find_executable('gzip')
+    find_decompressor = cfo.find_external_decompressor
+    try:
+        # More messages than fit in a pipe do not block the decompressor
+        cfo.find_external_decompressor = use_script('noisy.sh', 'head -c 1000000 /dev/zero >&2\n{} "$@"\n'.format(gzip_path))
+        check_reader(gzip_filename, lines, external = True)
+        # Failures are reported with the decompressor's messages
+        cfo.find_external_decompressor = use_script('failing.sh', 'echo "corrupt input" >&2\nexit 1\n')
+        with cfo.ThreadedLineReader(gzip_filename, external = True) as reader:
+            try:
+                read_all(reader, [10])
+                assert False, 'No error was raised.'
+            except AssertionError as e:
+                assert 'corrupt input' in str(e)
+    finally:
+        cfo.find_external_decompressor = find_decompressor
+
+def test_close_early():
+    # Closing before the end stops the background thread (and decompressor)
+    for external in [False, True]:
+        reader = cfo.ThreadedLineReader(gzip_filename, block_size = 1, queue_size = 1, external = external)
+        assert reader.read_lines(3) == lines[0:3]
+        reader.close()
+        assert not reader.thread.is_alive()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import multiprocessing as mp
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+from testing_lib import get_results_dir
+import correction_cache
+from correction_cache import CorrectionCache, get_cache_key
+
+results_dir = get_results_dir()
+os.makedirs(results_dir)
+
+refs = ['AAAAAA', 'CCCCCC', 'GGGGGG']
+
+class FakeTime:
+    '''
+    Stands in for the time module, so entries can be given distinct (or
+    identical) "last used" times.
+    '''
+    def __init__(self):
+        self.now = 0.0
+    def time(self):
+        return self.now
+
+def get_cache(name, max_size = 100):
+
+    return CorrectionCache(os.path.join(results_dir, name), max_size)
+
+def test_round_trip():
+    cache = get_cache('round_trip')
+    key = get_cache_key(refs, 1, 6)
+    assert cache.load(key) == {}
+    cache.update(key, {'AAAAAT': ['AAAAAA', 3], 'ACACAC': ['multi_match', 1], 'TTTTTT': ['no_match', 2]})
+    assert cache.load(key) == {'AAAAAT': 'AAAAAA', 'ACACAC': 'multi_match', 'TTTTTT': 'no_match'}
+    # A new cache on the same folder (e.g. another lane) sees the corrections
+    cache.update(key, {'CCCCCA': ['CCCCCC', 1]})
+    assert get_cache('round_trip').load(key) == {'AAAAAT': 'AAAAAA', 'ACACAC': 'multi_match', 'TTTTTT': 'no_match', 'CCCCCA': 'CCCCCC'}
+    assert not [x for x in os.listdir(cache.folder) if x.endswith('.tmp')]
+
+def test_key_changes():
+    key = get_cache_key(refs, 1, 6)
+    # The order and duplicates of the references do not matter...
+    assert get_cache_key(refs[::-1] + refs[0:1], 1, 6) == key
+    # ...but the references, tolerance and window length do
+    assert get_cache_key(refs + ['TTTTTT'], 1, 6) != key
+    assert get_cache_key(refs[0:2], 1, 6) != key
+    assert get_cache_key(refs, 2, 6) != key
+    assert get_cache_key(refs, 0.1, 6) != key
+    assert get_cache_key(refs, 1, 7) != key
+    cache = get_cache('key_changes')
+    cache.update(key, {'AAAAAT': ['AAAAAA', 1]})
+    assert cache.load(get_cache_key(refs, 2, 6)) == {}
+    assert cache.load(get_cache_key(refs + ['TTTTTT'], 1, 6)) == {}
+
+def test_eviction():
+    fake_time = FakeTime()
+    real_time = correction_cache.time
+    correction_cache.time = fake_time
+    try:
+        cache = get_cache('eviction', max_size = 3)
+        key = get_cache_key(refs, 1, 6)
+        cache.update(key, {'AAAAAT': ['AAAAAA', 5], 'AAAATA': ['AAAAAA', 1]})
+        fake_time.now = 1
+        cache.update(key, {'CCCCCA': ['CCCCCC', 1], 'CCCCAC': ['CCCCCC', 2]})
+        # The least recently used entry, with the fewest counts, goes first
+        assert sorted(cache.load(key)) == ['AAAAAT', 'CCCCAC', 'CCCCCA']
+        fake_time.now = 2
+        # Seeing an entry again makes it recently used
+        cache.update(key, {'AAAAAT': ['AAAAAA', 1], 'GGGGGA': ['GGGGGG', 1]})
+        assert sorted(cache.load(key)) == ['AAAAAT', 'CCCCAC', 'GGGGGA']
+        fake_time.now = 3
+        cache.update(key, {'GGGGAG': ['GGGGGG', 1], 'GGGAGG': ['GGGGGG', 1], 'GGAGGG': ['GGGGGG', 1], 'GAGGGG': ['GGGGGG', 7]})
+        assert len(cache.load(key)) == 3
+        assert 'GAGGGG' in cache.load(key)
+    finally:
+        correction_cache.time = real_time
+
+def write_entries(args):
+
+    folder, key, worker, n_updates = args
+    cache = CorrectionCache(folder, 1000000)
+    for i in range(n_updates):
+        cache.update(key, {'{}_{}'.format(worker, i): ['AAAAAA', 1], 'shared': ['AAAAAA', 1]})
+
+def test_concurrent_writers():
+    folder = os.path.join(results_dir, 'concurrent')
+    key = get_cache_key(refs, 1, 6)
+    n_workers = 4
+    n_updates = 25
+    pool = mp.Pool(n_workers)
+    pool.map(write_entries, [[folder, key, worker, n_updates] for worker in range(n_workers)])
+    pool.close()
+    pool.join()
+    # No update is lost, and the shared entry counts every update
+    entries = CorrectionCache(folder, 1000000)._read(key)
+    assert len(entries) == n_workers * n_updates + 1
+    assert entries['shared'][1] == n_workers * n_updates
+    assert not [x for x in os.listdir(folder) if x.endswith('.tmp')]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import gzip, cPickle
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+from testing_lib import get_results_dir
+from dataset_io import dataset_formats, dump_dataset, load_dataset, dataset_exists, find_dataset, get_npy_dataset_path
+from stacked_dataset import LowRankStack, is_low_rank_stack
+
+results_dir = get_results_dir()
+os.makedirs(results_dir)
+
+# Round-trips datasets through each of the dataset formats
+
+def get_filename(name, fmt):
+
+    return os.path.join(results_dir, '{}_{}.dump.gz'.format(name, fmt))
+
+def make_dataset(n_strains = 20, n_conds = 8):
+
+    rs = np.random.RandomState(0)
+    strains = np.array(['strain_{}'.format(i) for i in range(n_strains)], dtype = np.object)
+    conditions = np.array([['screen', 'cond_{}'.format(i)] for i in range(n_conds)], dtype = 'S').reshape(n_conds, 2)
+    matrix = rs.normal(size = (n_strains, n_conds))
+    if matrix.size > 0:
+        matrix[1, 2] = np.nan
+    return [strains, conditions, matrix]
+
+def make_stack(n_strains = 20, n_conds = 8, k = 4):
+
+    rs = np.random.RandomState(1)
+    base = rs.normal(size = (n_strains, n_conds))
+    base[3, 4] = np.nan
+    vectors = np.linalg.qr(rs.normal(size = (n_strains, k)))[0]
+    contributions = rs.normal(size = (k, n_conds))
+    return LowRankStack(base, vectors, contributions, range(k + 1))
+
+def assert_labels_equal(labels, new_labels):
+
+    assert len(labels) == len(new_labels)
+    for x, y in zip(labels, new_labels):
+        assert type(x) == type(y)
+        if isinstance(x, np.ndarray):
+            assert x.dtype == y.dtype
+            assert x.shape == y.shape
+        assert np.array_equal(np.asarray(x), np.asarray(y))
+
+def assert_matrices_equal(matrix, new_matrix):
+
+    assert matrix.shape == new_matrix.shape
+    assert matrix.dtype == new_matrix.dtype
+    assert np.array_equal(np.isnan(matrix), np.isnan(new_matrix))
+    assert np.array_equal(matrix[~np.isnan(matrix)], new_matrix[~np.isnan(new_matrix)])
+
+def test_round_trip():
+    for fmt in dataset_formats:
+        dataset = make_dataset()
+        filename = get_filename('round_trip', fmt)
+        dump_dataset(dataset, filename, fmt)
+        assert dataset_exists(filename)
+        new_dataset = load_dataset(filename)
+        assert_labels_equal(dataset[:-1], new_dataset[:-1])
+        assert_matrices_equal(dataset[-1], np.asarray(new_dataset[-1]))
+
+def test_round_trip_stacked_labels():
+    # Stacked datasets have a list of component numbers as their first label
+    for fmt in dataset_formats:
+        strains, conditions, matrix = make_dataset()
+        dataset = [[0, 1, 2], strains, conditions, np.array([matrix, 2 * matrix, 3 * matrix])]
+        filename = get_filename('stacked_labels', fmt)
+        dump_dataset(dataset, filename, fmt)
+        new_dataset = load_dataset(filename)
+        assert_labels_equal(dataset[:-1], new_dataset[:-1])
+        assert_matrices_equal(dataset[-1], np.asarray(new_dataset[-1]))
+
+def test_round_trip_empty_matrix():
+    for fmt in dataset_formats:
+        for n_strains, n_conds in [(0, 8), (20, 0), (0, 0)]:
+            dataset = make_dataset(n_strains, n_conds)
+            filename = get_filename('empty_{}_{}'.format(n_strains, n_conds), fmt)
+            dump_dataset(dataset, filename, fmt)
+            new_dataset = load_dataset(filename)
+            assert_labels_equal(dataset[:-1], new_dataset[:-1])
+            assert_matrices_equal(dataset[-1], np.asarray(new_dataset[-1]))
+
+def test_round_trip_low_rank_stack():
+    strains, conditions, matrix = make_dataset()
+    for kind in ['corrected', 'components']:
+        stack = make_stack()
+        if kind == 'components':
+            stack = LowRankStack(None, stack.vectors, stack.contributions, range(4), kind = kind)
+        dataset = [np.arange(len(stack)), strains, conditions, stack]
+        for fmt in dataset_formats:
+            filename = get_filename('stack_{}'.format(kind), fmt)
+            dump_dataset(dataset, filename, fmt)
+            new_dataset = load_dataset(filename)
+            assert_labels_equal(dataset[:-1], new_dataset[:-1])
+            new_stack = new_dataset[-1]
+            if fmt == 'pickle':
+                # Pickles hold the dense array, which can be read without
+                # BEAN-counter's modules
+                assert isinstance(new_stack, np.ndarray)
+                with gzip.open(filename) as f:
+                    assert isinstance(cPickle.load(f)[-1], np.ndarray)
+            else:
+                assert is_low_rank_stack(new_stack)
+                assert new_stack.kind == kind
+            assert_matrices_equal(np.asarray(stack), np.asarray(new_stack))
+
+def test_formats_replace_each_other():
+    dataset = make_dataset()
+    filename = get_filename('replace', 'all')
+    dump_dataset(dataset, filename, 'npy')
+    assert find_dataset(filename) == get_npy_dataset_path(filename)
+    assert not os.path.exists(filename)
+    dump_dataset(dataset, filename, 'pickle')
+    assert find_dataset(filename) == filename
+    assert not os.path.exists(get_npy_dataset_path(filename))
+
+def test_load_npy_folder_and_mmap():
+    dataset = make_dataset()
+    filename = get_filename('mmap', 'npy')
+    dump_dataset(dataset, filename, 'npy')
+    # The npy folder can be given in place of the filename
+    new_dataset = load_dataset(get_npy_dataset_path(filename))
+    assert_matrices_equal(dataset[-1], new_dataset[-1])
+    # Changes to a memory-mapped matrix are not written back to disk
+    new_dataset[-1][0, 0] = 1000
+    assert load_dataset(filename)[-1][0, 0] == dataset[-1][0, 0]
+    assert_matrices_equal(dataset[-1], load_dataset(filename, mmap = False)[-1])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+from stacked_dataset import LowRankStack
+
+# Compares LowRankStacks to the dense stacks they stand for
+
+rs = np.random.RandomState(0)
+base = rs.normal(size = (30, 12))
+base[2, 5] = np.nan
+vectors = rs.normal(size = (30, 5))
+contributions = rs.normal(size = (5, 12))
+zeroed_base = np.where(np.isnan(base), 0, base)
+
+def dense_layer(r):
+
+    layer = zeroed_base - np.dot(vectors[:, :r], contributions[:r])
+    layer[np.isnan(base)] = np.nan
+    return layer
+
+def assert_close(a, b):
+
+    assert np.array_equal(np.isnan(a), np.isnan(b))
+    assert np.allclose(a[~np.isnan(a)], b[~np.isnan(b)], rtol = 0, atol = 1e-12)
+
+def test_layers():
+    stack = LowRankStack(base, vectors, contributions, range(6))
+    assert stack.shape == (6, 30, 12)
+    assert len(stack) == 6
+    dense = np.asarray(stack)
+    for r in range(6):
+        assert_close(stack[r], dense_layer(r))
+        assert_close(dense[r], dense_layer(r))
+
+def test_iteration_matches_indexing():
+    # Iteration builds each layer from the previous one, including when the
+    # ranks skip, repeat or go back down
+    stack = LowRankStack(base, vectors, contributions, [0, 2, 2, 5, 1, 3])
+    layers = list(stack)
+    assert len(layers) == 6
+    for i, layer in enumerate(layers):
+        assert_close(layer, stack.layer(i))
+
+def test_indexing():
+    stack = LowRankStack(base, vectors, contributions, range(6))
+    dense = np.asarray(stack)
+    rows = np.array([0, 2, 7, 29])
+    cols = np.array([1, 5, 11])
+    assert_close(stack[3, rows, :][:, cols], dense[3][rows][:, cols])
+    assert_close(stack[4, :, 5], dense[4, :, 5])
+    sub_stack = stack[1:4, :, cols]
+    assert isinstance(sub_stack, LowRankStack)
+    assert_close(np.asarray(sub_stack), dense[1:4][:, :, cols])
+
+def test_components():
+    stack = LowRankStack(None, vectors, contributions, range(5), kind = 'components')
+    for r in range(5):
+        assert_close(stack[r], np.outer(vectors[:, r], contributions[r]))
+    assert_close(np.asarray(stack)[2], np.outer(vectors[:, 2], contributions[2]))
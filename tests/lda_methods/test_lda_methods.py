@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'master_scripts'))
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+import batch_correction
+
+# Compares the batch-correction LDA fitted in the span of the conditions
+# ("reduced") to the LDA fitted on strains x strains scatter matrices
+# ("full").
+
+def make_data(n_strains, n_conds, n_classes, seed):
+
+    rs = np.random.RandomState(seed)
+    classes = np.arange(n_conds) % n_classes
+    # Batch effects: a shared profile for each class, plus noise
+    batch_profiles = rs.normal(size = (n_strains, n_classes))
+    full_x = batch_profiles[:, rs.randint(0, n_classes, 2 * n_conds)] + rs.normal(size = (n_strains, 2 * n_conds))
+    small_x = batch_profiles[:, classes] + rs.normal(size = (n_strains, n_conds))
+    # Strains without any data
+    small_x[0:3] = 0
+    full_x[0:3] = 0
+    return small_x, full_x, classes
+
+def get_stacks(small_x, full_x, classes, n_comps):
+
+    return [np.asarray(batch_correction.outer_python_lda(small_x, full_x, classes, n_comps, method)) for method in ['reduced', 'full']]
+
+def test_fewer_conditions_than_strains():
+    small_x, full_x, classes = make_data(150, 40, 5, 0)
+    reduced, full = get_stacks(small_x, full_x, classes, 4)
+    assert reduced.shape == full.shape == (5, 150, 80)
+    assert np.allclose(reduced, full, rtol = 0, atol = 1e-8)
+
+def test_more_conditions_than_strains():
+    small_x, full_x, classes = make_data(30, 60, 4, 1)
+    reduced, full = get_stacks(small_x, full_x, classes, 3)
+    assert np.array_equal(reduced, full)
+
+def test_more_components_than_conditions():
+    # With 8 conditions, the span of the conditions has (at most) 8
+    # dimensions, but 10 components can be removed, as with the full LDA
+    small_x, full_x, classes = make_data(100, 8, 4, 2)
+    n_comps = 10
+    reduced, full = get_stacks(small_x, full_x, classes, n_comps)
+    assert reduced.shape == full.shape == (n_comps + 1, 100, 16)
+    # The directions with discriminant information (one fewer than the
+    # number of classes) are the same
+    assert np.allclose(reduced[0:4], full[0:4], rtol = 0, atol = 1e-8)
+    N = batch_correction.get_lda_components(small_x, classes, n_comps, 'reduced')
+    assert N.shape == (100, n_comps)
+    assert np.allclose(np.dot(N.T, N), np.eye(n_comps), rtol = 0, atol = 1e-10)
+    assert np.all(N[0:3] == 0)
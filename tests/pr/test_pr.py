@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+import pr
+
+# Compares precision_recall_curve to the original version, which stepped
+# through every sorted value
+
+def loop_precision_recall_curve(y_true, probas_pred):
+
+    sort_inds = np.argsort(-probas_pred)
+
+    total_pos = np.sum(y_true == 1)
+    tp = 0
+    fp = 0
+    start_prec = np.repeat(np.nan, total_pos + 1)
+    end_prec = start_prec.copy()
+    start_prec[0] = 1
+    end_prec[0] = 1
+    start_thresh = start_prec.copy()
+    end_thresh = end_prec.copy()
+    start_thresh[0] = probas_pred.max()
+    end_thresh[0] = probas_pred.max()
+
+    for i, idx in enumerate(sort_inds):
+        if y_true[idx] == 1:
+            tp += 1
+            start_prec[tp] = end_prec[tp] = tp * 1.0 / (tp + fp)
+            start_thresh[tp] = end_thresh[tp] = probas_pred[idx]
+        else:
+            fp += 1
+            end_prec[tp] = tp * 1.0 / (tp + fp)
+            end_thresh[tp] = probas_pred[idx]
+
+    dup_inds = start_prec == end_prec
+    final_len = (total_pos + 1) * 2 - np.sum(dup_inds)
+    recall = np.repeat(np.nan, final_len)
+    precision = recall.copy()
+    thresholds = recall.copy()
+    final_end_inds = np.arange(1, (total_pos + 1) * 2, 2) - np.cumsum(dup_inds)
+    final_start_inds = np.setdiff1d(np.arange(final_len), final_end_inds)
+
+    precision[final_start_inds] = start_prec[np.invert(dup_inds)]
+    precision[final_end_inds] = end_prec
+    recall[final_start_inds] = np.arange(total_pos + 1)[np.invert(dup_inds)]
+    recall[final_end_inds] = np.arange(total_pos + 1)
+    thresholds[final_start_inds] = start_thresh[np.invert(dup_inds)]
+    thresholds[final_end_inds] = end_thresh
+
+    return precision[::-1], recall[::-1] * 1.0 / total_pos, thresholds[1:][::-1]
+
+def assert_same_curve(y_true, probas_pred):
+
+    for size in [1, 7, 2**22]:
+        pr.chunk_size = size
+        try:
+            curve = pr.precision_recall_curve(y_true, probas_pred)
+        finally:
+            pr.chunk_size = 2**22
+        expected = loop_precision_recall_curve(y_true, probas_pred)
+        for x, y in zip(curve, expected):
+            np.testing.assert_array_equal(x, y)
+
+def test_random_scores():
+    rs = np.random.RandomState(0)
+    for n in [2, 10, 500]:
+        # Both labels must be present
+        y_true = rs.randint(0, 2, n)
+        y_true[0:2] = [1, 0]
+        assert_same_curve(y_true, rs.normal(size = n))
+
+def test_ties():
+    rs = np.random.RandomState(1)
+    y_true = rs.randint(0, 2, 300)
+    assert_same_curve(y_true, rs.randint(0, 5, 300).astype(np.float))
+
+def test_nans():
+    rs = np.random.RandomState(2)
+    y_true = rs.randint(0, 2, 300)
+    probas_pred = rs.normal(size = 300)
+    probas_pred[rs.randint(0, 300, 40)] = np.nan
+    assert_same_curve(y_true, probas_pred)
+
+def test_label_types():
+    rs = np.random.RandomState(3)
+    y_true = rs.randint(0, 2, 200)
+    probas_pred = rs.normal(size = 200)
+    assert_same_curve(y_true.astype(np.bool), probas_pred)
+    # -1 labels are negatives
+    y_signed = np.where(y_true == 1, 1, -1)
+    curve = pr.precision_recall_curve(y_signed, probas_pred)
+    for x, y in zip(curve, loop_precision_recall_curve(y_true, probas_pred)):
+        np.testing.assert_array_equal(x, y)
+
+def test_positives_first_and_last():
+    # The first sorted value is a positive (no negatives at 0 true positives),
+    # and the last is a positive too
+    probas_pred = np.arange(10, 0, -1).astype(np.float)
+    assert_same_curve(np.array([1, 0, 0, 1, 1, 0, 0, 0, 0, 1]), probas_pred)
+    assert_same_curve(np.array([0, 0, 1, 0, 0, 0, 0, 0, 0, 0]), probas_pred)
+    assert_same_curve(np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 1]), probas_pred)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import random
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+from sequence_index import SequenceIndex, get_n_mismatch
+
+# Compares the precomputed index to matching each query against every
+# reference by its edit distance, for full-length and truncated queries.
+
+def edit_distance(a, b):
+
+    prev = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+        prev = cur
+    return prev[-1]
+
+def brute_force_match(seq, refs, tol):
+
+    refs = sorted(set(x for x in refs if len(x) > max(tol, 2)))
+    for l in sorted(set(len(x) for x in refs), reverse = True):
+        length_refs = [x for x in refs if len(x) == l]
+        dists = [edit_distance(seq[0:l], x) for x in length_refs]
+        best = min(dists)
+        if best <= get_n_mismatch(tol, l):
+            if dists.count(best) > 1:
+                return 'multi_match'
+            return length_refs[dists.index(best)]
+    return 'no_match'
+
+def mutate(seq, n_changes, rnd):
+
+    seq = list(seq)
+    for i in range(n_changes):
+        op = rnd.randrange(3)
+        pos = rnd.randrange(len(seq) + 1)
+        if op == 0 and pos < len(seq):
+            seq[pos] = rnd.choice('ACGTN')
+        elif op == 1 and pos < len(seq):
+            del seq[pos]
+        else:
+            seq.insert(pos, rnd.choice('ACGT'))
+    return ''.join(seq)
+
+def check_queries(refs, tol, n_queries, rnd):
+
+    index = SequenceIndex(refs, tol)
+    for i in range(n_queries):
+        ref = rnd.choice(refs)
+        seq = mutate(ref, rnd.randint(0, 3), rnd)
+        # Truncates some of the queries, down to a single base
+        if rnd.random() < 0.5:
+            seq = seq[0:rnd.randint(1, len(seq))]
+        assert index.match(seq) == brute_force_match(seq, refs, tol), 'Query {} (tolerance {}) matched {} instead of {}'.format(seq, tol, index.match(seq), brute_force_match(seq, refs, tol))
+
+def test_whole_number_tolerance():
+    rnd = random.Random(0)
+    for tol in [0, 1, 2, 3]:
+        refs = [''.join(rnd.choice('ACGT') for j in range(rnd.choice([6, 8, 10]))) for i in range(20)]
+        check_queries(refs, tol, 300, rnd)
+
+def test_fractional_tolerance():
+    rnd = random.Random(1)
+    for tol in [0.1, 0.15, 0.25]:
+        refs = [''.join(rnd.choice('ACGT') for j in range(rnd.choice([8, 10, 12]))) for i in range(20)]
+        check_queries(refs, tol, 300, rnd)
+
+def test_multi_match():
+    index = SequenceIndex(['AAAAAA', 'AAAATT'], 1)
+    assert index.match('AAAAAT') == 'multi_match'
+    assert index.match('AAAAA') == 'AAAAAA'
+    assert index.match('AAAA') == 'no_match'
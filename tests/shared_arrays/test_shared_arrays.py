@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import cPickle
+import tempfile
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+import shared_arrays
+from shared_arrays import SharedArray, get_worker_pool
+
+def double_rows(args):
+
+    shared_input, shared_output, rows = args
+    shared_output.array[rows] = 2 * shared_input.array[rows]
+
+def test_pool_writes_to_shared_output():
+    data = np.random.RandomState(0).normal(size = (50, 7))
+    with SharedArray(data = data) as shared_input, SharedArray(data.shape) as shared_output:
+        get_worker_pool(2).map(double_rows, [[shared_input, shared_output, rows] for rows in np.array_split(np.arange(50), 5)])
+        assert np.array_equal(shared_output.array, 2 * data)
+
+def test_shared_data_is_not_copied():
+    data = np.arange(60, dtype = np.float).reshape(10, 6)
+    with SharedArray(data = data) as original:
+        shared = SharedArray(data = original.array)
+        assert shared.filename == original.filename
+        assert shared.array is original.array
+        # Views of part of the file are shared too
+        part = SharedArray(data = original.array[3:7])
+        assert part.filename == original.filename
+        assert np.array_equal(cPickle.loads(cPickle.dumps(part)).array, data[3:7])
+        # Closing an array that does not own the file leaves it in place
+        shared.close()
+        part.close()
+        assert os.path.exists(original.filename)
+    assert not os.path.exists(original.filename)
+
+def test_copy_on_write_data_is_copied():
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        np.arange(12, dtype = np.float).tofile(filename)
+        data = np.memmap(filename, dtype = np.float, mode = 'c', shape = (12,))
+        # This change is private to this process, so the file cannot be shared
+        data[0] = -1
+        with SharedArray(data = data) as shared:
+            assert shared.filename != filename
+            assert cPickle.loads(cPickle.dumps(shared)).array[0] == -1
+    finally:
+        os.remove(filename)
+
+def test_falls_back_when_shm_is_too_small():
+    if shared_arrays.shm_folder is None:
+        return
+    class SmallFilesystem:
+        f_bavail = 10
+        f_frsize = 4096
+    statvfs = shared_arrays.os.statvfs
+    shared_arrays.os.statvfs = lambda path: SmallFilesystem()
+    try:
+        with SharedArray((100, 100)) as too_big:
+            assert os.path.dirname(too_big.filename) != shared_arrays.shm_folder
+        with SharedArray((2000,)) as small:
+            assert os.path.dirname(small.filename) == shared_arrays.shm_folder
+            # The unwritten part of "small" counts against the free space
+            with SharedArray((4000,)) as second:
+                assert os.path.dirname(second.filename) != shared_arrays.shm_folder
+    finally:
+        shared_arrays.os.statvfs = statvfs
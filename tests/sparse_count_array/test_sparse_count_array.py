@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+#################################################################
+######  Copyright: Regents of the University of Minnesota  ######
+#################################################################
+
+import os, sys
+import cPickle
+import numpy as np
+
+barseq_path = os.getenv('BARSEQ_PATH')
+assert barseq_path is not None, "'BARSEQ_PATH' environment variable is not set. Please consult the instructions for setting up BEAN-counter."
+
+sys.path.append(os.path.join(barseq_path, 'lib'))
+
+import sparse_count_array
+from sparse_count_array import SparseCountArray
+
+# Compares SparseCountArrays to the dense count arrays they replace, for a
+# paired-end layout (index tag x index tag x barcode x barcode) with the
+# last row and column along each axis for unmatched sequences.
+
+shape = (9, 7, 41, 33)
+
+def random_reads(rs, n):
+
+    return tuple(rs.randint(0, dim, n) for dim in shape)
+
+def make_arrays(seed, n_blocks = 5, block_size = 2000):
+
+    rs = np.random.RandomState(seed)
+    sparse = SparseCountArray(shape)
+    dense = np.zeros(shape, dtype = np.int)
+    for i in range(n_blocks):
+        idxs = random_reads(rs, block_size)
+        sparse.add_at(idxs)
+        np.add.at(dense, idxs, 1)
+    return sparse, dense
+
+def test_counts_match_dense():
+    sparse, dense = make_arrays(0)
+    assert sparse.shape == dense.shape
+    assert np.array_equal(sparse.toarray(), dense)
+    assert sparse.sum() == dense.sum()
+    for axis in [0, 3, -1, (0, 1), (2, 3), (0, 1, 2, 3)]:
+        assert np.array_equal(sparse.sum(axis = axis), dense.sum(axis = axis))
+    rs = np.random.RandomState(1)
+    idxs = random_reads(rs, 500)
+    assert np.array_equal(sparse[idxs], dense[idxs])
+    assert sparse[-1, -1, 0, 0] == dense[-1, -1, 0, 0]
+    assert np.array_equal(sparse[0:-1, 2:5, :, 10:].toarray(), dense[0:-1, 2:5, :, 10:])
+
+def test_adding_arrays():
+    sparse, dense = make_arrays(2)
+    other_sparse, other_dense = make_arrays(3)
+    sparse += other_sparse
+    assert np.array_equal(sparse.toarray(), dense + other_dense)
+    sparse += other_dense
+    assert np.array_equal(sparse.toarray(), dense + 2 * other_dense)
+    sparse = cPickle.loads(cPickle.dumps(sparse, protocol = cPickle.HIGHEST_PROTOCOL))
+    assert np.array_equal(sparse.toarray(), dense + 2 * other_dense)
+
+def test_empty():
+    sparse = SparseCountArray(shape)
+    assert sparse.sum() == 0
+    assert np.array_equal(sparse.sum(axis = (2, 3)), np.zeros(shape[0:2], dtype = np.int))
+    assert sparse[1, 2, 3, 4] == 0
+    assert sparse.toarray().dtype == np.int
+
+def test_large_counts():
+    # Adding these as floats would round away the 1
+    sparse = SparseCountArray(shape)
+    sparse.add_at(([0], [0], [0], [0]), 2**53)
+    sparse.add_at(([0, 1], [0, 0], [0, 0], [0, 0]), 1)
+    assert sparse[0, 0, 0, 0] == 2**53 + 1
+    assert sparse.sum(axis = (1, 2, 3))[0] == 2**53 + 1
+
+def test_sum_counts():
+    rs = np.random.RandomState(4)
+    inds = rs.randint(0, 50, 1000)
+    counts = rs.randint(0, 100, 1000)
+    sums = sparse_count_array.sum_counts(inds, counts, 60)
+    assert sums.dtype == np.int
+    assert np.array_equal(sums, np.bincount(inds, weights = counts, minlength = 60))
+    assert np.array_equal(sparse_count_array.sum_counts(inds[0:0], counts[0:0], 3), [0, 0, 0])